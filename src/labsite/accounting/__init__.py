@@ -0,0 +1 @@
+default_app_config = 'labsite.accounting.apps.AccountingConfig'
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class AccountingConfig(AppConfig):
+    name = 'labsite.accounting'
+    label = 'accounting'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -1,13 +1,15 @@
 from collections import OrderedDict
 from datetime import date
-from itertools import chain
 
 from django import forms
-from django.db.models import DateField
+from django.db import transaction
+from django.db.models import Case, DateField, Value, When
 from django.utils.formats import date_format
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext as _
 
 from . import models
+from .ledger import MonthlyBalances
 from .utils import Month, format_currency
 
 
@@ -194,9 +196,10 @@ class MonthlyReconcileForm(forms.ModelForm):
         models.CashBalance,
     ]
 
-    def __init__(self, dirty, *args, **kwargs):
+    def __init__(self, dirty, *args, balances=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.dirty = dirty
+        self.balances = balances
 
     def clean(self):
         cleaned_data = super().clean()
@@ -212,11 +215,12 @@ class MonthlyReconcileForm(forms.ModelForm):
             msg = _("Changes need to be saved before the month can be reconciled.")
             raise forms.ValidationError(msg, code='dirty')
 
+        balances = self.balances
+        if balances is None:
+            balances = MonthlyBalances(cleaned_data['business_unit'], [month])
+
         for model in self.models:
-            try:
-                instance = model.objects.get(year=month.year, month=month.month)
-            except model.DoesNotExist:
-                instance = None
+            instance = balances.get(model, month)
 
             if instance is None or \
                instance.expected_amount is None or \
@@ -282,6 +286,7 @@ class MonthlyBalanceForm(forms.Form):
         self.business_unit = business_unit
         self.billing_month = billing_month
         self.fiscal_months = fiscal_months
+        self.balances = MonthlyBalances(business_unit, fiscal_months)
 
         # build month fields & data, make accessible through `month_data` attribute
         self.month_data = []
@@ -343,11 +348,14 @@ class MonthlyBalanceForm(forms.Form):
         """
         fields = OrderedDict()
         for key, model in self.models.items():
-            try:
-                instance = model.objects.get(month=month.month, year=month.year)
-                actual, expected = instance.actual_amount, instance.expected_amount
-            except model.DoesNotExist:
+            instance = self.balances.get(model, month)
+
+            if instance is None:
                 actual, expected = None, None
+            elif model is models.CashBalance:
+                actual, expected = instance.actual_amount, self.expected_cash_balances.get(month)
+            else:
+                actual, expected = instance.actual_amount, instance.expected_amount
 
             # build fields or get formatted values
             fields[self.field_name(month, key, 'expected')] = self.build_field(model, 'expected', expected, month)
@@ -355,9 +363,17 @@ class MonthlyBalanceForm(forms.Form):
 
         return fields
 
-    def save_month_data(self, month, data):
-        saved = []
+    @cached_property
+    def expected_cash_balances(self):
+        return models.CashBalanceSnapshot.objects.get_expected_amounts(
+            self.business_unit, self.fiscal_months[0], self.fiscal_months[-1],
+        )
 
+    def save_month_data(self, month, data, changes):
+        """
+        Apply the month's changed values to its balances. The instances are added to the
+        `changes` lists of created, updated and deleted instances, and are written by `save`.
+        """
         for key, model in self.models.items():
             expected = data.pop(self.field_name(month, key, 'expected'), empty)
             actual = data.pop(self.field_name(month, key, 'actual'), empty)
@@ -372,50 +388,80 @@ class MonthlyBalanceForm(forms.Form):
             if not update:
                 continue
 
+            instance = self.balances.get(model, month)
+
             # handle expected_amount clearing
             # since the field has a not-null constraint, it's necessary to delete the instance
             # if the actual_amount has not been set, then this is safe to do
             # if the actual is set, then we either have to noop and keep both or delete and remove both
             if expected is None:
-                instance = model.objects.get(
-                    month=month.month, year=month.year,
-                    business_unit=self.business_unit)
-
                 # we can safely delete if actual is not set
-                if instance.actual_amount is None:
-                    instance.delete()
-                    saved.append(instance)
+                if instance is not None and instance.actual_amount is None:
+                    changes['deleted'].append(instance)
 
                 continue
 
-            instance, created = model.objects.get_or_create(
-                month=month.month, year=month.year,
-                business_unit=self.business_unit,
-                defaults=update)
+            if instance is None:
+                instance = model(
+                    month=month.month, year=month.year,
+                    business_unit=self.business_unit,
+                    **update)
+                changes['created'].append(instance)
 
             # instance exists, update fields manually
-            if not created:
+            else:
                 for k, v in update.items():
                     setattr(instance, k, v)
-                instance.save(update_fields=update.keys())
-
-            saved.append(instance)
-
-        return saved
+                changes['updated'].append(instance)
 
     def save(self):
         # Only save fields that have changed
         cleaned_data = {key: self.cleaned_data[key] for key in self.changed_data}
-        saved = [
-            self.save_month_data(month, cleaned_data)
-            for month in self.fiscal_months
-        ]
+        changes = {'created': [], 'updated': [], 'deleted': []}
+        for month in self.fiscal_months:
+            self.save_month_data(month, cleaned_data, changes)
 
         # Something went wrong if 'cleaned_data' is not empty
         assert not cleaned_data
 
-        # 'saved' is a list of lists - this flattens the results
-        return list(chain.from_iterable(saved))
+        with transaction.atomic():
+            for model in self.models.values():
+                created = [instance for instance in changes['created'] if type(instance) is model]
+                updated = [instance for instance in changes['updated'] if type(instance) is model]
+                deleted = [instance for instance in changes['deleted'] if type(instance) is model]
+
+                model.objects.bulk_create(created)
+                if updated:
+                    update_amounts(model, updated)
+                if deleted:
+                    model.objects.filter(pk__in=[instance.pk for instance in deleted]).delete()
+
+            # bulk_create and update() do not send post_save signals
+            saved = changes['created'] + changes['updated']
+            if saved:
+                earliest = min(Month(instance) for instance in saved)
+                models.CashBalanceSnapshot.objects.invalidate(self.business_unit, earliest)
+
+        for instance in saved:
+            self.balances.add(instance)
+        for instance in changes['deleted']:
+            self.balances.remove(instance)
+
+        return saved + changes['deleted']
+
+
+def update_amounts(model, instances):
+    """
+    Update the amounts of the instances with a single query.
+    """
+    fields = [field for field in model._meta.concrete_fields if field.name in ('expected_amount', 'actual_amount')]
+
+    model.objects.filter(pk__in=[instance.pk for instance in instances]).update(**{
+        field.name: Case(
+            *[When(pk=instance.pk, then=Value(getattr(instance, field.attname))) for instance in instances],
+            output_field=field
+        ) for field in fields
+    })
 
 
 class UserTeamRoleCreateForm(BaseForm):
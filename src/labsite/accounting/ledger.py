@@ -0,0 +1,170 @@
+"""
+The month-by-month ledger of a business unit, as shown on the dashboard and the reconcile
+page. The invoices and each kind of monthly balance are loaded with a single query apiece,
+and the totals and the carried-over cash balances are then computed in memory.
+"""
+from collections import OrderedDict, namedtuple
+from decimal import Decimal
+
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+from . import models
+from .utils import Month
+
+
+Balance = namedtuple('Balance', ['expected_amount', 'actual_amount'])
+
+
+class MonthlyBalances:
+    """
+    The monthly balances of a business unit over a range of months. Each model's balances
+    are loaded with a single range query, and are indexed by model and month.
+    """
+    def __init__(self, business_unit, months):
+        self.business_unit = business_unit
+        self.months = list(months)
+        self._instances = {}
+
+    def load(self, model):
+        if model not in self._instances:
+            self._instances[model] = {
+                Month(instance): instance for instance in model.objects
+                .filter(business_unit=self.business_unit)
+                .range(self.months[0], self.months[-1])
+            }
+        return self._instances[model]
+
+    def get(self, model, month):
+        """
+        Returns the model's balance for the month, or None if there is no balance.
+        """
+        return self.load(model).get(Month(month))
+
+    def add(self, instance):
+        self.load(type(instance))[Month(instance)] = instance
+
+    def remove(self, instance):
+        self.load(type(instance)).pop(Month(instance), None)
+
+
+class Ledger:
+
+    def __init__(self, business_unit, months):
+        self.business_unit = business_unit
+        self.months = list(months)
+        self.monthly_balances = MonthlyBalances(business_unit, self.months)
+
+    @property
+    def start(self):
+        return self.months[0]
+
+    @property
+    def end(self):
+        return self.months[-1]
+
+    def get_invoices(self):
+        """
+        Returns the invoices that are expected or were paid during the ledger's months.
+        """
+        start, stop = self.start.as_date(), Month.next(self.end).as_date()
+
+        return models.Invoice.objects \
+            .exclude(contract__state=models.Contract.STATES.NEW) \
+            .filter(business_unit=self.business_unit) \
+            .filter(Q(expected_payment_date__gte=start, expected_payment_date__lt=stop) |
+                    Q(actual_payment_date__gte=start, actual_payment_date__lt=stop)) \
+            .select_related('contract') \
+            .order_by('expected_payment_date', 'pk')
+
+    @cached_property
+    def invoice_groups(self):
+        """
+        The invoices expected to be paid in each month.
+        """
+        groups = OrderedDict((month, []) for month in self.months)
+
+        for invoice in self._invoices:
+            month = Month(invoice.expected_payment_date)
+            if month in groups:
+                groups[month].append(invoice)
+
+        return list(groups.values())
+
+    @cached_property
+    def invoice_totals(self):
+        expected = OrderedDict((month, Decimal(0)) for month in self.months)
+        actual = OrderedDict((month, Decimal(0)) for month in self.months)
+
+        for invoice in self._invoices:
+            month = Month(invoice.expected_payment_date)
+            if month in expected:
+                expected[month] += invoice.expected_amount
+
+            if invoice.actual_payment_date is not None and invoice.actual_amount is not None:
+                month = Month(invoice.actual_payment_date)
+                if month in actual:
+                    actual[month] += invoice.actual_amount
+
+        return [Balance(expected[month], actual[month]) for month in self.months]
+
+    @cached_property
+    def expenses(self):
+        return self._get_monthly_list(models.Expenses)
+
+    @cached_property
+    def permanent_payroll(self):
+        return self._get_monthly_list(models.PermanentPayroll)
+
+    @cached_property
+    def temporary_payroll(self):
+        return self._get_monthly_list(models.TemporaryPayroll)
+
+    @cached_property
+    def cash_balances(self):
+        """
+        The cash balance of each month. The expected amount carries over last month's
+        balance (preferring the actual over the expected amount), adds this month's
+        expected invoices and subtracts this month's expenses.
+        """
+        instances = self._get_monthly_list(models.CashBalance)
+
+        # The balance carried over into the ledger's first month is a stored snapshot.
+        opening = models.CashBalanceSnapshot.objects.get_snapshot(self.business_unit, Month.prev(self.start))
+        carried = Decimal(0) if opening is None else opening.carried_amount
+
+        balances = []
+        for i, month in enumerate(self.months):
+            instance = instances[i]
+            expenses = sum(
+                balance.expected_amount or 0 for balance
+                in [self.expenses[i], self.permanent_payroll[i], self.temporary_payroll[i]]
+            )
+
+            expected = carried + self.invoice_totals[i].expected_amount - expenses
+            balances.append(Balance(expected, instance.actual_amount))
+            carried = instance.actual_amount or expected
+
+        return balances
+
+    @cached_property
+    def balances(self):
+        return OrderedDict([
+            ('Invoices', self.invoice_totals),
+            ('Expenses', self.expenses),
+            ('Permanent Payroll', self.permanent_payroll),
+            ('Temporary Payroll', self.temporary_payroll),
+            ('Cash Balance', self.cash_balances),
+        ])
+
+    @cached_property
+    def _invoices(self):
+        return list(self.get_invoices())
+
+    def _get_monthly_list(self, model):
+        # Months without a balance are filled in with unsaved instances.
+        return [
+            self.monthly_balances.get(model, month) or
+            model(business_unit=self.business_unit, year=month.year, month=month.month)
+            for month in self.months
+        ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-18 10:30
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+import labsite.accounting.models as accounting
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0008_auto_20180613_1358'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CashBalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expected_amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('actual_amount', models.DecimalField(blank=True, decimal_places=2, default=None, max_digits=10, null=True)),
+                ('month', models.SmallIntegerField(choices=[(1, 'January'), (2, 'February'), (3, 'March'), (4, 'April'), (5, 'May'), (6, 'June'), (7, 'July'), (8, 'August'), (9, 'September'), (10, 'October'), (11, 'November'), (12, 'December')], default=1)),
+                ('year', models.SmallIntegerField(default=accounting.current_year)),
+                ('business_unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounting.BusinessUnit')),
+            ],
+            options={
+                'ordering': ('-year', '-month'),
+                'abstract': False,
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='cashbalancesnapshot',
+            unique_together=set([('business_unit', 'year', 'month')]),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-18 10:35
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0009_cashbalancesnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='cashbalance',
+            unique_together=set([('business_unit', 'month', 'year')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cashbalancesnapshot',
+            unique_together=set([('business_unit', 'month', 'year')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='expenses',
+            unique_together=set([('business_unit', 'month', 'year')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='monthlyreconcile',
+            unique_together=set([('business_unit', 'month', 'year')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='permanentpayroll',
+            unique_together=set([('business_unit', 'month', 'year')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='temporarypayroll',
+            unique_together=set([('business_unit', 'month', 'year')]),
+        ),
+    ]
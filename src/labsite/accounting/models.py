@@ -1,13 +1,11 @@
 from datetime import date
 from decimal import Decimal
 
-from django.apps import apps
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Q, Sum
-from django.db.models import Value as V
-from django.db.models.functions import Coalesce
+from django.db import IntegrityError, models, transaction
+from django.db.models import Min, Q, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
 from django.utils.translation import ugettext_lazy as _
 from django_fsm import FSMField, transition
 
@@ -100,9 +98,11 @@ class Contract(models.Model):
         return '%s: %s' % (self.contract_id, self.name)
 
     def outstanding_amount(self):
-        total_received = self.invoice_set \
-            .filter(state=Invoice.STATES.RECEIVED) \
-            .aggregate(v=Coalesce(Sum('actual_amount'), V(Decimal(0))))['v']
+        # Totalled in Python, so that invoices prefetched by the contract views are used.
+        total_received = sum(
+            invoice.actual_amount or 0 for invoice in self.invoice_set.all()
+            if invoice.state == Invoice.STATES.RECEIVED
+        )
         return self.amount - total_received
 
     def get_invoices_expected_total(self):
@@ -197,7 +197,16 @@ class Invoice(LineItem):
 
 
 class MonthlyQuerySet(models.QuerySet):
-    # TODO: define before/after if useful
+    # TODO: define before if useful
+
+    def after(self, start):
+        # Inclusive of the start month.
+        start = Month(start)
+
+        return self.filter(
+            Q(year=start.year, month__gte=start.month) |
+            Q(year__gt=start.year)
+        )
 
     def range(self, start, stop, inclusive=True):
         # While counterintuitive, we're mostly dealing with inclusive month ranges.
@@ -230,7 +239,7 @@ class MonthlyReconcile(models.Model):
     objects = MonthlyQuerySet.as_manager()
 
     class Meta:
-        unique_together = ('month', 'year')
+        unique_together = ('business_unit', 'month', 'year')
         ordering = ('-year', '-month')
 
     def __repr__(self):
@@ -248,7 +257,7 @@ class MonthlyBalance(LineItem):
     objects = MonthlyQuerySet.as_manager()
 
     class Meta:
-        unique_together = ('month', 'year')
+        unique_together = ('business_unit', 'month', 'year')
         ordering = ('-year', '-month')
         abstract = True
 
@@ -270,86 +279,182 @@ class CashBalance(MonthlyBalance):
             - use *last* month's cash balance
             - add this month's billable invoices
             - subtract this month's expenses
+
+        The balances are computed once and stored as `CashBalanceSnapshot`s.
         """
-        # carry over last month's cash balance
-        cash_balance = Decimal(0)
-        if self.previous_cashbalance is not None:
-            # preference actual cash balance over expected
-            cash_balance = self.previous_cashbalance.actual_amount \
-                or self.previous_cashbalance.expected_amount
-
-        # sum all billable invoices
-        income = Invoice.objects \
-            .filter(
-                business_unit=self.business_unit,
-                expected_payment_date__year=self.year,
-                expected_payment_date__month=self.month) \
-            .exclude(contract__state=Contract.STATES.NEW) \
-            .aggregate(v=Coalesce(Sum('expected_amount'), V(Decimal(0))))['v']
+        return CashBalanceSnapshot.objects.get_expected_amount(self.business_unit, self)
 
-        # sum all expenses
-        expenses = Decimal(0)
-        for inst in [self.expenses, self.permanent_payroll, self.temporary_payroll]:
-            if inst is not None:
-                expenses += inst.expected_amount or 0
 
-        return cash_balance + income - expenses
+class Expenses(MonthlyBalance):
+    """
+    The total miscelaneous expenses for a month. (eg, phone bill + electric + ...)
+    """
 
-    @property
-    def previous_balance_kwargs(self):
-        previous = Month.prev(self)
-        return {
-            'business_unit': self.business_unit,
-            'year': previous.year,
-            'month': previous.month,
-        }
 
-    @property
-    def balance_kwargs(self):
+class PermanentPayroll(MonthlyBalance):
+    """
+    The full time payroll costs for a month.
+    """
+
+
+class TemporaryPayroll(MonthlyBalance):
+    """
+    The part time payroll costs for a month.
+    """
+
+
+class CashBalanceSnapshotQuerySet(MonthlyQuerySet):
+
+    def lock(self, business_unit):
+        """
+        Lock the business unit until the end of the transaction, so that its snapshots are
+        not extended while another transaction's invalidation is uncommitted.
+        """
+        pk = getattr(business_unit, 'pk', business_unit)
+        list(BusinessUnit.objects.select_for_update().filter(pk=pk).values_list('pk'))
+
+    def invalidate(self, business_unit, start=None):
+        """
+        Delete the business unit's snapshots from the start month onwards, or all of
+        its snapshots if no start month is given.
+        """
+        queryset = self.filter(business_unit=business_unit)
+        if start is not None:
+            queryset = queryset.after(start)
+
+        with transaction.atomic():
+            self.lock(business_unit)
+            return queryset.delete()
+
+    def get_expected_amount(self, business_unit, month):
+        snapshot = self.get_snapshot(business_unit, month)
+        if snapshot is None:
+            return Decimal(0)
+        return snapshot.expected_amount
+
+    def get_expected_amounts(self, business_unit, start, stop):
+        """
+        Returns a dict of the business unit's expected balances from the start to the stop
+        month, indexed by month. Months that precede all of its balances are omitted.
+        """
+        self.get_snapshot(business_unit, stop)
+
         return {
-            'business_unit': self.business_unit,
-            'year': self.year,
-            'month': self.month,
+            Month(snapshot): snapshot.expected_amount for snapshot
+            in self.filter(business_unit=business_unit).range(start, stop)
         }
 
-    def balance_property(model_name, kwargs_name):
-        def fget(self):
-            model = apps.get_model('accounting', model_name)
-            name = '_previous_%s' % model.__name__.lower()
+    def get_snapshot(self, business_unit, month):
+        """
+        Returns the business unit's snapshot for the month, computing any missing snapshots
+        up to it. Returns None if the month precedes all of the business unit's balances.
+        """
+        month = Month(month)
+        snapshot = get_or_none(self.filter(business_unit=business_unit, year=month.year, month=month.month))
 
-            if not hasattr(self, name):
-                kwargs = getattr(self, kwargs_name)
-                setattr(self, name, get_or_none(model.objects.filter(**kwargs)))
+        if snapshot is None:
+            snapshot = self.extend(business_unit, month)
+        return snapshot
 
-            return getattr(self, name)
+    def get_first_month(self, business_unit):
+        """
+        Returns the first month with an expected invoice or a monthly balance.
+        """
+        first = Invoice.objects \
+            .filter(business_unit=business_unit) \
+            .exclude(contract__state=Contract.STATES.NEW) \
+            .aggregate(v=Min('expected_payment_date'))['v']
+        months = [Month(first)] if first is not None else []
 
-        def fset(self, value):
-            model = apps.get_model('accounting', model_name)
-            name = '_previous_%s' % model.__name__.lower()
+        for model in [Expenses, PermanentPayroll, TemporaryPayroll, CashBalance]:
+            first = model.objects.filter(business_unit=business_unit).order_by('year', 'month').first()
+            if first is not None:
+                months.append(Month(first))
 
-            setattr(self, name, value)
+        return min(months, default=None)
 
-        return property(**{'fget': fget, 'fset': fset})
+    def extend(self, business_unit, stop):
+        """
+        Compute and store the business unit's snapshots up to and including the stop month,
+        continuing on from its latest snapshot. The stored snapshots should be a contiguous
+        run of months, so any snapshots following a missing month are recomputed.
+        """
+        stop = Month(stop)
 
-    previous_cashbalance = balance_property('CashBalance', 'previous_balance_kwargs')
-    expenses = balance_property('Expenses', 'balance_kwargs')
-    permanent_payroll = balance_property('PermanentPayroll', 'balance_kwargs')
-    temporary_payroll = balance_property('TemporaryPayroll', 'balance_kwargs')
+        with transaction.atomic():
+            self.lock(business_unit)
 
+            latest = None
+            for snapshot in self.filter(business_unit=business_unit).order_by('year', 'month'):
+                if latest is not None and Month(snapshot) != Month.next(latest):
+                    self.invalidate(business_unit, Month.next(latest))
+                    break
+                latest = snapshot
 
-class Expenses(MonthlyBalance):
-    """
-    The total miscelaneous expenses for a month. (eg, phone bill + electric + ...)
-    """
+            if latest is not None:
+                start, carried = Month.next(latest), latest.carried_amount
+            else:
+                start, carried = self.get_first_month(business_unit), Decimal(0)
 
+            if start is None or start > stop:
+                return None
 
-class PermanentPayroll(MonthlyBalance):
-    """
-    The full time payroll costs for a month.
-    """
+            return self.compute(business_unit, start, stop, carried)
 
+    def compute(self, business_unit, start, stop, carried):
+        """
+        Compute and store the business unit's snapshots from the start to the stop month,
+        given the amount carried over into the start month. Returns the last snapshot.
+        """
+        income = Invoice.objects \
+            .filter(business_unit=business_unit) \
+            .filter(expected_payment_date__gte=start.as_date(),
+                    expected_payment_date__lt=Month.next(stop).as_date()) \
+            .exclude(contract__state=Contract.STATES.NEW) \
+            .annotate(year=ExtractYear('expected_payment_date'), month=ExtractMonth('expected_payment_date')) \
+            .values_list('year', 'month') \
+            .annotate(v=Sum('expected_amount'))
+        income = {Month(year, month): amount for year, month, amount in income}
+
+        expenses = {}
+        for model in [Expenses, PermanentPayroll, TemporaryPayroll]:
+            for instance in model.objects.filter(business_unit=business_unit).range(start, stop):
+                expenses[Month(instance)] = expenses.get(Month(instance), 0) + (instance.expected_amount or 0)
+
+        cash_balances = {
+            Month(instance): instance.actual_amount for instance
+            in CashBalance.objects.filter(business_unit=business_unit).range(start, stop)
+        }
 
-class TemporaryPayroll(MonthlyBalance):
+        snapshots = []
+        for month in Month.range(start, Month.next(stop)):
+            expected = carried + income.get(month, 0) - expenses.get(month, 0)
+            snapshot = self.model(
+                business_unit=business_unit, year=month.year, month=month.month,
+                expected_amount=expected, actual_amount=cash_balances.get(month),
+            )
+            snapshots.append(snapshot)
+            carried = snapshot.carried_amount
+
+        try:
+            with transaction.atomic():
+                self.bulk_create(snapshots)
+        except IntegrityError:
+            # the snapshots were computed concurrently by a backend without row locks
+            pass
+
+        return snapshots[-1]
+
+
+class CashBalanceSnapshot(MonthlyBalance):
     """
-    The part time payroll costs for a month.
+    The expected cash balance of a business unit for a month. Snapshots are computed
+    on demand and deleted from the earliest affected month whenever an invoice, a
+    contract's state or a monthly balance changes.
     """
+    objects = CashBalanceSnapshotQuerySet.as_manager()
+
+    @property
+    def carried_amount(self):
+        # preference actual cash balance over expected
+        return self.actual_amount or self.expected_amount
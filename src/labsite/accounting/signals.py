@@ -0,0 +1,101 @@
+from django.db.models import Min
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .models import (
+    CashBalance, CashBalanceSnapshot, Contract, Expenses, Invoice,
+    PermanentPayroll, TemporaryPayroll,
+)
+from .utils import Month
+
+
+# The fields that the cash balance snapshots are computed from. The business unit is
+# listed first and is followed by the fields that determine the month.
+SNAPSHOT_FIELDS = {
+    Invoice: ['business_unit', 'expected_payment_date', 'contract', 'expected_amount'],
+    Expenses: ['business_unit', 'year', 'month', 'expected_amount'],
+    PermanentPayroll: ['business_unit', 'year', 'month', 'expected_amount'],
+    TemporaryPayroll: ['business_unit', 'year', 'month', 'expected_amount'],
+    CashBalance: ['business_unit', 'year', 'month', 'actual_amount'],
+}
+
+
+def get_snapshot_values(instance, fields):
+    """
+    Return the instance's values of the fields that contribute to the snapshots, or None
+    if any of them are deferred. Deferred fields are not loaded from the database.
+    """
+    values = []
+    for name in fields:
+        field = instance._meta.get_field(name)
+        if field.attname not in instance.__dict__:
+            return None
+        values.append(field.to_python(instance.__dict__[field.attname]))
+    return tuple(values)
+
+
+def invalidate_snapshots(sender, *values):
+    """
+    Invalidate the snapshots from the earliest month of each business unit in the values.
+    """
+    starts = {}
+    for business_unit, *rest in values:
+        month = Month(rest[0]) if sender is Invoice else Month(*rest[:2])
+        starts[business_unit] = min(month, starts.get(business_unit, month))
+
+    for business_unit, start in starts.items():
+        CashBalanceSnapshot.objects.invalidate(business_unit, start)
+
+
+@receiver(post_init, sender=Contract)
+def contract_loaded(sender, instance, **kwargs):
+    instance._snapshot_state = instance.__dict__.get('state')
+
+
+@receiver(post_save, sender=Contract)
+def contract_saved(sender, instance, created, **kwargs):
+    original, instance._snapshot_state = instance._snapshot_state, instance.state
+    if created or original == instance.state:
+        return
+
+    # the invoices of new contracts are excluded from the expected balances
+    invoices = Invoice.objects \
+        .filter(contract=instance) \
+        .values_list('business_unit') \
+        .annotate(Min('expected_payment_date'))
+    invalidate_snapshots(Invoice, *invoices)
+
+
+def snapshot_source_loaded(sender, instance, **kwargs):
+    instance._snapshot_values = get_snapshot_values(instance, SNAPSHOT_FIELDS[sender])
+
+
+def snapshot_source_saved(sender, instance, created, update_fields, **kwargs):
+    fields = SNAPSHOT_FIELDS[sender]
+    if update_fields is not None and not set(update_fields) & set(fields):
+        return
+
+    original = None if created else instance._snapshot_values
+    current = get_snapshot_values(instance, fields)
+    instance._snapshot_values = current
+
+    if current is None or (original is None and not created):
+        # the values are deferred, so the affected months are unknown
+        CashBalanceSnapshot.objects.invalidate(instance.business_unit_id)
+    elif original != current:
+        invalidate_snapshots(sender, *[values for values in (original, current) if values is not None])
+
+
+def snapshot_source_deleted(sender, instance, **kwargs):
+    current = get_snapshot_values(instance, SNAPSHOT_FIELDS[sender])
+
+    if current is None:
+        CashBalanceSnapshot.objects.invalidate(instance.business_unit_id)
+    else:
+        invalidate_snapshots(sender, current)
+
+
+for model in SNAPSHOT_FIELDS:
+    post_init.connect(snapshot_source_loaded, sender=model)
+    post_save.connect(snapshot_source_saved, sender=model)
+    post_delete.connect(snapshot_source_deleted, sender=model)
@@ -6,9 +6,7 @@ from decimal import Decimal
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.db.models import Sum
-from django.db.models import Value as V
-from django.db.models.functions import Coalesce
+from django.db.models import Prefetch
 from django.db.transaction import atomic
 from django.http import Http404
 from django.shortcuts import get_object_or_404, redirect
@@ -19,7 +17,8 @@ from django.views.generic import (
 )
 
 from . import forms, models
-from .utils import FiscalCalendar, Month, format_currency
+from .ledger import Ledger
+from .utils import FiscalCalendar, Month, format_currency, get_or_none
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -35,9 +34,13 @@ class AccountingMixin(LoginRequiredMixin):
     """
     success_url_name = None
 
-    @atomic
     def dispatch(self, request, *args, **kwargs):
-        return super(AccountingMixin, self).dispatch(request, *args, **kwargs)
+        # Reads are not wrapped in a transaction. Writes are atomic.
+        if request.method in ('GET', 'HEAD'):
+            return super(AccountingMixin, self).dispatch(request, *args, **kwargs)
+
+        with atomic():
+            return super(AccountingMixin, self).dispatch(request, *args, **kwargs)
 
     def get_fiscal_year(self, calendar_date):
         calendar_year = calendar_date.year
@@ -56,13 +59,18 @@ class AccountingMixin(LoginRequiredMixin):
 
     @cached_property
     def team_role(self):
-        try:
-            return models.UserTeamRole.objects.get(
-                user=self.user,
-                business_unit=self.current_business_unit,
-            )
-        except models.UserTeamRole.DoesNotExist:
+        """
+        The user's role in the current business unit. The business unit is loaded in
+        the same query, so that members don't require a separate lookup.
+        """
+        pk = self.kwargs.get('business_unit', None)
+
+        if pk is None:
             return None
+        return get_or_none(models.UserTeamRole.objects.select_related('business_unit').filter(
+            user=self.user,
+            business_unit=pk,
+        ))
 
     @cached_property
     def is_manager(self):
@@ -85,8 +93,18 @@ class AccountingMixin(LoginRequiredMixin):
 
         if pk is None:
             return None
+
+        # the business unit is loaded with the user's role
+        if self.team_role is not None:
+            return self.team_role.business_unit
         return models.BusinessUnit.objects.get(pk=pk)
 
+    @cached_property
+    def latest_reconcile(self):
+        return models.MonthlyReconcile.objects \
+            .filter(business_unit=self.current_business_unit) \
+            .order_by('-year', '-month').first()
+
     @cached_property
     def fiscal_calendar(self):
         fiscal_year = self.kwargs.get('fiscal_year')
@@ -97,9 +115,7 @@ class AccountingMixin(LoginRequiredMixin):
 
         # try to determine from the last reconcile date
         else:
-            latest = models.MonthlyReconcile.objects \
-                .filter(business_unit=self.current_business_unit) \
-                .order_by('-year', '-month').first()
+            latest = self.latest_reconcile
 
             if latest is not None:
                 latest_date = Month.next(latest).as_date()  # Need to operate on next available month
@@ -123,9 +139,7 @@ class AccountingMixin(LoginRequiredMixin):
         the next month to reconcile, or (if no months have been reconciled yet)
         the first month of this fiscal year.
         """
-        latest = models.MonthlyReconcile.objects \
-            .filter(business_unit=self.current_business_unit) \
-            .order_by('-year', '-month').first()
+        latest = self.latest_reconcile
 
         # get the next month
         if latest is not None:
@@ -188,28 +202,72 @@ class ContractCtxMixin(object):
     """
     Contract context functions to retreive context data
     """
+    # Distinctive pks that are reversed in place of the contract and invoice, and are
+    # then swapped out for format fields. See `get_url_template`.
+    url_placeholders = {
+        'contract': 9090909091,
+        'invoice': 9090909092,
+    }
+
+    def get_contracts(self):
+        """
+        The business unit's contracts, with their invoices prefetched in order.
+        """
+        invoices = models.Invoice.objects.order_by('-expected_invoice_date')
+
+        return models.Contract.objects \
+            .filter(business_unit=self.current_business_unit) \
+            .prefetch_related(Prefetch('invoice_set', queryset=invoices))
+
+    def get_url_template(self, viewname, *names):
+        kwargs = {'business_unit': self.current_business_unit.pk}
+        kwargs.update({name: self.url_placeholders[name] for name in names})
+
+        url = reverse(viewname, kwargs=kwargs).replace('{', '{{').replace('}', '}}')
+        for name in names:
+            url = url.replace(str(self.url_placeholders[name]), '{%s}' % name)
+
+        return url
+
+    @cached_property
+    def url_templates(self):
+        """
+        Reversing URLs is relatively slow, so the contract and invoice URLs are
+        reversed once and then formatted for each contract and invoice.
+        """
+        return {
+            'update_contract': self.get_url_template('accounting:update_contract', 'contract'),
+            'create_invoice': self.get_url_template('accounting:create_invoice', 'contract'),
+            'contract_detail': self.get_url_template('accounting:contract_detail', 'contract'),
+            'delete_invoice': self.get_url_template('accounting:delete_invoice', 'contract', 'invoice'),
+            'update_invoice': self.get_url_template('accounting:update_invoice', 'contract', 'invoice'),
+            'print_invoice': self.get_url_template('accounting:print_invoice', 'contract', 'invoice'),
+        }
 
     def make_contract_context(self, contract):
+        # the invoices are expected to be prefetched by `get_contracts`
+        invoices = contract.invoice_set.all()
         url_kwargs = self.contract_url_kwargs(contract)
+        urls = self.url_templates
 
         return {
             'contract': contract,
-            'invoices': [
-                self.make_invoice_context(invoice) for invoice
-                in models.Invoice.objects.filter(contract=contract).order_by('-expected_invoice_date')
-            ],
-            'update_url': reverse('accounting:update_contract', kwargs=url_kwargs),
-            'invoice_url': reverse('accounting:create_invoice', kwargs=url_kwargs),
-            'detail_url': reverse('accounting:contract_detail', kwargs=url_kwargs),
+            'outstanding_amount': contract.outstanding_amount(),
+            'invoices': [self.make_invoice_context(invoice) for invoice in invoices],
+            'update_url': urls['update_contract'].format(**url_kwargs),
+            'invoice_url': urls['create_invoice'].format(**url_kwargs),
+            'detail_url': urls['contract_detail'].format(**url_kwargs),
         }
 
     def make_invoice_context(self, invoice):
         url_kwargs = self.invoice_url_kwargs(invoice)
+        urls = self.url_templates
+
         return {
             'invoice': invoice,
-            'delete_url': reverse('accounting:delete_invoice', kwargs=url_kwargs),
-            'update_url': reverse('accounting:update_invoice', kwargs=url_kwargs),
-            'print_url': reverse('accounting:print_invoice', kwargs=url_kwargs),
+            'delete_url': urls['delete_invoice'].format(**url_kwargs),
+            'update_url': urls['update_invoice'].format(**url_kwargs),
+            'print_url': urls['print_invoice'].format(**url_kwargs),
         }
 
     def contract_url_kwargs(self, contract):
@@ -219,10 +277,11 @@ class ContractCtxMixin(object):
         }
 
     def invoice_url_kwargs(self, invoice):
-        kwargs = self.contract_url_kwargs(invoice.contract)
-        kwargs['invoice'] = invoice.pk
-
-        return kwargs
+        return {
+            'business_unit': self.current_business_unit.pk,
+            'contract': invoice.contract_id,
+            'invoice': invoice.pk,
+        }
 
     def activate(self, contract):
         if not contract.has_invoice():
@@ -270,79 +329,16 @@ class HomePageView(ViewerMixin, TemplateView):
 class DashboardView(ViewerMixin, TemplateView):
     template_name = 'accounting/dashboard.html'
 
-    def get_expected_monthly_invoices(self, date):
-        # Although this call looks similar to the other queries, there may be multiple
-        # invoices per month while the other models are an aggregate monthly balance.
-        return models.Invoice.objects \
-            .exclude(contract__state=models.Contract.STATES.NEW) \
-            .filter(business_unit=self.current_business_unit) \
-            .filter(expected_payment_date__year=date.year, expected_payment_date__month=date.month) \
-            .aggregate(v=Coalesce(Sum('expected_amount'), V(0)))['v']
-
-    def get_actual_monthly_invoices(self, date):
-        # Although this call looks similar to the other queries, there may be multiple
-        # invoices per month while the other models are an aggregate monthly balance.
-        return models.Invoice.objects \
-            .exclude(contract__state=models.Contract.STATES.NEW) \
-            .filter(business_unit=self.current_business_unit) \
-            .filter(actual_payment_date__year=date.year, actual_payment_date__month=date.month) \
-            .aggregate(v=Coalesce(Sum('actual_amount'), V(0)))['v']
-
-    def get_monthly_invoices(self, date):
-        return {
-            'expected_amount': self.get_expected_monthly_invoices(date),
-            'actual_amount': self.get_actual_monthly_invoices(date),
-        }
-
-    def get_monthly_instance(self, model, date):
-        try:
-            return model.objects \
-                .filter(business_unit=self.current_business_unit) \
-                .filter(year=date.year, month=date.month).get()
-        except model.DoesNotExist:
-            return model(
-                business_unit=self.current_business_unit,
-                year=date.year, month=date.month)
-
-    def get_invoice_groups(self, date):
-        return models.Invoice.objects \
-            .exclude(contract__state=models.Contract.STATES.NEW) \
-            .filter(business_unit=self.current_business_unit) \
-            .filter(expected_payment_date__year=date.year, expected_payment_date__month=date.month)
-
-    def get_balances(self):
-        # get instances
-        invoices = [self.get_monthly_invoices(month) for month in self.fiscal_months]  # already in dict form
-        expenses = [self.get_monthly_instance(models.Expenses, month) for month in self.fiscal_months]
-        perm_payroll = [self.get_monthly_instance(models.PermanentPayroll, month) for month in self.fiscal_months]
-        temp_payroll = [self.get_monthly_instance(models.TemporaryPayroll, month) for month in self.fiscal_months]
-        cash_balance = [self.get_monthly_instance(models.CashBalance, month) for month in self.fiscal_months]
-
-        # avoid executing duplicate query for expected cash balance calculation.
-        for i, _ in enumerate(self.fiscal_months):
-            cash_balance[i].expenses = expenses[i]
-            cash_balance[i].permanent_payroll = perm_payroll[i]
-            cash_balance[i].temporary_payroll = temp_payroll[i]
-
-            if i > 0:
-                cash_balance[i].previous_cashbalance = cash_balance[i - 1]
-
-        # create dictionaries
-        return OrderedDict([
-            ('Invoices', invoices),
-            ('Expenses', expenses),
-            ('Permanent Payroll', perm_payroll),
-            ('Temporary Payroll', temp_payroll),
-            ('Cash Balance', cash_balance),
-        ])
+    @cached_property
+    def ledger(self):
+        return Ledger(self.current_business_unit, self.fiscal_months)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        invoice_groups = [self.get_invoice_groups(month) for month in self.fiscal_months]
-        balances = self.get_balances()
+        balances = self.ledger.balances
         cash_balances = balances['Cash Balance']
-        invoice_groups_and_totals = list(zip(invoice_groups, balances['Invoices']))
+        invoice_groups_and_totals = list(zip(self.ledger.invoice_groups, balances['Invoices']))
 
         next_kwargs = {'business_unit': self.current_business_unit.pk, 'fiscal_year': self.fiscal_year + 1}
         prev_kwargs = {'business_unit': self.current_business_unit.pk, 'fiscal_year': self.fiscal_year - 1}
@@ -370,25 +366,19 @@ class ContractsView(ViewerMixin, ContractCtxMixin, TemplateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        contracts = models.Contract.objects \
-            .filter(business_unit=self.current_business_unit) \
-            .order_by('-start_date')
+        contracts = self.get_contracts().order_by('-start_date')
 
+        # group the contracts by state
         STATES = models.Contract.STATES
+        groups = OrderedDict((state, []) for state in STATES.keys())
+        for contract in contracts:
+            groups[contract.state].append(self.make_contract_context(contract))
+
         context.update({
-            'has_contracts': contracts.exists(),
-            'new_contracts': [
-                self.make_contract_context(contract) for contract
-                in contracts.filter(state=STATES.NEW)
-            ],
-            'active_contracts': [
-                self.make_contract_context(contract) for contract
-                in contracts.filter(state=STATES.ACTIVE)
-            ],
-            'completed_contracts': [
-                self.make_contract_context(contract) for contract
-                in contracts.filter(state=STATES.COMPLETE)
-            ],
+            'has_contracts': bool(contracts),
+            'new_contracts': groups[STATES.NEW],
+            'active_contracts': groups[STATES.ACTIVE],
+            'completed_contracts': groups[STATES.COMPLETE],
         })
 
         return context
@@ -453,28 +443,11 @@ class ProspectsView(ViewerMixin, TemplateView):
         messages.success(self.request, "Prospect '%s' was successfully deleted." % prospect.name)
         prospect.delete()
 
-    def get_monthly_instance(self, model, date):
-        try:
-            return model.objects \
-                .filter(business_unit=self.current_business_unit) \
-                .filter(year=date.year, month=date.month).get()
-        except model.DoesNotExist:
-            return model(
-                business_unit=self.current_business_unit,
-                year=date.year, month=date.month
-            )
-
     @property
     def ending_fiscal_month_balance(self):
-        latest_cashbalance = models.CashBalance.objects.first()
-        first_month = Month(latest_cashbalance)
-        months = Month.range(first_month, Month.next(self.fiscal_months[-1]))
-        cash_balances = [self.get_monthly_instance(models.CashBalance, month) for month in months]
-        for i, _ in enumerate(months):
-            if i > 0:
-                cash_balances[i].previous_cashbalance = cash_balances[i - 1]
-                # print(self.get_monthly_instance(models.CashBalance, months[i - 1]).expected_amount)
-        return cash_balances[-1].expected_amount
+        return models.CashBalanceSnapshot.objects.get_expected_amount(
+            self.current_business_unit, self.fiscal_months[-1],
+        )
 
     @property
     def projected_eofy_balance(self):
@@ -545,7 +518,7 @@ class MonthlyReconcileView(ViewerMixin, FormView):
 
         month = self.current_billing_month
         data = {'month': month.month, 'year': month.year, 'business_unit': self.current_business_unit.pk}
-        reconcile_form = forms.MonthlyReconcileForm(dirty=form.has_changed(), data=data)
+        reconcile_form = forms.MonthlyReconcileForm(dirty=form.has_changed(), data=data, balances=form.balances)
 
         if reconcile_form.is_valid():
             reconcile_form.save()
@@ -660,7 +633,7 @@ class ContractDetailView(ContractMixin, ContractCtxMixin, TemplateView):
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        contract = models.Contract.objects.get(business_unit=self.current_business_unit, pk=self.kwargs['contract'])
+        contract = self.get_contracts().get(pk=self.kwargs['contract'])
         contract_ctx = self.make_contract_context(contract)
         context['contract_ctx'] = contract_ctx
         return context
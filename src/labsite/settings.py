@@ -244,7 +244,6 @@ REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ('rest_framework_filters.backends.DjangoFilterBackend',),
     'DEFAULT_AUTHENTICATION_CLASSES': ('rest_framework.authentication.SessionAuthentication',),
     'DEFAULT_PERMISSION_CLASSES': ('rest_framework.permissions.IsAuthenticated',),
-    'PAGINATE_BY': None,
 }
 
 
@@ -259,6 +258,26 @@ WORKLOG_SEND_REMINDERS = env('WORKLOG_SEND_REMINDERS')
 
 WORKLOG_EMAIL_REMINDERS_EXPIRE_AFTER = 4
 
+# Number of reminder emails handed to the mail backend at a time
+WORKLOG_EMAIL_REMINDERS_BATCH_SIZE = 100
+
+# Upper bound (in seconds) on how long cached worklog lookups may be stale
+WORKLOG_CACHE_TIMEOUT = 60 * 60
+
+# Number of users whose available jobs are kept in each process
+WORKLOG_JOB_ACCESS_CACHE_SIZE = 256
+
+# Number of seconds after which an invoice run that is still in progress is assumed lost
+WORKLOG_INVOICE_RUN_TIMEOUT = 60 * 60
+
+# Default and maximum number of rows per page in the worklog API
+WORKLOG_API_PAGE_SIZE = 100
+WORKLOG_API_MAX_PAGE_SIZE = 1000
+
+# Number of seconds of changes before a sync token that the change feed lists again, to
+# catch changes committed after the token was read
+WORKLOG_CHANGE_FEED_WINDOW = 5 * 60
+
 # Foodapp
 FOODAPP_SEND_INVOICE_REMINDERS = env('FOODAPP_SEND_INVOICE_REMINDERS')
 
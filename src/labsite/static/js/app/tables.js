@@ -90,8 +90,10 @@ function WorkItemDisplayTable(rowTemplate) {
 
     $.when(
         $.getJSON('/worklog/api/workitems/?date=' + worklog.date + '&user=' + worklog.userid, null, function (data) {
-            for (var i = 0; i < data.length; i++) {
-                var wi = new WorkItem(data[i]);
+            // a single day's items fit on the first page
+            var results = data.results;
+            for (var i = 0; i < results.length; i++) {
+                var wi = new WorkItem(results[i]);
                 table.addWorkItem(wi);
                 workItems[wi.id] = wi;
             }
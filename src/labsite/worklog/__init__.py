@@ -0,0 +1 @@
+default_app_config = 'labsite.worklog.apps.WorklogConfig'
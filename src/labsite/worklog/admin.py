@@ -1,22 +1,26 @@
 import csv
-import io
-from collections import Counter
 from datetime import date
-from operator import attrgetter
+from itertools import groupby
+from operator import itemgetter
 from zipfile import ZipFile
 
 from django import forms
 from django.contrib import admin, messages
 from django.contrib.admin import SimpleListFilter, helpers
-from django.db.models import Q, Sum
-from django.http import HttpResponse
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.http import StreamingHttpResponse
 from django.template.response import TemplateResponse
 from django.utils.translation import ugettext_lazy as _
 from rangefilter.filter import DateRangeFilter
 
+from . import signals
 from .models import (
-    BillingSchedule, Employee, Funding, Holiday, Job, WorkItem, WorkPeriod,
+    BillingSchedule, Change, ChangeCounter, Employee, Funding, Holiday,
+    InvoiceRun, Job, JobSummary, UserDayHours, WorkItem, WorkPeriod,
 )
+from .utils import Echo, StreamBuffer
 
 
 class RelatedFieldListFilter(admin.RelatedFieldListFilter):
@@ -93,46 +97,80 @@ class WorkItemAdmin(admin.ModelAdmin):
         ('user', InactiveUserFilter),
     )
     actions = ['mark_invoiced', 'mark_not_invoiced', 'archive', 'reassign']
+    # bytes of the invoice zip to buffer before sending
+    archive_chunk_size = 64 * 1024
+    # number of archived items to mark as invoiced per update
+    invoice_batch_size = 500
     # sort the items by time in descending order
     ordering = ['-date']
+    # the fields filtered on that are also on the user day hours rollup
+    rollup_filter_paths = ('user', 'date', 'job')
+
+    def set_invoiced(self, queryset, invoiced):
+        # The changelist may filter on `invoiced`, so the rows are collected before the
+        # update empties the queryset, and only those rows are updated.
+        with transaction.atomic():
+            rows = list(queryset.exclude(invoiced=invoiced).values_list('pk', 'job_id', 'hours'))
+            WorkItem.objects.filter(pk__in=[row[0] for row in rows]).update(invoiced=invoiced)
+            JobSummary.objects.set_invoiced([row[1:] for row in rows], invoiced)
 
     def mark_invoiced(self, request, queryset):
-        queryset.update(invoiced=True)
+        self.set_invoiced(queryset, True)
     mark_invoiced.short_description = "Mark selected items as invoiced"
 
     def mark_not_invoiced(self, request, queryset):
-        queryset.update(invoiced=False)
+        self.set_invoiced(queryset, False)
     mark_not_invoiced.short_description = "Mark selected items as not invoiced"
 
-    def create_invoice(self, job, queryset):
+    def get_invoice_names(self, queryset):
         """
-        Generate a CSV name and file for the workitems in the queryset
+        Return a mapping of job ids to invoice file names. Each invoice is named after its
+        job and the month containing most of its items (the earliest month on a tie).
         """
-        labels, getters = zip(*[
-            # Title, function on item returning value
-            ('Date', attrgetter('date')),
-            ('Hours', attrgetter('hours')),
-            ('Task', attrgetter('text')),
-        ])
+        months = queryset \
+            .order_by() \
+            .annotate(month=TruncMonth('date')) \
+            .values_list('job_id', 'job__name', 'month') \
+            .annotate(count=Count('pk'))
+
+        names = {}
+        for job_id, job_name, month, count in sorted(months, key=lambda row: (-row[3], row[2])):
+            names.setdefault(job_id, '%s-%s.csv' % (job_name, month.strftime('%Y-%m')))
 
-        csvfile = io.StringIO()
-        writer = csv.writer(csvfile)
-        dates = []
+        return names
 
-        writer.writerow(labels)
-        for item in queryset.filter(job=job):
-            writer.writerow([getter(item) for getter in getters])
+    def stream_invoices(self, queryset):
+        """
+        Yield a zip of invoices for the workitems in the queryset, one CSV per job, as it
+        is written. The items are fetched in a single query. Once the last chunk of the
+        zip has been sent, the items that were written to it are marked as invoiced, so
+        an archive that was not received in full can be requested again.
+        """
+        names = self.get_invoice_names(queryset)
+        items = queryset \
+            .order_by('job__name', 'job_id', 'date', 'pk') \
+            .values_list('job_id', 'date', 'hours', 'text', 'pk') \
+            .iterator()
 
-            # append year-month date for each item
-            dates.append(item.date.strftime('%Y-%m'))
+        stream = StreamBuffer()
+        writer = csv.writer(Echo())
+        pks = []
 
-        # generate the file name
-        name = "%(name)s-%(year_month)s.csv" % {
-            'name': job.name,
-            'year_month': Counter(dates).most_common(1)[0][0]
-        }
+        with ZipFile(stream, 'w') as archive:
+            for job_id, rows in groupby(items, itemgetter(0)):
+                with archive.open(names[job_id], 'w') as invoice:
+                    invoice.write(writer.writerow(['Date', 'Hours', 'Task']).encode())
+                    for row in rows:
+                        invoice.write(writer.writerow(row[1:4]).encode())
+                        pks.append(row[4])
 
-        return name, csvfile.getvalue()
+                        if stream.size >= self.archive_chunk_size:
+                            yield stream.drain()
+
+        yield stream.drain()
+
+        for i in range(0, len(pks), self.invoice_batch_size):
+            self.set_invoiced(WorkItem.objects.filter(pk__in=pks[i:i + self.invoice_batch_size]), True)
 
     def archive(self, request, queryset):
         """
@@ -146,16 +184,9 @@ class WorkItemAdmin(admin.ModelAdmin):
             self.message_user(request, "Cannot invoice items that have already been invoiced.", level=messages.ERROR)
             return
 
-        response = HttpResponse(content_type='application/zip')
+        response = StreamingHttpResponse(self.stream_invoices(queryset), content_type='application/zip')
         response['Content-Disposition'] = 'attachment; filename=invoices-%s.zip' % date.today().isoformat()
 
-        with ZipFile(response, 'w') as archive:
-            for job in Job.objects.filter(workitem__in=queryset).distinct():
-                name, file = self.create_invoice(job, queryset)
-                archive.writestr(name, file)
-
-        queryset.update(invoiced=True)
-
         return response
     archive.short_description = 'Invoice selected items'
 
@@ -187,7 +218,14 @@ class WorkItemAdmin(admin.ModelAdmin):
         if request.POST.get('post'):
             form = Form(data=request.POST)
             form.is_valid()
-            queryset.update(job=form.cleaned_data['job'])
+            job = form.cleaned_data['job']
+            with transaction.atomic():
+                rows = list(queryset.values_list('pk', 'user_id', 'job_id', 'date', 'hours', 'invoiced'))
+                WorkItem.objects.filter(pk__in=[row[0] for row in rows]).update(job=job)
+                ChangeCounter.objects.increment_on_commit(WorkItem)
+                Change.objects.record(WorkItem, Change.ACTIONS.UPDATE, [row[:2] for row in rows])
+                signals.add_work_rows([row[1:] for row in rows], -1)
+                signals.add_work_rows([(user_id, job.pk) + tuple(values) for pk, user_id, _, *values in rows])
 
             return None
 
@@ -208,12 +246,32 @@ class WorkItemAdmin(admin.ModelAdmin):
     invoiceable.admin_order_field = 'job__invoiceable'
     invoiceable.boolean = True
 
+    def get_hours_queryset(self, request, cl):
+        """
+        Return the queryset to total the changelist hours from. When only the user, date
+        and job filters are in use, the `UserDayHours` rollup is filtered instead of the
+        work items.
+        """
+        params = set(cl.get_filters_params())
+        rollup_specs = [
+            spec for spec in cl.filter_specs
+            if getattr(spec, 'field_path', None) and spec.field_path.split('__')[0] in self.rollup_filter_paths
+        ]
+
+        if cl.query or not params <= {param for spec in rollup_specs for param in spec.expected_parameters()}:
+            return cl.get_queryset(request)
+
+        queryset = UserDayHours.objects.all()
+        for spec in rollup_specs:
+            queryset = spec.queryset(request, queryset)
+        return queryset
+
     def changelist_view(self, request, extra_context=None):
         response = super().changelist_view(request, extra_context)
 
         if hasattr(response, 'context_data') and 'cl' in response.context_data:
             cl = response.context_data['cl']
-            hours = cl.get_queryset(request).aggregate(Sum('hours'))
+            hours = self.get_hours_queryset(request, cl).aggregate(Sum('hours'))
             response.context_data.update(hours)
 
         return response
@@ -228,8 +286,12 @@ class FundingInline(admin.StackedInline):
 
 
 class JobAdmin(admin.ModelAdmin):
-    list_display = ('name', 'open_date', 'close_date', 'is_open', 'invoiceable')
+    list_display = (
+        'name', 'open_date', 'close_date', 'is_open', 'invoiceable',
+        'funded_hours', 'worked_hours', 'uninvoiced_hours',
+    )
     list_filter = (OpenJobsFilter,)
+    list_select_related = ('summary',)
     inlines = [
         BillingScheduleInline,
         FundingInline,
@@ -241,6 +303,38 @@ class JobAdmin(admin.ModelAdmin):
     is_open.boolean = True
     is_open.admin_order_field = 'is_open'
 
+    def get_summary_value(self, obj, name):
+        try:
+            return getattr(obj.summary, name)
+        except JobSummary.DoesNotExist:
+            return None
+
+    def funded_hours(self, obj):
+        return self.get_summary_value(obj, 'funded_hours')
+
+    funded_hours.admin_order_field = 'summary__funded_hours'
+
+    def worked_hours(self, obj):
+        return self.get_summary_value(obj, 'worked_hours')
+
+    worked_hours.admin_order_field = 'summary__worked_hours'
+
+    def uninvoiced_hours(self, obj):
+        return self.get_summary_value(obj, 'uninvoiced_hours')
+
+    uninvoiced_hours.admin_order_field = 'summary__uninvoiced_hours'
+
+
+class InvoiceRunAdmin(admin.ModelAdmin):
+    list_display = ('date', 'state', 'invoiced', 'created',)
+    list_filter = ('state',)
+    actions = ['mark_failed']
+
+    def mark_failed(self, request, queryset):
+        # a run that is stuck in progress blocks its date from being invoiced again
+        queryset.filter(active=True).fail()
+    mark_failed.short_description = "Mark selected runs as failed"
+
 
 class WorkPeriodAdmin(admin.ModelAdmin):
     list_display = ('payroll_id', 'start_date', 'end_date',)
@@ -258,3 +352,4 @@ admin.site.register(Job, JobAdmin)
 admin.site.register(Employee)
 admin.site.register(WorkPeriod, WorkPeriodAdmin)
 admin.site.register(Holiday, HolidayAdmin)
+admin.site.register(InvoiceRun, InvoiceRunAdmin)
@@ -14,7 +14,7 @@ class WorkDayFilter(filters.FilterSet):
 
 
 class WorkItemFilter(filters.FilterSet):
-    username = filters.CharFilter(name='user__username', lookup_type='exact')
+    username = filters.CharFilter(name='user__username', lookup_expr='exact')
 
     class Meta:
         model = models.WorkItem
@@ -0,0 +1,16 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class PKCursorPagination(CursorPagination):
+    """
+    Paginates by primary key, so that pages remain stable as new rows are inserted.
+    Clients may request smaller or larger pages with `page_size`, up to the
+    `WORKLOG_API_MAX_PAGE_SIZE` setting.
+    """
+    ordering = 'pk'
+    page_size_query_param = 'page_size'
+
+    def __init__(self):
+        self.page_size = settings.WORKLOG_API_PAGE_SIZE
+        self.max_page_size = settings.WORKLOG_API_MAX_PAGE_SIZE
@@ -0,0 +1,33 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+from ..utils import stream_csv
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    Selects the CSV format for views that stream their own response. Any other
+    response data (e.g. errors) is rendered as a single row.
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, dict):
+            data = {'detail': data}
+        return ''.join(stream_csv(list(data), [list(data.values())]))
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Selects the newline delimited JSON format for views that stream their own response.
+    Any other response data (e.g. errors) is rendered as a single line.
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data) + '\n'
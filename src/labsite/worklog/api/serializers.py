@@ -1,27 +1,142 @@
 import datetime
+from collections import OrderedDict
 
 from django.contrib.auth.models import User
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
 from rest_framework import serializers
 
 from ..models import Job, WorkDay, WorkItem
 
 
-class UserSerializer(serializers.ModelSerializer):
+def _pk(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class WorkItemBatch(object):
+    """
+    Preloads the users and jobs referenced by a list of work item data, so that the
+    whole batch can be validated with a fixed number of queries.
+    """
+
+    def __init__(self, data):
+        items = [item for item in data if isinstance(item, dict)]
+        user_ids = {_pk(item.get('user')) for item in items} - {None}
+        job_ids = {_pk(item.get('job')) for item in items} - {None}
+
+        self.users = User.objects.in_bulk(user_ids)
+        # the default manager annotates whether the job is open today
+        self.jobs = Job.objects.in_bulk(job_ids)
+        self.access = set(Job.users.through.objects
+                          .filter(user_id__in=user_ids, job_id__in=job_ids)
+                          .values_list('user_id', 'job_id'))
+
+    def is_open(self, job):
+        return self.jobs[job.pk].is_open
+
+    def is_available(self, user, job):
+        return user.is_superuser or job.available_all_users or (user.pk, job.pk) in self.access
+
+
+class BatchRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Resolves related instances from the `WorkItemBatch` in the serializer context,
+    falling back to a regular queryset lookup.
+    """
+
+    def __init__(self, batch_attr, **kwargs):
+        self.batch_attr = batch_attr
+        super(BatchRelatedField, self).__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        batch = self.context.get('batch')
+        if batch is None:
+            return super(BatchRelatedField, self).to_internal_value(data)
+
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+        pk = _pk(data)
+        if pk is None:
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+        try:
+            return getattr(batch, self.batch_attr)[pk]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+
+
+class SparseFieldsetMixin(object):
+    """
+    Restricts the serialized fields to the names in the `fields` context entry.
+    Unknown names are ignored. If no names are given, all fields are serialized.
+    """
+
+    def get_fields(self):
+        fields = super(SparseFieldsetMixin, self).get_fields()
+        requested = self.context.get('fields')
+        if not requested:
+            return fields
+
+        return OrderedDict((name, field) for name, field in fields.items() if name in requested)
+
+
+def get_field_lookups(model, serializer_fields):
+    """
+    Return the `select_related()` and `only()` lookups needed to serialize the given
+    fields from instances of `model`. The `only()` lookups are `None` if any field is
+    not backed by a concrete model field (e.g. a method, property or reverse relation).
+    """
+    related, columns = set(), {model._meta.pk.name}
+
+    for field in serializer_fields:
+        path = field.source_attrs
+        current = model
+
+        for i, attr in enumerate(path):
+            try:
+                model_field = current._meta.get_field(attr)
+            except FieldDoesNotExist:
+                model_field = None
+
+            if model_field is None or not model_field.concrete or model_field.many_to_many:
+                columns = None
+                break
+
+            lookup = '__'.join(path[:i + 1])
+            if columns is not None:
+                columns.add(lookup)
+
+            if i < len(path) - 1:
+                if not model_field.is_relation:
+                    columns = None
+                    break
+                related.add(lookup)
+                current = model_field.related_model
+
+        if not path:  # source='*'
+            columns = None
+
+    return related, columns
+
+
+class UserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
 
     class Meta:
         model = User
         fields = ['id', 'username', 'email']
 
 
-class JobSerializer(serializers.ModelSerializer):
+class JobSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Job
         fields = ['id', 'name']
 
 
-class WorkDaySerializer(serializers.ModelSerializer):
+class WorkDaySerializer(SparseFieldsetMixin, serializers.ModelSerializer):
 
     class Meta:
         model = WorkDay
@@ -37,7 +152,9 @@ class WorkDaySerializer(serializers.ModelSerializer):
         return attrs
 
 
-class WorkItemSerializer(serializers.ModelSerializer):
+class WorkItemSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    user = BatchRelatedField('users', queryset=User.objects.all())
+    job = BatchRelatedField('jobs', queryset=Job.objects.all())
 
     class Meta:
         model = WorkItem
@@ -48,6 +165,12 @@ class WorkItemSerializer(serializers.ModelSerializer):
         if value is None:
             raise serializers.ValidationError("This field is required.")
 
+        batch = self.context.get('batch')
+        if batch is not None:
+            if not batch.is_open(value):
+                raise serializers.ValidationError("Job must be open.")
+            return value
+
         open_jobs = Job.objects.open_on(datetime.date.today())
 
         try:
@@ -89,7 +212,13 @@ class WorkItemSerializer(serializers.ModelSerializer):
         user = data['user']
         job = data['job']
 
-        if (not Job.objects.available_to(user).filter(name=job.name).exists()):
+        batch = self.context.get('batch')
+        if batch is not None:
+            available = batch.is_available(user, job)
+        else:
+            available = job.pk in Job.objects.accessible_ids(user)
+
+        if not available:
             raise serializers.ValidationError("Job not available to user.")
 
         return data
@@ -1,29 +1,252 @@
+import datetime
+import hashlib
+import math
+import time
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from rest_framework import viewsets
+from django.db import transaction
+from django.db.models import Count, Max
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import status, viewsets
+from rest_framework.decorators import list_route
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from . import filters, pagination, renderers, serializers
+from .. import caches, models, signals, utils
+
+
+class SparseFieldsetViewMixin(object):
+    """
+    Supports a `fields` query parameter on reads, a comma separated list of the fields
+    to return. The queryset is restricted to the columns those fields need, and any
+    related models they traverse are fetched in the same query.
+    """
+
+    def get_requested_fields(self):
+        if self.request is None or self.request.method not in SAFE_METHODS:
+            return None
+
+        value = self.request.query_params.get('fields')
+        if not value:
+            return None
+
+        return {name.strip() for name in value.split(',')} - {''}
+
+    def get_serializer_context(self):
+        context = super(SparseFieldsetViewMixin, self).get_serializer_context()
+        context['fields'] = self.get_requested_fields()
+        return context
+
+    def get_queryset(self):
+        queryset = super(SparseFieldsetViewMixin, self).get_queryset()
+        fields = self.get_serializer().fields.values()
+        related, columns = serializers.get_field_lookups(queryset.model, fields)
+
+        if related:
+            queryset = queryset.select_related(*related)
+        if columns and self.get_requested_fields():
+            queryset = queryset.only(*columns)
+
+        return queryset
+
 
-from . import filters, serializers
-from .. import models
+class ConditionalListMixin(object):
+    """
+    Validates list responses with an ETag and Last-Modified date, so that polling
+    clients receive a 304 response without the rows being fetched or serialized.
 
+    The validators are computed from the table's `ChangeCounter` and the max pk and
+    count of the filtered queryset. Last-Modified only has a resolution of a second, so
+    it is omitted until the second of the latest change has passed.
+    """
 
-class UserViewSet(viewsets.ReadOnlyModelViewSet):
+    def get_list_validators(self, queryset):
+        counter = models.ChangeCounter.objects.for_model(queryset.model)
+        summary = queryset.order_by().aggregate(max_pk=Max('pk'), count=Count('pk'))
+
+        key = '%s:%s:%s:%s:%s' % (
+            self.request.get_full_path(), self.request.accepted_renderer.format,
+            counter.version, summary['max_pk'], summary['count'],
+        )
+        etag = quote_etag(hashlib.md5(key.encode()).hexdigest())
+        last_modified = None
+        if counter.modified is not None:
+            last_modified = math.ceil(counter.modified.timestamp())
+            if last_modified > time.time():
+                last_modified = None
+
+        return etag, last_modified
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        etag, last_modified = self.get_list_validators(queryset)
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+
+        response = super(ConditionalListMixin, self).list(request, *args, **kwargs)
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+
+        return response
+
+
+class UserViewSet(SparseFieldsetViewMixin, viewsets.ReadOnlyModelViewSet):
     queryset = User.objects.all().order_by('pk')
     serializer_class = serializers.UserSerializer
     # filter_class = there is no user filter class yet
 
 
-class WorkDayViewSet(viewsets.ModelViewSet):
+class WorkDayViewSet(ConditionalListMixin, SparseFieldsetViewMixin, viewsets.ModelViewSet):
     queryset = models.WorkDay.objects.all().order_by('pk')
     serializer_class = serializers.WorkDaySerializer
     filter_class = filters.WorkDayFilter
 
 
-class WorkItemViewSet(viewsets.ModelViewSet):
+class WorkItemViewSet(ConditionalListMixin, SparseFieldsetViewMixin, viewsets.ModelViewSet):
     queryset = models.WorkItem.objects.all().order_by('pk')
     serializer_class = serializers.WorkItemSerializer
     filter_class = filters.WorkItemFilter
+    pagination_class = pagination.PKCursorPagination
+
+    @list_route(methods=['post'])
+    def bulk(self, request, *args, **kwargs):
+        """
+        Create a list of work items in one transaction. By default, no items are created
+        if any item is invalid. Pass `?skip_invalid=true` to create the valid items and
+        return the errors for the rest.
+        """
+        if not isinstance(request.data, list):
+            return Response({'non_field_errors': ["Expected a list of items."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        context = self.get_serializer_context()
+        context['batch'] = serializers.WorkItemBatch(request.data)
+
+        items = [self.get_serializer_class()(data=data, context=context) for data in request.data]
+        errors = [{} if item.is_valid() else item.errors for item in items]
+        skip_invalid = request.query_params.get('skip_invalid') in ('1', 'true')
 
+        if any(errors) and not skip_invalid:
+            return Response(errors, status=status.HTTP_400_BAD_REQUEST)
 
-class JobViewSet(viewsets.ReadOnlyModelViewSet):
+        with transaction.atomic():
+            created = models.WorkItem.objects.insert(
+                models.WorkItem(**item.validated_data) for item, error in zip(items, errors) if not error
+            )
+
+            # insert() does not send post_save signals
+            models.ChangeCounter.objects.increment_on_commit(models.WorkItem)
+            models.Change.objects.record(
+                models.WorkItem, models.Change.ACTIONS.CREATE, [(item.pk, item.user_id) for item in created]
+            )
+            signals.add_created_work(created)
+
+        caches.update_month_index([item.date for item in created])
+
+        data = self.get_serializer(created, many=True).data
+        if skip_invalid:
+            data = {'created': data, 'errors': errors}
+
+        return Response(data, status=status.HTTP_201_CREATED)
+
+    @list_route(renderer_classes=[renderers.CSVRenderer, renderers.NDJSONRenderer])
+    def export(self, request, *args, **kwargs):
+        """
+        Stream the filtered work items as CSV (`export.csv`, the default) or newline
+        delimited JSON (`export.ndjson`). The export is not paginated.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        renderer = request.accepted_renderer
+
+        response = StreamingHttpResponse(
+            utils.export_workitems(queryset, renderer.format),
+            content_type='%s; charset=%s' % (renderer.media_type, renderer.charset),
+        )
+        response['Content-Disposition'] = 'attachment; filename=workitems-%s.%s' % (
+            datetime.date.today().isoformat(), renderer.format,
+        )
+
+        return response
+
+
+class JobViewSet(ConditionalListMixin, SparseFieldsetViewMixin, viewsets.ReadOnlyModelViewSet):
     queryset = models.Job.objects.all().order_by('pk')
     serializer_class = serializers.JobSerializer
     filter_class = filters.JobFilter
+
+
+class ChangeFeedView(APIView):
+    """
+    The work items and work days changed since a sync token, so that clients can
+    mirror the worklog without re-fetching it. Pass `?since=<token>` with the `next`
+    token of the previous response, and optionally `?user=<pk>`. Without a token, only
+    the current token is returned; take it before the initial full fetch.
+
+    Each object is listed once, in its current state, however often it changed. Deleted
+    objects are listed by pk. If `more` is true, request the next token straight away.
+
+    A change is numbered when it is made, not when its transaction commits, so it may
+    appear after a later change was synced. The changes made within
+    `WORKLOG_CHANGE_FEED_WINDOW` seconds before the token are therefore listed again,
+    and clients should expect to re-apply them. Changes in transactions that run for
+    longer than that may still be missed.
+    """
+    feeds = [
+        ('workitems', models.WorkItem, serializers.WorkItemSerializer),
+        ('workdays', models.WorkDay, serializers.WorkDaySerializer),
+    ]
+
+    def get(self, request, *args, **kwargs):
+        changes = models.Change.objects.all()
+        since = request.query_params.get('since')
+
+        user = request.query_params.get('user')
+        if user:
+            if not user.isdigit():
+                return Response({'user': ["A valid user pk is required."]}, status=status.HTTP_400_BAD_REQUEST)
+            changes = changes.filter(user_id=user)
+
+        if since is None:
+            latest = changes.order_by('-seq').values_list('seq', flat=True).first()
+            return Response({'next': str(latest or 0)})
+
+        try:
+            since = int(since)
+            if since < 0:
+                raise ValueError
+        except ValueError:
+            return Response({'since': ["A valid sync token is required."]}, status=status.HTTP_400_BAD_REQUEST)
+
+        limit = settings.WORKLOG_API_MAX_PAGE_SIZE
+        columns = ('seq', 'model', 'object_id', 'action')
+        page = list(changes.since(since).values_list(*columns)[:limit + 1])
+        more = len(page) > limit
+        page = page[:limit]
+        recent = list(changes.recent(since).values_list(*columns)[:limit])
+
+        # the last action on each object wins
+        actions = {(model, object_id): action for seq, model, object_id, action in recent[::-1] + page}
+
+        data = {'next': str(page[-1][0] if page else since), 'more': more, 'deleted': {}}
+        for name, model, serializer_class in self.feeds:
+            model_name = model._meta.model_name
+            changed = {pk for (kind, pk), action in actions.items()
+                       if kind == model_name and action != models.Change.ACTIONS.DELETE}
+            deleted = {pk for (kind, pk), action in actions.items()
+                       if kind == model_name and action == models.Change.ACTIONS.DELETE}
+
+            instances = list(model.objects.filter(pk__in=changed).order_by('pk')) if changed else []
+            # an object deleted after this page of changes is listed as deleted
+            deleted |= changed - {instance.pk for instance in instances}
+
+            data[name] = serializer_class(instances, many=True, context={'request': request}).data
+            data['deleted'][name] = sorted(deleted)
+
+        return Response(data)
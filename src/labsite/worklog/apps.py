@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class WorklogConfig(AppConfig):
+    name = 'labsite.worklog'
+    label = 'worklog'
+
+    def ready(self):
+        from . import signals  # noqa: F401
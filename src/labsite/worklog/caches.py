@@ -0,0 +1,192 @@
+"""
+Cached lookups used by the worklog views. Entries are invalidated by the receivers in
+`worklog.signals`, and additionally expire after `WORKLOG_CACHE_TIMEOUT` seconds, so
+that processes which do not share a cache backend eventually agree. Authorization, such
+as the jobs available to a user, is instead keyed on a version stored in the database.
+"""
+import datetime
+from bisect import bisect_right
+from functools import lru_cache
+from uuid import uuid4
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+
+from .models import ChangeCounter, Holiday, Job, WorkItem
+
+
+MONTH_INDEX_KEY = 'worklog:month-index'
+USER_MENU_KEY = 'worklog:user-menu'
+JOB_MENU_KEY = 'worklog:job-menu'
+JOB_ACCESS_KEY = 'worklog:job-access:%s:%d:%d'
+HOLIDAY_VERSION_KEY = 'worklog:holiday-version'
+
+
+def get_month_index():
+    """
+    Returns the first day of each month that has work items, most recent first.
+    """
+    months = cache.get(MONTH_INDEX_KEY)
+
+    if months is None:
+        months = list(WorkItem.objects.dates('date', 'month', order='DESC'))
+        cache.set(MONTH_INDEX_KEY, months, settings.WORKLOG_CACHE_TIMEOUT)
+
+    return months
+
+
+def update_month_index(dates):
+    """
+    Invalidates the month index if any of the dates fall in a month that is not yet
+    indexed. The index is rebuilt on the next lookup.
+    """
+    months = cache.get(MONTH_INDEX_KEY)
+
+    if months is not None and not {date.replace(day=1) for date in dates} <= set(months):
+        cache.delete(MONTH_INDEX_KEY)
+
+
+def clear_month_index():
+    cache.delete(MONTH_INDEX_KEY)
+
+
+def get_user_menu():
+    """
+    Returns a list of (pk, username) pairs for all users.
+    """
+    users = cache.get(USER_MENU_KEY)
+
+    if users is None:
+        users = list(get_user_model().objects.values_list('pk', 'username'))
+        cache.set(USER_MENU_KEY, users, settings.WORKLOG_CACHE_TIMEOUT)
+
+    return users
+
+
+def clear_user_menu():
+    cache.delete(USER_MENU_KEY)
+
+
+def get_job_menu():
+    """
+    Returns a list of (pk, name) pairs for all jobs, ordered by name.
+    """
+    jobs = cache.get(JOB_MENU_KEY)
+
+    if jobs is None:
+        jobs = list(Job.objects.values_list('pk', 'name'))
+        cache.set(JOB_MENU_KEY, jobs, settings.WORKLOG_CACHE_TIMEOUT)
+
+    return jobs
+
+
+def clear_job_menu():
+    cache.delete(JOB_MENU_KEY)
+
+
+def get_version(key):
+    """
+    Returns the current version stored under the key, for values that are also kept in
+    process. A new version is started whenever the version expires or is cleared.
+    """
+    version = cache.get(key)
+
+    if version is None:
+        cache.add(key, uuid4().hex, settings.WORKLOG_CACHE_TIMEOUT)
+        # a dummy cache backend never stores the version, so nothing is reused
+        version = cache.get(key) or uuid4().hex
+
+    return version
+
+
+@lru_cache(maxsize=settings.WORKLOG_JOB_ACCESS_CACHE_SIZE)
+def _get_job_access(version, user, is_superuser):
+    key = JOB_ACCESS_KEY % (version, user.pk, is_superuser)
+    job_ids = cache.get(key)
+
+    if job_ids is None:
+        job_ids = frozenset(Job.objects.available_to(user).values_list('pk', flat=True))
+        cache.set(key, job_ids, settings.WORKLOG_CACHE_TIMEOUT)
+
+    return job_ids
+
+
+def get_job_access(user):
+    """
+    Returns a frozenset of the pks of the jobs available to the user. The sets are
+    cached per user, and the most recently used are also kept in process. Both are
+    keyed by the version of the jobs' `ChangeCounter`, which is read from the database
+    on each call and incremented once a change to the jobs or their users commits, so
+    every process sees the change. The counter's modified time is part of the version,
+    as a count may be reused if the transaction that incremented it was rolled back.
+    """
+    counter = ChangeCounter.objects.filter(table=Job._meta.db_table).values_list('version', 'modified').first()
+    version = '%d-%s' % counter if counter else '0'
+    return _get_job_access(version, user, user.is_superuser)
+
+
+class HolidayCalendar(object):
+    """
+    The holidays as sorted, non-overlapping date intervals, so that days can be looked
+    up with a binary search.
+    """
+
+    def __init__(self, ranges):
+        intervals = []
+        for start, end in sorted(ranges):
+            if end < start:
+                continue
+            # merge overlapping and adjacent holidays
+            if intervals and start <= intervals[-1][1] + datetime.timedelta(days=1):
+                intervals[-1][1] = max(intervals[-1][1], end)
+            else:
+                intervals.append([start, end])
+
+        self.starts = [start for start, end in intervals]
+        self.ends = [end for start, end in intervals]
+
+    def is_holiday(self, date):
+        i = bisect_right(self.starts, date) - 1
+        return i >= 0 and date <= self.ends[i]
+
+    def is_business_day(self, date):
+        return date.isoweekday() < 6 and not self.is_holiday(date)
+
+    def business_days(self, start, end):
+        """
+        Returns the weekdays from start to end (inclusive) that are not holidays, in
+        order. The holidays in the range are skipped over in a single pass.
+        """
+        days = []
+        i = max(bisect_right(self.starts, start) - 1, 0)
+        date = start
+
+        while date <= end:
+            while i < len(self.ends) and self.ends[i] < date:
+                i += 1
+            if i < len(self.starts) and self.starts[i] <= date:
+                date = self.ends[i] + datetime.timedelta(days=1)
+                continue
+            if date.isoweekday() < 6:
+                days.append(date)
+            date += datetime.timedelta(days=1)
+
+        return days
+
+
+@lru_cache(maxsize=1)
+def _get_holiday_calendar(version):
+    return HolidayCalendar(Holiday.objects.values_list('start_date', 'end_date'))
+
+
+def get_holiday_calendar():
+    """
+    Returns the `HolidayCalendar`. It is built once per process and rebuilt when the
+    holidays change.
+    """
+    return _get_holiday_calendar(get_version(HOLIDAY_VERSION_KEY))
+
+
+def clear_holiday_calendar():
+    cache.delete(HOLIDAY_VERSION_KEY)
@@ -1,11 +1,100 @@
 import datetime
 import random
+from collections import defaultdict
 
 from django import forms
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, FloatField, Q, Value, When
 from django.forms import ModelForm
 from django.forms.formsets import BaseFormSet
+from django.utils.functional import cached_property
 
-from .models import Job, WorkItem
+from . import caches, signals
+from .models import Change, ChangeCounter, Job, WorkItem
+
+
+INCREMENT_MESSAGES = [
+    "Please, Hammer, don't hurt 'em! Use 15-minute increments.",
+    "All your mantissa are belong to us. 15-minute increments only. Please.",
+    "You thought we wouldn't notice that you didn't use 15-minute increments. You were wrong. Try again, jerk.",
+    "Hey buddy. How's it going? Listen, not a huge deal, but we've got this thing where we use 15-minute increments.",
+    "If you could go ahead and use 15-minute increments, that would be grrrreeaat.",
+]
+
+MISSING_TEXT_MESSAGE = "This is where you describe the work you did, as if you did any."
+
+
+def validate_hours(hours):
+    """
+    Only allows non-zero, non-negative hours to be entered in quarter hour increments.
+    Raises a `ValidationError` otherwise.
+    """
+    if (hours % 1 != 0) and (hours % 1 % .25 != 0):
+        error_message = INCREMENT_MESSAGES[random.randint(0, len(INCREMENT_MESSAGES) - 1)]
+        raise forms.ValidationError(error_message)
+    elif hours < 0:
+        raise forms.ValidationError("We here at <Insert Company Name here> would like you to "
+                                    "have a non-negative work experience. Please enter a "
+                                    "non-negative number of hours.")
+    elif not hours:
+        raise forms.ValidationError("If you work at <Insert Company Name here>, you're "
+                                    "more hero than zero. Enter an hero number of hours.")
+
+
+class JobChoices(object):
+    """
+    A pre-evaluated list of jobs, with a pk lookup for cleaning. A formset shares one
+    instance between its forms, so the jobs are only queried once.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+        self.lookup = {job.pk: job for job in self.jobs}
+
+    @classmethod
+    def for_user(cls, user, date=None):
+        """ The jobs available to the user that are open on the date (default today) """
+        if date is None:
+            date = datetime.date.today()
+        jobs = Job.objects.open_on(date).filter(pk__in=Job.objects.accessible_ids(user))
+        return cls(jobs.order_by('name'))
+
+
+class JobChoiceField(forms.ModelChoiceField):
+    """
+    A job field whose choices are the pre-evaluated `job_choices`, so that neither
+    rendering nor cleaning the field queries the database.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._job_choices = JobChoices([])
+        super(JobChoiceField, self).__init__(Job.objects.none(), *args, **kwargs)
+
+    def _get_job_choices(self):
+        return self._job_choices
+
+    def _set_job_choices(self, job_choices):
+        self._job_choices = job_choices
+        self.widget.choices = self.choices
+
+    job_choices = property(_get_job_choices, _set_job_choices)
+
+    def _get_choices(self):
+        choices = [(job.pk, self.label_from_instance(job)) for job in self.job_choices.jobs]
+        if self.empty_label is not None:
+            choices.insert(0, ('', self.empty_label))
+        return choices
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            return self.job_choices.lookup[int(value)]
+        except (KeyError, TypeError, ValueError):
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
 
 
 class WorkItemBaseFormSet(BaseFormSet):
@@ -14,9 +103,14 @@ class WorkItemBaseFormSet(BaseFormSet):
         self.user = kwargs.pop("logged_in_user")
         super(WorkItemBaseFormSet, self).__init__(*args, **kwargs)
 
+    @cached_property
+    def job_choices(self):
+        return JobChoices.for_user(self.user)
+
     def _construct_form(self, *args, **kwargs):
-        # inject user in each form on the formset
+        # inject user and the shared job choices in each form on the formset
         kwargs['user'] = self.user
+        kwargs['job_choices'] = self.job_choices
         return super(WorkItemBaseFormSet, self)._construct_form(*args, **kwargs)
 
 
@@ -26,7 +120,7 @@ class BadWorkItemForm(Exception):
 
 class WorkItemForm(ModelForm):
 
-    job = forms.ModelChoiceField(queryset=Job.objects.none(), empty_label="None")  # empty queryset, overridden in ctor
+    job = JobChoiceField(empty_label="None")  # no choices, overridden in ctor
 
     job.widget.attrs['class'] = 'form-control'
 
@@ -36,10 +130,9 @@ class WorkItemForm(ModelForm):
 
     def __init__(self, *args, **kwargs):
         user = kwargs.pop("user")
+        job_choices = kwargs.pop("job_choices", None)
         super(WorkItemForm, self).__init__(*args, **kwargs)
-        queryset = Job.objects.available_to(user) & Job.objects.open_on(datetime.date.today())
-        queryset = queryset.order_by('name')
-        self.fields["job"].queryset = queryset
+        self.fields["job"].job_choices = job_choices or JobChoices.for_user(user)
 
         self.fields["hours"].widget.attrs['class'] = 'form-control'
         self.fields["text"].widget.attrs['class'] = 'form-control'
@@ -49,6 +142,12 @@ class WorkItemForm(ModelForm):
 
         self.fields["text"].widget.attrs['rows'] = '6'
 
+    def _get_validation_exclusions(self):
+        # the job was validated against the job choices, so the model needn't look it up
+        exclude = super(WorkItemForm, self)._get_validation_exclusions()
+        exclude.append('job')
+        return exclude
+
     def clean(self):  # noqa: C901
         cleaned_data = super(WorkItemForm, self).clean()
         try:
@@ -66,34 +165,16 @@ class WorkItemForm(ModelForm):
         except KeyError:
             job = None
 
-        # Only allows non-zero, non-negative hours to be entered in half hour increments.
-        if (hours % 1 != 0) and (hours % 1 % .25 != 0):
-            message_list = ["Please, Hammer, don't hurt 'em! Use 15-minute increments.",
-                            "All your mantissa are belong to us. 15-minute increments only. Please.",
-                            "You thought we wouldn't notice that you didn't use 15-minute increments. You were wrong. Try again, jerk.",  # noqa: E501
-                            "Hey buddy. How's it going? Listen, not a huge deal, but we've got this thing where we use 15-minute increments.",  # noqa: E501
-                            "If you could go ahead and use 15-minute increments, that would be grrrreeaat."]
-            error_message = message_list[random.randint(0, len(message_list) - 1)]
-            self._errors["hours"] = self.error_class([error_message])
-            if hours:
-                del cleaned_data["hours"]
-        elif hours < 0:
-            error_message = ("We here at <Insert Company Name here> would like you to "
-                             "have a non-negative work experience. Please enter a "
-                             "non-negative number of hours.")
-            self._errors["hours"] = self.error_class([error_message])
-            if hours:
-                del cleaned_data["hours"]
-        elif not hours:
-            error_message = ("If you work at <Insert Company Name here>, you're "
-                             "more hero than zero. Enter an hero number of hours.")
-            self._errors["hours"] = self.error_class([error_message])
+        try:
+            validate_hours(hours)
+        except forms.ValidationError as e:
+            self._errors["hours"] = self.error_class(e.messages)
             if hours:
                 del cleaned_data["hours"]
 
         # Custom error messages for empty fields
         if text is None or text == "":
-            error_message = "This is where you describe the work you did, as if you did any."
+            error_message = MISSING_TEXT_MESSAGE
             self._errors["text"] = self.error_class([error_message])
             if text:
                 del cleaned_data["text"]
@@ -106,3 +187,131 @@ class WorkItemForm(ModelForm):
                 del cleaned_data["job"]
 
         return cleaned_data
+
+
+class WeekGridForm(forms.Form):
+    """
+    A jobs x days grid of a user's hours for a week. Each cell edits the hours of (at
+    most) one work item: filling an empty cell adds an item, described by the text of
+    its job's row, and clearing a cell deletes its item. Cells with several or invoiced
+    items, on days that can no longer be edited, or of jobs that are not available or
+    open on the day are read-only.
+    """
+
+    def __init__(self, user, days, *args, **kwargs):
+        super(WeekGridForm, self).__init__(*args, **kwargs)
+        self.user = user
+        self.days = days
+
+        self.items = defaultdict(list)
+        items = WorkItem.objects \
+            .filter(user=user, date__range=(days[0], days[-1])) \
+            .select_related('job') \
+            .order_by('pk')
+        for item in items:
+            self.items[item.job, item.date].append(item)
+
+        accessible = Job.objects.accessible_ids(user)
+        jobs = Job.objects \
+            .filter(pk__in=accessible, open_date__lte=days[-1]) \
+            .filter(Q(close_date__gte=days[0]) | Q(close_date=None))
+        jobs = sorted(set(jobs) | {job for job, date in self.items}, key=lambda job: job.name)
+
+        # (job, text field name, [(day, cell field name)]) for each row
+        self.grid = []
+        for job in jobs:
+            text_name = '%d-text' % job.pk
+            self.fields[text_name] = forms.CharField(required=False, disabled=job.pk not in accessible)
+            self.fields[text_name].widget.attrs.update({'class': 'form-control', 'placeholder': 'Work Description'})
+
+            cells = []
+            for day in days:
+                name = '%d-%s' % (job.pk, day.isoformat())
+                items = self.items[job, day]
+                self.fields[name] = forms.FloatField(
+                    required=False,
+                    disabled=not self.is_editable(job, day, items, accessible),
+                    initial=sum(item.hours for item in items) if items else None,
+                )
+                self.fields[name].widget.attrs.update({'class': 'form-control', 'step': '0.25'})
+                cells.append((day, name))
+            self.grid.append((job, text_name, cells))
+
+    def is_editable(self, job, day, items, accessible):
+        if job.pk not in accessible:
+            return False
+        if datetime.date.today() - day >= datetime.timedelta(days=settings.WORKLOG_EMAIL_REMINDERS_EXPIRE_AFTER):
+            return False
+        if items:
+            return len(items) == 1 and not items[0].invoiced
+        return job.open_date <= day and (job.close_date is None or day <= job.close_date)
+
+    @property
+    def rows(self):
+        """ (job, text field, [cell fields]) for each row, as bound fields """
+        for job, text_name, cells in self.grid:
+            yield job, self[text_name], [self[name] for day, name in cells]
+
+    def clean(self):
+        cleaned_data = super(WeekGridForm, self).clean()
+        self.created, self.updated, self.deleted = [], [], []
+
+        for job, text_name, cells in self.grid:
+            for day, name in cells:
+                if not self.fields[name].disabled and name in cleaned_data:
+                    self.clean_cell(job, day, name, text_name)
+
+        return cleaned_data
+
+    def clean_cell(self, job, day, name, text_name):
+        """ Validate a cell's hours and record the change to its work item """
+        hours = self.cleaned_data[name]
+        items = self.items[job, day]
+        item = items[0] if items else None
+
+        if hours is None:
+            if item is not None:
+                self.deleted.append(item)
+            return
+
+        try:
+            validate_hours(hours)
+        except forms.ValidationError as e:
+            self.add_error(name, e)
+            return
+
+        if item is None:
+            text = self.cleaned_data.get(text_name)
+            if not text and text_name not in self.errors:
+                self.add_error(text_name, MISSING_TEXT_MESSAGE)
+            self.created.append(WorkItem(user=self.user, date=day, hours=hours, text=text, job=job))
+        elif item.hours != hours:
+            item.hours = hours
+            self.updated.append(item)
+
+    def save(self):
+        """
+        Save the changes to the grid in a single transaction. New items are bulk created,
+        and the changed hours are written with a single update.
+        """
+        with transaction.atomic():
+            created = WorkItem.objects.insert(self.created)
+
+            if self.updated:
+                WorkItem.objects.filter(pk__in=[item.pk for item in self.updated]).update(hours=Case(
+                    *[When(pk=item.pk, then=Value(item.hours)) for item in self.updated],
+                    output_field=FloatField()
+                ))
+
+            if self.deleted:
+                WorkItem.objects.filter(pk__in=[item.pk for item in self.deleted]).delete()
+
+            # insert() and update() do not send post_save signals
+            signals.add_created_work(created)
+            signals.move_updated_work(self.updated)
+            if created or self.updated:
+                ChangeCounter.objects.increment_on_commit(WorkItem)
+            Change.objects.record(WorkItem, Change.ACTIONS.CREATE, [(item.pk, item.user_id) for item in created])
+            Change.objects.record(WorkItem, Change.ACTIONS.UPDATE, [(item.pk, item.user_id) for item in self.updated])
+
+        caches.update_month_index([item.date for item in created])
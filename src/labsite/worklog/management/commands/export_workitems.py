@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.http import QueryDict
+
+from labsite.worklog.api.filters import WorkItemFilter
+from labsite.worklog.models import WorkItem
+from labsite.worklog.utils import EXPORT_FORMATS, export_workitems
+
+
+class Command(BaseCommand):
+    help = 'Export work items as CSV or newline delimited JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'filters', nargs='*', metavar='lookup=value',
+            help='Filters accepted by the work item API, e.g. date__year=2018 username=jdoe.',
+        )
+        parser.add_argument(
+            '-f', '--format', default='csv', dest='format', choices=sorted(EXPORT_FORMATS),
+            help='The export format.',
+        )
+        parser.add_argument(
+            '-o', '--output', default=None, dest='output',
+            help='Specifies file to which the output is written.'
+        )
+
+    def handle(self, *args, **options):
+        data = QueryDict(mutable=True)
+        for arg in options['filters']:
+            lookup, sep, value = arg.partition('=')
+            if not sep:
+                raise CommandError("Filters must be given as lookup=value, not '%s'." % arg)
+            data.appendlist(lookup, value)
+
+        filterset = WorkItemFilter(data, queryset=WorkItem.objects.all())
+        if not filterset.form.is_valid():
+            raise CommandError(filterset.form.errors.as_text())
+
+        lines = export_workitems(filterset.qs, options['format'])
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
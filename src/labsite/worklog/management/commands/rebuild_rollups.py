@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from labsite.worklog.models import JobSummary, UserDayHours
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the job summaries and user day hours from the work items and funding.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'jobs', nargs='*', type=int, metavar='job_id',
+            help='The jobs to rebuild. By default, all jobs are rebuilt.',
+        )
+
+    def handle(self, *args, **options):
+        summaries = JobSummary.objects.rebuild(options['jobs'] or None)
+        self.stdout.write('Rebuilt %d job summaries.' % len(summaries))
+
+        count = UserDayHours.objects.rebuild(options['jobs'] or None)
+        self.stdout.write('Rebuilt %d user day hours.' % count)
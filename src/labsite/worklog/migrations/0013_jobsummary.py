@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-18 09:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Case, Max, Min, Sum, Value, When
+import django.db.models.deletion
+
+
+def build_summaries(apps, schema_editor):
+    Job = apps.get_model('worklog', 'Job')
+    JobSummary = apps.get_model('worklog', 'JobSummary')
+    WorkItem = apps.get_model('worklog', 'WorkItem')
+    Funding = apps.get_model('worklog', 'Funding')
+
+    work = {row['job_id']: row for row in WorkItem.objects.order_by().values('job_id').annotate(
+        worked=Sum('hours'),
+        uninvoiced=Sum(Case(When(invoiced=False, then='hours'), default=Value(0), output_field=models.FloatField())),
+        first=Min('date'),
+        last=Max('date'),
+    )}
+    funding = {row['job_id']: row for row in Funding.objects.order_by().values('job_id').annotate(
+        funded=Sum('hours'),
+        first=Min('date_available'),
+        last=Max('date_available'),
+    )}
+
+    JobSummary.objects.bulk_create(
+        JobSummary(
+            job_id=job_id,
+            funded_hours=funding.get(job_id, {}).get('funded', 0),
+            worked_hours=work.get(job_id, {}).get('worked', 0),
+            uninvoiced_hours=work.get(job_id, {}).get('uninvoiced', 0),
+            first_work_date=work.get(job_id, {}).get('first'),
+            last_work_date=work.get(job_id, {}).get('last'),
+            first_funding_date=funding.get(job_id, {}).get('first'),
+            last_funding_date=funding.get(job_id, {}).get('last'),
+        )
+        for job_id in Job.objects.values_list('pk', flat=True)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('worklog', '0012_invoicerun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobSummary',
+            fields=[
+                ('job', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='summary', serialize=False, to='worklog.Job')),
+                ('funded_hours', models.IntegerField(default=0)),
+                ('worked_hours', models.FloatField(default=0)),
+                ('uninvoiced_hours', models.FloatField(default=0)),
+                ('first_work_date', models.DateField(blank=True, null=True)),
+                ('last_work_date', models.DateField(blank=True, null=True)),
+                ('first_funding_date', models.DateField(blank=True, null=True)),
+                ('last_funding_date', models.DateField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-18 10:02
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+def build_user_day_hours(apps, schema_editor):
+    UserDayHours = apps.get_model('worklog', 'UserDayHours')
+    WorkItem = apps.get_model('worklog', 'WorkItem')
+
+    rows = WorkItem.objects.order_by().values_list('user_id', 'date', 'job_id') \
+        .annotate(hours=Sum('hours'), item_count=Count('pk'))
+
+    UserDayHours.objects.bulk_create((
+        UserDayHours(user_id=user_id, date=date, job_id=job_id, hours=hours, item_count=item_count)
+        for user_id, date, job_id, hours, item_count in rows
+    ), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('worklog', '0013_jobsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserDayHours',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('hours', models.FloatField(default=0)),
+                ('item_count', models.PositiveIntegerField(default=0)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='worklog.Job')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'user day hours',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='userdayhours',
+            unique_together=set([('user', 'date', 'job')]),
+        ),
+        migrations.RunPython(build_user_day_hours, migrations.RunPython.noop),
+    ]
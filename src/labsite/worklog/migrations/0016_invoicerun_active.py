@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.10 on 2026-10-18 11:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def deactivate_finished_runs(apps, schema_editor):
+    InvoiceRun = apps.get_model('worklog', 'InvoiceRun')
+
+    InvoiceRun.objects.filter(state__in=['DONE', 'FAILED']).update(active=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('worklog', '0015_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoicerun',
+            name='active',
+            field=models.NullBooleanField(default=True),
+        ),
+        migrations.RunPython(deactivate_finished_runs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='invoicerun',
+            name='date',
+            field=models.DateField(),
+        ),
+        migrations.AlterUniqueTogether(
+            name='invoicerun',
+            unique_together=set([('date', 'active')]),
+        ),
+    ]
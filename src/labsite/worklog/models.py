@@ -1,8 +1,14 @@
 import datetime
+from collections import defaultdict
+from itertools import islice
 
 from django.conf import settings
-from django.db import models
-from django.db.models import Case, Q, When
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Case, Count, F, Max, Min, Q, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
+
+from labsite.utils import choices
 
 
 User = settings.AUTH_USER_MODEL
@@ -66,6 +72,16 @@ class JobQuerySet(models.QuerySet):
             return self
         return self.filter(Q(users__id=user.pk) | Q(available_all_users=True)).distinct()
 
+    def accessible_ids(self, user):
+        """
+        Returns a frozenset of the pks of the jobs available to the user, regardless of
+        any filtering on the queryset. Unlike `available_to`, the result is cached (see
+        `caches.get_job_access`), so membership can be checked with a single query.
+        """
+        from .caches import get_job_access
+
+        return get_job_access(user)
+
 
 class JobManager(models.Manager.from_queryset(JobQuerySet)):
     def get_queryset(self):
@@ -90,11 +106,19 @@ class Job(models.Model):
     def __str__(self):
         return self.name
 
+    def get_summary(self):
+        """ Returns the job's summary, building it if it does not exist yet """
+        try:
+            return self.summary
+        except JobSummary.DoesNotExist:
+            self.summary = JobSummary.objects.rebuild([self.pk])[0]
+            return self.summary
+
     def hasFunding(self):
-        return len(self.funding.all()) != 0
+        return self.get_summary().first_funding_date is not None
 
     def hasWork(self):
-        return len(WorkItem.objects.filter(job=self)) != 0
+        return self.get_summary().first_work_date is not None
 
 
 class BillingSchedule(models.Model):
@@ -114,6 +138,26 @@ class Funding(models.Model):
         return 'Funding for %s' % self.job
 
 
+class WorkItemQuerySet(models.QuerySet):
+    def insert(self, objs):
+        """
+        Insert the items without sending signals, setting their pks. They are bulk created
+        on backends that return the pks of bulk inserted rows (e.g. PostgreSQL), and
+        inserted one row at a time elsewhere.
+        """
+        objs = list(objs)
+        if connections[self.db].features.can_return_ids_from_bulk_insert:
+            return self.bulk_create(objs)
+
+        fields = [field for field in self.model._meta.concrete_fields if not isinstance(field, models.AutoField)]
+        with transaction.atomic(using=self.db, savepoint=False):
+            for obj in objs:
+                obj.pk = self._insert([obj], fields=fields, return_id=True, using=self.db)
+                obj._state.adding, obj._state.db = False, self.db
+
+        return objs
+
+
 class WorkItem(models.Model):
     user = models.ForeignKey(User)
     date = models.DateField()
@@ -122,15 +166,390 @@ class WorkItem(models.Model):
     job = models.ForeignKey(Job)
     invoiced = models.BooleanField(default=False)
 
+    objects = WorkItemQuerySet.as_manager()
+
     def __str__(self):
         return '{user} on {date} worked {hours} hours on job {job} doing {item}'.format(
             user=self.user, date=self.date, hours=self.hours, job=self.job, item=self.text)
 
     def save(self, *args, **kwargs):
-        if (not Job.objects.available_to(self.user).filter(name=self.job.name).exists()):
+        if self.job_id not in Job.objects.accessible_ids(self.user):
             raise ValueError("Specified job is not available to {user}".format(user=str(self.user)))
 
         # if (not Job.objects.open_on(self.date).filter(name=self.job.name).exists()):
         #     raise ValueError("Specified job is not open on {date}".format(date=self.date.isoformat()))
 
         super(WorkItem, self).save(*args, **kwargs)
+
+
+class JobSummaryQuerySet(models.QuerySet):
+    def rebuild(self, job_ids=None):
+        """
+        Rebuild the summaries of the given jobs (or of all jobs) from their work items and
+        funding, returning the new summaries.
+        """
+        jobs, work, funding = Job.objects.all(), WorkItem.objects.all(), Funding.objects.all()
+        if job_ids is not None:
+            jobs, work, funding = [
+                queryset.filter(**{lookup: job_ids})
+                for queryset, lookup in [(jobs, 'pk__in'), (work, 'job_id__in'), (funding, 'job_id__in')]
+            ]
+
+        work = {row['job_id']: row for row in work.order_by().values('job_id').annotate(
+            worked=Sum('hours'),
+            uninvoiced=Sum(Case(
+                When(invoiced=False, then='hours'),
+                default=Value(0),
+                output_field=models.FloatField(),
+            )),
+            first=Min('date'),
+            last=Max('date'),
+        )}
+        funding = {row['job_id']: row for row in funding.order_by().values('job_id').annotate(
+            funded=Sum('hours'),
+            first=Min('date_available'),
+            last=Max('date_available'),
+        )}
+
+        summaries = []
+        for job_id in jobs.order_by('pk').values_list('pk', flat=True):
+            job_work, job_funding = work.get(job_id, {}), funding.get(job_id, {})
+            summaries.append(self.model(
+                job_id=job_id,
+                funded_hours=job_funding.get('funded', 0),
+                worked_hours=job_work.get('worked', 0),
+                uninvoiced_hours=job_work.get('uninvoiced', 0),
+                first_work_date=job_work.get('first'),
+                last_work_date=job_work.get('last'),
+                first_funding_date=job_funding.get('first'),
+                last_funding_date=job_funding.get('last'),
+            ))
+
+        with transaction.atomic():
+            stale = self.all() if job_ids is None else self.filter(job_id__in=job_ids)
+            stale.delete()
+            self.bulk_create(summaries)
+
+        return summaries
+
+    def rebuild_for(self, queryset):
+        """ Rebuild the summaries of the jobs in a queryset of work items or funding """
+        return self.rebuild(set(queryset.order_by().values_list('job_id', flat=True).distinct()))
+
+    def _add(self, job_id, dates, sign, first, last, rows, date_field, **totals):
+        """
+        Add (or remove, if `sign` is negative) the totals and dates of rows to a summary.
+        The first/last dates are recomputed from `rows` when a boundary date is removed.
+        """
+        summary = self.filter(job_id=job_id)
+        values = {field: F(field) + sign * value for field, value in totals.items()}
+        if sign > 0:
+            start, end = min(dates), max(dates)
+            values[first] = Least(Coalesce(first, Value(start)), Value(start), output_field=models.DateField())
+            values[last] = Greatest(Coalesce(last, Value(end)), Value(end), output_field=models.DateField())
+
+        if not summary.update(**values):
+            # the summary is created from scratch, unless the rows are being removed
+            if sign > 0:
+                try:
+                    self.rebuild([job_id])
+                except IntegrityError:
+                    # the summary was created concurrently, without these rows
+                    summary.update(**values)
+            return
+
+        if sign < 0 and summary.filter(Q(**{first + '__in': dates}) | Q(**{last + '__in': dates})).exists():
+            dates = rows.filter(job_id=job_id).aggregate(first=Min(date_field), last=Max(date_field))
+            summary.update(**{first: dates['first'], last: dates['last']})
+
+    def add_work(self, job_id, date, hours, invoiced, sign=1):
+        self.add_work_rows([(job_id, date, hours, invoiced)], sign)
+
+    def add_work_rows(self, rows, sign=1):
+        """
+        Add (or remove, if `sign` is negative) the hours of (job_id, date, hours, invoiced)
+        rows to their summaries, with one update per job.
+        """
+        jobs = defaultdict(lambda: {'dates': set(), 'worked_hours': 0, 'uninvoiced_hours': 0})
+        for job_id, date, hours, invoiced in rows:
+            totals = jobs[job_id]
+            totals['dates'].add(date)
+            totals['worked_hours'] += hours
+            if not invoiced:
+                totals['uninvoiced_hours'] += hours
+
+        for job_id, totals in jobs.items():
+            dates = totals.pop('dates')
+            self._add(job_id, dates, sign, 'first_work_date', 'last_work_date', WorkItem.objects, 'date', **totals)
+
+    def set_invoiced(self, rows, invoiced=True):
+        """
+        Move the hours of (job_id, hours) rows out of the uninvoiced hours, or back into
+        them if `invoiced` is false, with one update per job.
+        """
+        jobs = defaultdict(int)
+        for job_id, hours in rows:
+            jobs[job_id] += hours
+
+        sign = -1 if invoiced else 1
+        for job_id, hours in jobs.items():
+            self.filter(job_id=job_id).update(uninvoiced_hours=F('uninvoiced_hours') + sign * hours)
+
+    def add_funding(self, job_id, date, hours, sign=1):
+        self._add(job_id, [date], sign, 'first_funding_date', 'last_funding_date', Funding.objects, 'date_available',
+                  funded_hours=hours)
+
+
+class JobSummary(models.Model):
+    """
+    The work and funding totals of a job, kept current by the worklog signals. Bulk
+    updates that bypass the signals should `rebuild()` the affected summaries.
+    """
+    job = models.OneToOneField(Job, primary_key=True, related_name='summary')
+    funded_hours = models.IntegerField(default=0)
+    worked_hours = models.FloatField(default=0)
+    uninvoiced_hours = models.FloatField(default=0)
+    first_work_date = models.DateField(null=True, blank=True)
+    last_work_date = models.DateField(null=True, blank=True)
+    first_funding_date = models.DateField(null=True, blank=True)
+    last_funding_date = models.DateField(null=True, blank=True)
+
+    objects = JobSummaryQuerySet.as_manager()
+
+    def __str__(self):
+        return 'Summary for %s' % self.job
+
+    @property
+    def remaining_hours(self):
+        return self.funded_hours - self.worked_hours
+
+
+class UserDayHoursQuerySet(models.QuerySet):
+    def rebuild(self, job_ids=None, batch_size=1000):
+        """ Rebuild the rollup rows of the given jobs (or of all jobs). Returns the number of rows. """
+        work = WorkItem.objects.all() if job_ids is None else WorkItem.objects.filter(job_id__in=job_ids)
+        rows = work \
+            .order_by() \
+            .values_list('user_id', 'date', 'job_id') \
+            .annotate(hours=Sum('hours'), item_count=Count('pk')) \
+            .iterator()
+
+        count = 0
+        with transaction.atomic():
+            stale = self.all() if job_ids is None else self.filter(job_id__in=job_ids)
+            stale.delete()
+
+            while True:
+                batch = [
+                    self.model(user_id=user_id, date=date, job_id=job_id, hours=hours, item_count=item_count)
+                    for user_id, date, job_id, hours, item_count in islice(rows, batch_size)
+                ]
+                if not batch:
+                    break
+                self.bulk_create(batch)
+                count += len(batch)
+        return count
+
+    def rebuild_for(self, queryset):
+        """ Rebuild the rollup rows of the jobs in a queryset of work items """
+        self.rebuild(set(queryset.order_by().values_list('job_id', flat=True).distinct()))
+
+    def add_work(self, user_id, date, job_id, hours, items=1):
+        """
+        Add hours and items to a rollup row (or remove them, if negative). Rows are created
+        as items are added and deleted with their last item.
+        """
+        rows = self.filter(user_id=user_id, date=date, job_id=job_id)
+        values = {'hours': F('hours') + hours, 'item_count': F('item_count') + items}
+
+        if items <= 0:
+            rows.update(**values)
+            if items < 0:
+                rows.filter(item_count__lte=0).delete()
+            return
+
+        if rows.update(**values):
+            return
+        try:
+            with transaction.atomic():
+                self.create(user_id=user_id, date=date, job_id=job_id, hours=hours, item_count=items)
+        except IntegrityError:
+            # the row was created concurrently
+            rows.update(**values)
+
+
+class UserDayHours(models.Model):
+    """
+    The hours worked by each user on each job per day, kept current by the worklog
+    signals. Aggregate reads use the rollup instead of scanning the work items.
+    """
+    user = models.ForeignKey(User)
+    date = models.DateField(db_index=True)
+    job = models.ForeignKey(Job)
+    hours = models.FloatField(default=0)
+    item_count = models.PositiveIntegerField(default=0)
+
+    objects = UserDayHoursQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['user', 'date', 'job']
+        verbose_name_plural = 'user day hours'
+
+    def __str__(self):
+        return '%s worked %s hours on %s on %s' % (self.user, self.hours, self.job, self.date)
+
+
+class InvoiceRunQuerySet(models.QuerySet):
+    def stale(self):
+        """ The runs still in progress `WORKLOG_INVOICE_RUN_TIMEOUT` seconds after they were created """
+        cutoff = timezone.now() - datetime.timedelta(seconds=settings.WORKLOG_INVOICE_RUN_TIMEOUT)
+        return self.filter(active=True, created__lt=cutoff)
+
+    def fail(self):
+        """ Mark the runs as failed, so that their dates can be invoiced again """
+        return self.update(state=self.model.STATES.FAILED, active=None)
+
+
+class InvoiceRun(models.Model):
+    """
+    Tracks the background task that marks the items billed on a date as invoiced.
+    There is at most one run in progress per billing date, so repeated requests do not
+    re-run it, while a date can be invoiced again once its previous run has finished.
+    """
+    STATES = choices((
+        ('PENDING', 'Pending'),
+        ('RUNNING', 'Running'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed'),
+    ))
+    date = models.DateField()
+    state = models.CharField(max_length=8, choices=STATES, default=STATES.PENDING)
+    # True while the run is in progress and null once it has finished, as the nulls
+    # are exempt from the unique constraint
+    active = models.NullBooleanField(default=True)
+    invoiced = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = InvoiceRunQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('date', 'active')
+
+    def __str__(self):
+        return 'Invoice run for %s (%s)' % (self.date, self.get_state_display())
+
+    @property
+    def in_progress(self):
+        return self.state in (self.STATES.PENDING, self.STATES.RUNNING)
+
+
+class ChangeCounterQuerySet(models.QuerySet):
+    def increment(self, model):
+        """ Count a change to the model's table """
+        table = model._meta.db_table
+        values = {'version': F('version') + 1, 'modified': timezone.now()}
+
+        if not self.filter(table=table).update(**values):
+            self.get_or_create(table=table)
+            self.filter(table=table).update(**values)
+
+    def increment_on_commit(self, model):
+        """
+        Count a change to the model's table once the current transaction commits, so that
+        concurrent writers do not wait on the counter's row lock for the rest of the
+        transaction. The table is counted once per transaction, however many of its rows
+        are changed.
+        """
+        table = model._meta.db_table
+        connection = transaction.get_connection(self.db)
+
+        # a pending count is only reused if it was registered in this or an enclosing
+        # savepoint, so that it is not rolled back without the change
+        savepoints = set(connection.savepoint_ids)
+        for sids, func in connection.run_on_commit:
+            if getattr(func, 'counter_table', None) == table and sids <= savepoints:
+                return
+
+        def increment():
+            self.increment(model)
+        increment.counter_table = table
+        transaction.on_commit(increment, using=self.db)
+
+    def for_model(self, model):
+        """ Return the model's counter, or an unsaved counter if its table has not changed yet """
+        table = model._meta.db_table
+        try:
+            return self.get(table=table)
+        except self.model.DoesNotExist:
+            return self.model(table=table)
+
+
+class ChangeCounter(models.Model):
+    """
+    Counts the changes made to a table. The worklog API uses the counters to validate
+    cached list responses.
+    """
+    table = models.CharField(max_length=255, unique=True)
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField(null=True, blank=True)
+
+    objects = ChangeCounterQuerySet.as_manager()
+
+    def __str__(self):
+        return '%s v%s' % (self.table, self.version)
+
+
+class ChangeQuerySet(models.QuerySet):
+    def record(self, model, action, rows):
+        """
+        Record a change to each of the model's (pk, user pk) rows.
+        """
+        return self.bulk_create(
+            self.model(model=model._meta.model_name, object_id=pk, user_id=user_id, action=action)
+            for pk, user_id in rows
+        )
+
+    def since(self, seq):
+        """ The changes made after the sequence number, in order """
+        return self.filter(seq__gt=seq).order_by('seq')
+
+    def recent(self, seq):
+        """
+        The changes made before the sequence number, no more than `WORKLOG_CHANGE_FEED_WINDOW`
+        seconds before it, most recent first. A sequence number is assigned when a change
+        is inserted rather than when it commits, so these may not have been visible when
+        the sequence number was read.
+        """
+        created = self.model.objects.filter(seq=seq).values_list('created', flat=True).first()
+        if created is None:
+            return self.none()
+
+        window = datetime.timedelta(seconds=settings.WORKLOG_CHANGE_FEED_WINDOW)
+        return self.filter(seq__lt=seq, created__gte=created - window).order_by('-seq')
+
+
+class Change(models.Model):
+    """
+    A feed of the inserts, updates and deletes of work items and work days, which
+    clients mirror the worklog from. Each change has a new, higher sequence number.
+    The feed is kept for deleted users, so their changes have no foreign key.
+    """
+    ACTIONS = choices((
+        ('CREATE', 'Create'),
+        ('UPDATE', 'Update'),
+        ('DELETE', 'Delete'),
+    ))
+    seq = models.BigAutoField(primary_key=True)
+    model = models.CharField(max_length=32)
+    object_id = models.PositiveIntegerField()
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    action = models.CharField(max_length=8, choices=ACTIONS)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = ChangeQuerySet.as_manager()
+
+    class Meta:
+        index_together = [['user', 'seq']]
+
+    def __str__(self):
+        return '%s %s %s %s' % (self.seq, self.get_action_display(), self.model, self.object_id)
@@ -0,0 +1,211 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_init, post_save,
+)
+from django.dispatch import receiver
+
+from . import caches
+from .models import (
+    Change, ChangeCounter, Funding, Holiday, Job, JobSummary, UserDayHours,
+    WorkDay, WorkItem,
+)
+
+
+def get_rollup_values(instance, fields):
+    """
+    Return the instance's values of the fields that contribute to the rollups, or None
+    if any of them are deferred. Deferred fields are not loaded from the database.
+    """
+    values = []
+    for name in fields:
+        field = instance._meta.get_field(name)
+        if field.attname not in instance.__dict__:
+            return None
+        values.append(field.to_python(instance.__dict__[field.attname]))
+    return tuple(values)
+
+
+def rollups_changed(sender, instance, created, update_fields, fields, move, rebuild):
+    """
+    Move the contribution of a saved instance to the rollups from its original values
+    (as loaded) to its current values.
+    """
+    if update_fields is not None and not set(update_fields) & set(fields):
+        return
+
+    original = None if created else instance._rollup_values
+    current = get_rollup_values(instance, fields)
+    instance._rollup_values = current
+
+    if current is None or (original is None and not created):
+        # the values are deferred, so the contribution is unknown
+        rebuild(sender.objects.filter(pk=instance.pk))
+    elif original != current:
+        move(original, current)
+
+
+WORKITEM_ROLLUP_FIELDS = ['user', 'job', 'date', 'hours', 'invoiced']
+FUNDING_ROLLUP_FIELDS = ['job', 'date_available', 'hours']
+
+
+def move_work(original, current):
+    """ Move a work item's hours between the rollups. Either set of values may be None. """
+    for values, sign in [(original, -1), (current, 1)]:
+        if values is not None:
+            user_id, job_id, date, hours, invoiced = values
+            JobSummary.objects.add_work(job_id, date, hours, invoiced, sign)
+
+    if original is not None and current is not None and original[:3] == current[:3]:
+        # the item stays on the same user day, so only its hours may have changed
+        if original[3] != current[3]:
+            user_id, job_id, date = current[:3]
+            UserDayHours.objects.add_work(user_id, date, job_id, current[3] - original[3], items=0)
+        return
+
+    for values, sign in [(original, -1), (current, 1)]:
+        if values is not None:
+            user_id, job_id, date, hours, invoiced = values
+            UserDayHours.objects.add_work(user_id, date, job_id, sign * hours, items=sign)
+
+
+def add_work_rows(rows, sign=1):
+    """
+    Add (or remove, if `sign` is negative) the rollup values of work items written
+    without sending signals, such as by `insert()` or `update()`. The hours on
+    each job and user day are added together.
+    """
+    rows = list(rows)
+    JobSummary.objects.add_work_rows([row[1:] for row in rows], sign)
+
+    days = defaultdict(lambda: [0, 0])
+    for user_id, job_id, date, hours, invoiced in rows:
+        days[user_id, date, job_id][0] += hours
+        days[user_id, date, job_id][1] += 1
+
+    for (user_id, date, job_id), (hours, items) in days.items():
+        UserDayHours.objects.add_work(user_id, date, job_id, sign * hours, items=sign * items)
+
+
+def add_created_work(items):
+    """ Add the hours of work items created by `insert()` to the rollups """
+    add_work_rows([get_rollup_values(item, WORKITEM_ROLLUP_FIELDS) for item in items])
+
+
+def move_updated_work(items):
+    """ Move the rollup contributions of work items saved by `update()` from their values as loaded """
+    for item in items:
+        original, item._rollup_values = item._rollup_values, get_rollup_values(item, WORKITEM_ROLLUP_FIELDS)
+        move_work(original, item._rollup_values)
+
+
+def rebuild_work(queryset):
+    JobSummary.objects.rebuild_for(queryset)
+    UserDayHours.objects.rebuild_for(queryset)
+
+
+def move_funding(original, current):
+    for values, sign in [(original, -1), (current, 1)]:
+        if values is not None:
+            job_id, date, hours = values
+            JobSummary.objects.add_funding(job_id, date, hours, sign)
+
+
+@receiver(post_save, sender=WorkItem)
+def workitem_saved(sender, instance, created, update_fields=None, **kwargs):
+    date = WorkItem._meta.get_field('date').to_python(instance.date)
+    caches.update_month_index([date])
+
+    if created or (update_fields is not None and 'date' not in update_fields):
+        return
+
+    # The item's original month may now be empty. The original values are replaced by
+    # `workitem_rollups`, which is connected after this receiver.
+    original = instance._rollup_values
+    if original is None or original[2].replace(day=1) != date.replace(day=1):
+        caches.clear_month_index()
+
+
+@receiver(post_delete, sender=WorkItem)
+def workitem_deleted(sender, instance, **kwargs):
+    # the month may now be empty
+    caches.clear_month_index()
+
+
+@receiver([post_save, post_delete], sender=settings.AUTH_USER_MODEL)
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    # logging in only updates 'last_login', which doesn't affect the menu
+    if update_fields is not None and set(update_fields) == {'last_login'}:
+        return
+    caches.clear_user_menu()
+
+
+@receiver([post_save, post_delete], sender=Job)
+def job_changed(sender, instance, **kwargs):
+    caches.clear_job_menu()
+
+
+@receiver([post_save, post_delete], sender=Holiday)
+def holiday_changed(sender, instance, **kwargs):
+    caches.clear_holiday_calendar()
+
+
+@receiver([post_save, post_delete], sender=WorkItem)
+@receiver([post_save, post_delete], sender=WorkDay)
+@receiver([post_save, post_delete], sender=Job)
+def table_changed(sender, **kwargs):
+    ChangeCounter.objects.increment_on_commit(sender)
+
+
+@receiver(post_save, sender=WorkItem)
+@receiver(post_save, sender=WorkDay)
+def record_change(sender, instance, created, **kwargs):
+    action = Change.ACTIONS.CREATE if created else Change.ACTIONS.UPDATE
+    Change.objects.record(sender, action, [(instance.pk, instance.user_id)])
+
+
+@receiver(post_delete, sender=WorkItem)
+@receiver(post_delete, sender=WorkDay)
+def record_deletion(sender, instance, **kwargs):
+    Change.objects.record(sender, Change.ACTIONS.DELETE, [(instance.pk, instance.user_id)])
+
+
+@receiver(m2m_changed, sender=Job.users.through)
+def job_users_changed(sender, action, **kwargs):
+    # job availability is filterable in the API
+    if action.startswith('post_'):
+        ChangeCounter.objects.increment_on_commit(Job)
+
+
+@receiver(post_init, sender=WorkItem)
+def workitem_loaded(sender, instance, **kwargs):
+    instance._rollup_values = get_rollup_values(instance, WORKITEM_ROLLUP_FIELDS)
+
+
+@receiver(post_save, sender=WorkItem)
+def workitem_rollups(sender, instance, created, update_fields=None, **kwargs):
+    rollups_changed(sender, instance, created, update_fields, WORKITEM_ROLLUP_FIELDS, move_work, rebuild_work)
+
+
+@receiver(post_delete, sender=WorkItem)
+def workitem_rollups_deleted(sender, instance, **kwargs):
+    if instance._rollup_values is not None:
+        move_work(instance._rollup_values, None)
+
+
+@receiver(post_init, sender=Funding)
+def funding_loaded(sender, instance, **kwargs):
+    instance._rollup_values = get_rollup_values(instance, FUNDING_ROLLUP_FIELDS)
+
+
+@receiver(post_save, sender=Funding)
+def funding_rollups(sender, instance, created, update_fields=None, **kwargs):
+    rollups_changed(sender, instance, created, update_fields, FUNDING_ROLLUP_FIELDS, move_funding,
+                    JobSummary.objects.rebuild_for)
+
+
+@receiver(post_delete, sender=Funding)
+def funding_rollups_deleted(sender, instance, **kwargs):
+    if instance._rollup_values is not None:
+        move_funding(instance._rollup_values, None)
@@ -1,5 +1,8 @@
-import calendar
 import datetime
+import logging
+import time
+from itertools import groupby
+from operator import attrgetter
 
 from celery import shared_task
 from django.conf import settings
@@ -8,7 +11,13 @@ from django.core import mail
 from django.core.urlresolvers import reverse
 from django.template import Context, Template
 
-from .models import Employee, Job, WorkDay, WorkItem
+from .caches import get_holiday_calendar
+from .models import (
+    BillingSchedule, Employee, InvoiceRun, Job, JobSummary, WorkDay, WorkItem,
+)
+
+
+logger = logging.getLogger(__name__)
 
 
 email_msg = Template("""
@@ -49,107 +58,96 @@ html_email_msg = Template("""
 """)
 
 
-@shared_task  # noqa: C901
-def generate_invoice(default_date=None):
-    if default_date is None:
-        default_date = datetime.date.today()
-    else:
-        default_date = datetime.datetime.strptime(default_date, '%Y-%m-%d').date()
+def get_invoice_week(date):
+    """
+    Returns the first day of the invoice week containing the date. Invoice weeks start
+    on Monday, but are split at the start of each month.
+    """
+    return max(date - datetime.timedelta(days=date.weekday()), date.replace(day=1))
 
-    # cal = calendar.Calendar(0)
-    billable_jobs = Job.objects.filter(billing_schedule__date=default_date).exclude(invoiceable=False).distinct()
-    send_mail = False
 
-    # continue only if we can bill jobs
-    if billable_jobs:
-        job_work_items = []
+def get_invoice_items(date):
+    """ Returns the uninvoiced work items of the invoiceable jobs billed on the given date """
+    return WorkItem.objects.filter(
+        job__in=BillingSchedule.objects.filter(date=date).values('job'),
+        job__invoiceable=True,
+        invoiced=False,
+        date__lt=date)
 
-        # loop through all the jobs
-        for job in billable_jobs:
-            work_items = WorkItem.objects.filter(job=job, invoiced=False, date__lt=default_date) \
-                .exclude(job__invoiceable=False).distinct().order_by('date')
 
-            # continue only if we have work items
-            if work_items:
-                # send email if we have work items
-                send_mail = True
+def build_invoice(default_date):
+    """
+    Builds the invoice message for all billable jobs on the given date, returning an
+    empty string if there is nothing to invoice.
 
-                # start at the first work item date
-                first_date = work_items[0].date
-                last_work_item = work_items.order_by('-date')[0]
-                end_date = last_work_item.date
+    All uninvoiced work items are fetched in a single ordered query, and then grouped
+    by job and invoice week in one pass.
+    """
+    work_items = get_invoice_items(default_date) \
+        .select_related('job') \
+        .order_by('job__name', 'job_id', 'date', 'pk')
 
-                days = (end_date - first_date).days
+    job_msg_str = '\n%s (%s)'
+    date_str = '\n\tDate: Week of %s (%s)\n'
+    email_msgs = []
 
-                week_of_str = '%s/%s/%s'
-                job_msg_str = '\n%s (%s)'
+    for job, job_items in groupby(work_items.iterator(), key=attrgetter('job')):
+        total_hours = 0
+        week_msgs = []
 
-                total_hours = 0
-                weekly_work_items = []
+        for week, week_items in groupby(job_items, key=lambda item: get_invoice_week(item.date)):
+            weekly_hours = 0
+            work_item_msgs = []
 
-                # continue to calculate hours until we reach the end date
-                while first_date <= end_date:
-                    # used to grab weeks in a month; this will stagger the starting weeks of certain months
-                    month = calendar.monthcalendar(first_date.year, first_date.month)
+            for item in week_items:
+                weekly_hours += item.hours
+                work_item_msgs.append('\t\t%s hours, %s' % (item.hours, item.text))
 
-                    for week in month:
-                        weekly_hours = 0
-                        work_item_msgs = []
-                        days = [day for day in week if day != 0]  # we need the first day of the month
-                        date = datetime.date(first_date.year, first_date.month, days[0])
+            total_hours += weekly_hours
+            week_of = '%s/%s/%s' % (week.month, week.day, week.year)
+            week_msgs.append(date_str % (week_of, weekly_hours) + '\n'.join(work_item_msgs))
 
-                        # if its the first day of the week, set the week of string
-                        if date.weekday == 0 or date.day == days[0]:
-                            week_of = week_of_str % (date.month, date.day, date.year)
-                            work_item_msgs.append(week_of)
-
-                        # calculate the work for each day
-                        for day in week:
-                            if day != 0:
-                                items = work_items.filter(date=date)
-
-                                for item in items:
-                                    total_hours += item.hours
-                                    weekly_hours += item.hours
-                                    work_item_msg = '\t\t%s hours, %s' % (item.hours, item.text)
-                                    work_item_msgs.append(work_item_msg)
-
-                                date += datetime.timedelta(days=1)
-
-                        # adjust the first date for loop check and add the weekly hours to the week
-                        first_date = date
-                        work_item_msgs[0] += ' (%s)' % weekly_hours
-                        weekly_work_items.append(work_item_msgs)
-
-                job_work_items.append((job_msg_str % (job.name, total_hours), weekly_work_items,))
-
-    if send_mail:
-        sub = 'Invoice'
-        date_str = '\n\tDate: Week of %s\n'
-        email_msgs = []
+        email_msgs.append(job_msg_str % (job.name, total_hours) + ''.join(week_msgs))
 
-        # a list of tuples (job, work items in a month)
-        for item in job_work_items:
-            job_msgs = []
-            job = item[0]
-            entries = item[1]
+    return '\n\n'.join(email_msgs)
 
-            # a list where the first entry is the week and the rest are work items
-            for entry in entries:
-                if len(entry) > 1:
-                    date = date_str % entry[0]
-                    work_item_msgs = []
 
-                    # loop through the work items
-                    for work in entry[1:]:
-                        work_item_msgs.append(work)
+@shared_task
+def mark_invoiced(run_id):
+    """
+    Marks the items billed on the run's date as invoiced, in a single update. Only a
+    pending run is executed, so a duplicated task does nothing.
+    """
+    runs = InvoiceRun.objects.filter(pk=run_id)
+    if not runs.filter(state=InvoiceRun.STATES.PENDING).update(state=InvoiceRun.STATES.RUNNING):
+        return
+
+    run = runs.get()
+    try:
+        items = get_invoice_items(run.date)
+        job_ids = set(items.values_list('job_id', flat=True))
+        count = items.update(invoiced=True)
+        JobSummary.objects.rebuild(job_ids)
+    except Exception:
+        runs.fail()
+        raise
+
+    runs.update(state=InvoiceRun.STATES.DONE, active=None, invoiced=count)
+    logger.info("Marked %d items billed on %s as invoiced.", count, run.date)
 
-                    job_msgs.append(date + ('\n').join(work_item_msgs))
 
-            email_msgs.append(job + ('').join(job_msgs))
+@shared_task
+def generate_invoice(default_date=None):
+    if default_date is None:
+        default_date = datetime.date.today()
+    else:
+        default_date = datetime.datetime.strptime(default_date, '%Y-%m-%d').date()
 
-        msg = ('\n\n').join(email_msgs)
+    msg = build_invoice(default_date)
 
+    # send email only if we have work items
+    if msg:
+        sub = 'Invoice'
         msg += '\n\nReport tools: %s?date=%s' % (settings.SITE_URL + reverse('worklog:report_url'), default_date)
 
         recipients = []
@@ -166,7 +164,9 @@ def generate_invoice(default_date=None):
 @shared_task
 def generate_invoice_email():
     default_date = datetime.date.today()
-    billable_jobs = Job.objects.filter(billing_schedule__date=default_date).distinct()
+    billable_jobs = Job.objects \
+        .filter(billing_schedule__date=default_date, invoiceable=True, summary__uninvoiced_hours__gt=0) \
+        .distinct()
 
     # continue only if we there are jobs to bill
     if billable_jobs:
@@ -204,37 +204,66 @@ def create_reminder_url(date):
     return settings.SITE_URL + path
 
 
+def get_reminder_dates(users, today=None):
+    """
+    Returns a mapping of user ids to the dates that the user still needs to reconcile,
+    ordered from most recent to least recent. Only business days (weekdays that are not
+    holidays) within the reminder window are considered. The reconciled work days for
+    all users are loaded in one query.
+    """
+    if today is None:
+        today = datetime.date.today()
+
+    expire_days = settings.WORKLOG_EMAIL_REMINDERS_EXPIRE_AFTER
+    start = today - datetime.timedelta(days=expire_days - 1)
+    date_list = get_holiday_calendar().business_days(start, today)[::-1]
+
+    reconciled = set(WorkDay.objects
+                     .filter(user__in=[user.pk for user in users], date__in=date_list, reconciled=True)
+                     .values_list('user_id', 'date'))
+
+    return {
+        user.pk: [date for date in date_list if (user.pk, date) not in reconciled]
+        for user in users
+    }
+
+
 def get_reminder_dates_for_user(user):
-    today = datetime.date.today()
-    date_list = [today - datetime.timedelta(days=x) for x in range(0, settings.WORKLOG_EMAIL_REMINDERS_EXPIRE_AFTER)]
-    rem_dates = []
-    for date in date_list:
-        if not WorkDay.objects.filter(user=user, date=date, reconciled=True) and date.isoweekday() in range(1, 6):
-            rem_dates.append(date)
-    return rem_dates
+    return get_reminder_dates([user])[user.pk]
 
 
 @shared_task
 def send_reminder_emails():
     today = datetime.date.today()
-    send_emails = settings.WORKLOG_SEND_REMINDERS and today.isoweekday() in range(1, 6)
-    if send_emails:
-        email_list = []
-        for employee in Employee.objects.all():
-            user = employee.user
-
-            if not user.email or not user.is_active:
-                continue
-
-            date_list = get_reminder_dates_for_user(user)
-
-            for date in date_list:
-                email_list.append(create_reminder_email(user.email, date, date_list))
-        if email_list:
-            connection = mail.get_connection(fail_silently=False)
-            for email in email_list:
-                email.connection = connection
-                email.send()
+    send_emails = settings.WORKLOG_SEND_REMINDERS and get_holiday_calendar().is_business_day(today)
+    if not send_emails:
+        return
+
+    started = time.monotonic()
+    users = [
+        employee.user for employee in Employee.objects
+        .select_related('user')
+        .filter(user__is_active=True)
+        .exclude(user__email='')
+    ]
+    reminder_dates = get_reminder_dates(users, today)
+
+    email_list = []
+    for user in users:
+        date_list = reminder_dates[user.pk]
+
+        for date in date_list:
+            email_list.append(create_reminder_email(user.email, date, date_list))
+
+    sent = 0
+    if email_list:
+        batch_size = settings.WORKLOG_EMAIL_REMINDERS_BATCH_SIZE
+        with mail.get_connection(fail_silently=False) as connection:
+            for i in range(0, len(email_list), batch_size):
+                sent += connection.send_messages(email_list[i:i + batch_size]) or 0
+
+    logger.info("Sent %d of %d reminder emails to %d employees in %.2fs.",
+                sent, len(email_list), len(users), time.monotonic() - started)
 
 
 def test_send_reminder_email(username, date=datetime.date.today()):
@@ -27,6 +27,7 @@ app_name = 'worklog'
 urlpatterns = [
     url(r'^$', views.HomepageView.as_view(), {}, name='home'),
     url(r'^(?P<date>\d{4}-\d{2}-\d{2})/$', views.WorkItemView.as_view(), name='date'),
+    url(r'^(?P<date>\d{4}-\d{2}-\d{2})/week/$', views.WeekView.as_view(), name='week'),
     url(r'^today/$', views.CurrentDateRedirectView.as_view(), name='today'),
     url(r'^add/$', views.CurrentDateRedirectView.as_view(), name='add'),
 
@@ -43,6 +44,8 @@ urlpatterns = [
     url(r'^report/$', views.ReportView.as_view(), name='report_url'),
     url(r'^chart/$', views.ChartView.as_view(), name='chart_url'),
     url(r'^chart/job/$', views.JobDataView.as_view(), name='job_data_url'),
+    url(r'^chart/job/(?P<pk>\d+)/burndown/$', views.BurndownView.as_view(), name='job_burndown_url'),
 
+    url(r'^api/changes/$', api_views.ChangeFeedView.as_view(), name='changes'),
     url(r'^api/', include(router.urls)),
 ]
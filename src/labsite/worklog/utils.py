@@ -0,0 +1,193 @@
+import csv
+import datetime
+from collections import OrderedDict, namedtuple
+from itertools import accumulate
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Sum
+
+from .models import Funding, UserDayHours
+from .tasks import get_reminder_dates
+
+
+WorkSummary = namedtuple('WorkSummary', ['days', 'week_total', 'outstanding'])
+
+# (label, lookup) pairs of the exported work item columns
+WORKITEM_EXPORT_FIELDS = [
+    ('id', 'id'),
+    ('date', 'date'),
+    ('user', 'user__username'),
+    ('job', 'job__name'),
+    ('hours', 'hours'),
+    ('text', 'text'),
+    ('invoiced', 'invoiced'),
+]
+
+
+def find_previous_saturday(date):
+    """ Returns the most recent saturday"""
+    dow = (date.isoweekday() + 1) % 7
+    last_saturday = date - datetime.timedelta(days=dow)
+    return last_saturday
+
+
+def get_past_n_days(date, num=7):
+    """ Gets the past [num] days and returns them in a list ordered from most recent to least recent """
+    past_week_dates = []
+    for i in range(0, num):
+        new_date = date - datetime.timedelta(days=i)
+        past_week_dates.append(new_date)
+
+    return past_week_dates
+
+
+def daterange(start, end):
+    """
+    Yield each date from `start` to `end`, inclusive.
+    """
+    for n in range((end - start).days + 1):
+        yield start + datetime.timedelta(days=n)
+
+
+def get_burndown(job, start_date=None, end_date=None):
+    """
+    Return an ordered mapping of date strings to the hours remaining on the job at
+    the end of that day (total funding available minus total hours worked).
+
+    The per-day hour and funding totals are fetched in one grouped query each (the hours
+    from the `UserDayHours` rollup), and the series is built with a running sum over a
+    dense date index. If either date is not provided, it defaults to the first/last date
+    with work or funding.
+
+    Raises a `ValueError` if the job has no work or funding, or the dates are invalid.
+    """
+    deltas = {}
+
+    work = UserDayHours.objects \
+        .filter(job=job) \
+        .order_by() \
+        .values_list('date') \
+        .annotate(hours=Sum('hours'))
+    for date, hours in work:
+        deltas[date] = deltas.get(date, 0) - hours
+
+    funding = Funding.objects \
+        .filter(job=job) \
+        .order_by() \
+        .values_list('date_available') \
+        .annotate(hours=Sum('hours'))
+    for date, hours in funding:
+        deltas[date] = deltas.get(date, 0) + hours
+
+    if not deltas:
+        raise ValueError('There is no work or funding available for job %s' % job)
+
+    initial_date, final_date = min(deltas), max(deltas)
+    start_date = start_date or initial_date
+    end_date = end_date or final_date
+
+    if start_date > end_date:
+        raise ValueError('Start date has to be before end date')
+
+    # hours carried over from before the start of the series
+    initial = sum(hours for date, hours in deltas.items() if date < start_date)
+
+    dates = list(daterange(start_date, end_date))
+    totals = accumulate([initial] + [deltas.get(date, 0) for date in dates])
+    next(totals)  # skip the carried over hours
+
+    return OrderedDict((str(date), hours) for date, hours in zip(dates, totals))
+
+
+def get_work_summary(user, today=None, num_days=7):
+    """
+    Summarize the user's recent work. Returns a `WorkSummary` of:
+
+    - days: (date, hours) pairs for the past `num_days` days, most recent first.
+    - week_total: the hours worked since the previous saturday.
+    - outstanding: the dates the user still needs to reconcile, most recent first.
+
+    The hours are fetched in a single grouped query of the `UserDayHours` rollup, and
+    the outstanding dates in another via the reminder planner (`tasks.get_reminder_dates`).
+    """
+    if today is None:
+        today = datetime.date.today()
+
+    days = get_past_n_days(today, num_days)
+    week_start = find_previous_saturday(today)
+
+    hours = dict(UserDayHours.objects
+                 .filter(user=user, date__range=(min(days[-1], week_start), today))
+                 .order_by()
+                 .values_list('date')
+                 .annotate(hours=Sum('hours')))
+
+    return WorkSummary(
+        days=[(date, hours.get(date, 0)) for date in days],
+        week_total=sum(value for date, value in hours.items() if date >= week_start),
+        outstanding=get_reminder_dates([user], today)[user.pk],
+    )
+
+
+class Echo(object):
+    """ A file-like object that returns what is written, so csv rows can be streamed """
+
+    def write(self, value):
+        return value
+
+
+class StreamBuffer(object):
+    """
+    An unseekable, write-only file-like object that collects what is written until it
+    is drained. A `ZipFile` written to the buffer can be streamed as it is built.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks, self.size = [], 0
+        return data
+
+
+def stream_csv(labels, rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(labels)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_ndjson(labels, rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(OrderedDict(zip(labels, row))) + '\n'
+
+
+EXPORT_FORMATS = {
+    'csv': stream_csv,
+    'ndjson': stream_ndjson,
+}
+
+
+def export_workitems(queryset, format='csv'):
+    """
+    Yield the work items in the queryset as lines of CSV or newline delimited JSON.
+
+    The rows are read with `iterator()`, so the results are not cached and memory use
+    does not grow with the size of the export. On PostgreSQL, the rows are fetched in
+    chunks from a server-side cursor.
+    """
+    labels, lookups = zip(*WORKITEM_EXPORT_FIELDS)
+    rows = queryset.order_by('pk').values_list(*lookups).iterator()
+
+    return EXPORT_FORMATS[format](labels, rows)
@@ -1,25 +1,41 @@
 import calendar
 import datetime
 import json
+import logging
 import time
+from itertools import islice
 
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.core import serializers
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db.models import Sum
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Sum
 from django.forms.models import modelformset_factory
-from django.http import HttpResponse
+from django.http import (
+    Http404, HttpResponse, JsonResponse, StreamingHttpResponse,
+)
+from django.shortcuts import get_object_or_404, redirect
 from django.utils.decorators import method_decorator
+from django.utils.html import format_html, format_html_join
 from django.views.decorators.csrf import csrf_exempt
-from django.views.generic import RedirectView, TemplateView, View
+from django.views.generic import FormView, RedirectView, TemplateView, View
 
-from .forms import WorkItemBaseFormSet, WorkItemForm
-from .models import Funding, Holiday, Job, WorkItem
-from .tasks import generate_invoice, get_reminder_dates_for_user
+from .caches import (
+    get_holiday_calendar, get_job_menu, get_month_index, get_user_menu,
+)
+from .forms import WeekGridForm, WorkItemBaseFormSet, WorkItemForm
+from .models import InvoiceRun, Job, WorkItem
+from .tasks import build_invoice, generate_invoice, mark_invoiced
+from .utils import (  # noqa: F401
+    find_previous_saturday, get_burndown, get_past_n_days, get_work_summary,
+)
 
 
+logger = logging.getLogger(__name__)
+
 # 'columns' determines the layout of the view table
 _column_layout = [
     # key, title
@@ -36,24 +52,28 @@ def _itercolumns(item):
         yield getattr(item, key)
 
 
-no_reminder_msg = 'There is no stored reminder with the given id.  Perhaps that reminder was already used?'
+def parse_cursor(value):
+    """ Parses a '<date>_<id>' keyset cursor, returning None if it is invalid """
+    try:
+        date, pk = value.split('_')
+        return datetime.datetime.strptime(date, '%Y-%m-%d').date(), int(pk)
+    except (AttributeError, ValueError):
+        return None
 
 
-def find_previous_saturday(date):
-    """ Returns the most recent saturday"""
-    dow = (date.isoweekday() + 1) % 7
-    last_saturday = date - datetime.timedelta(days=dow)
-    return last_saturday
+def make_cursor(item):
+    """ Creates the keyset cursor for a work item """
+    return '{0}_{1}'.format(item.date, item.pk)
 
 
-def get_past_n_days(date, num=7):
-    """ Gets the past [num] days and returns them in a list ordered from most recent to least recent """
-    past_week_dates = []
-    for i in range(0, 7):
-        new_date = date - datetime.timedelta(days=i)
-        past_week_dates.append(new_date)
+no_reminder_msg = 'There is no stored reminder with the given id.  Perhaps that reminder was already used?'
+
 
-    return past_week_dates
+def parse_date(value, format):
+    """ Parses an optional date string, returning None if the value is empty """
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, format).date()
 
 
 def get_total_hours_from_workitems(workitems):
@@ -73,32 +93,25 @@ class HomepageView(LoginRequiredMixin, TemplateView):
         user = self.request.user
         today = datetime.date.today()
 
-        # an ordered dictionary of unreconciled/empty work dates
-        outstanding_work = [
-            date for date in reversed(get_reminder_dates_for_user(user))]
+        summary = get_work_summary(user, today)
 
         past_seven_days = []
-        for date in get_past_n_days(today):
+        for date, hours in summary.days:
             # get the year-month-date representation, strip off the year and
             # any 0's in front of the month
             datestring = "{weekday} {date}".format(
                 weekday=day_list[date.weekday()],
                 date=date.strftime('%m-%d').lstrip('0')
             )
-            # get the total hours for that day's workitems
-            hours = get_total_hours_from_workitems(WorkItem.objects.filter(user=user, date=date))
             # only show the link to the workitem if it's recent and unreconciled
-            show_link = date in outstanding_work
+            show_link = date in summary.outstanding
             # package everything up
             tup = (datestring, date, hours, show_link)
             past_seven_days.append(tup)
 
-        # totals up the hours from last sunday to today for [user] (different from last 7 days)
-        total_hours = get_total_hours_from_workitems(
-            WorkItem.objects.filter(user=user, date__range=(find_previous_saturday(today), today)))
-
         context.update({'past_seven_days': past_seven_days})
-        context.update({'total_hours': total_hours})
+        # totals up the hours from last sunday to today for [user] (different from last 7 days)
+        context.update({'total_hours': summary.week_total})
         return context
 
 
@@ -125,8 +138,6 @@ class WorkItemView(LoginRequiredMixin, TemplateView):
         else:
             date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
 
-        holidays = Holiday.objects.filter(start_date__gte=date, end_date__lte=date)
-
         if datetime.date.today() - date < datetime.timedelta(days=settings.WORKLOG_EMAIL_REMINDERS_EXPIRE_AFTER):
             formset = self.WorkItemFormSet(logged_in_user=user)
             context['open'] = formset
@@ -134,10 +145,50 @@ class WorkItemView(LoginRequiredMixin, TemplateView):
         context['date'] = date
         context['items'] = items
         context['column_names'] = list(t for k, t in _column_layout)
-        context['holidays'] = holidays
+        context['is_holiday'] = get_holiday_calendar().is_holiday(date)
+
+        return context
+
+
+class WeekView(LoginRequiredMixin, FormView):
+    """
+    Enter a week of work at once, as a grid of jobs and days. The week starts on the
+    saturday before the given date.
+    """
+    template_name = 'worklog/weekform.html'
+    form_class = WeekGridForm
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            date = datetime.datetime.strptime(kwargs['date'], '%Y-%m-%d').date()
+        except ValueError:
+            raise Http404('Invalid date')
+
+        start = find_previous_saturday(date)
+        self.days = [start + datetime.timedelta(days=i) for i in range(7)]
+        return super(WeekView, self).dispatch(request, *args, **kwargs)
+
+    def get_form_kwargs(self):
+        kwargs = super(WeekView, self).get_form_kwargs()
+        kwargs.update(user=self.request.user, days=self.days)
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        context = super(WeekView, self).get_context_data(**kwargs)
+        start = self.days[0]
+
+        holiday_calendar = get_holiday_calendar()
+        context['holidays'] = {day for day in self.days if holiday_calendar.is_holiday(day)}
+        context['days'] = self.days
+        context['previous_week'] = start - datetime.timedelta(days=7)
+        context['next_week'] = start + datetime.timedelta(days=7)
 
         return context
 
+    def form_valid(self, form):
+        form.save()
+        return redirect(self.request.path)
+
 
 class CurrentDateRedirectView(RedirectView):
     permanent = False
@@ -295,13 +346,19 @@ class WorkViewer(object):
             items = filter.apply_filter(items)
         return items
 
+    def get_query_string(self, **params):
+        """ Returns the current queries, along with any additional parameters """
+        queries = list(self.current_queries.values())
+        queries += ["{0}={1}".format(key, value) for key, value in sorted(params.items())]
+        return '&'.join(queries)
+
     def build_user_links(self):
         # The basequery includes all current queries except for 'user'
         basequery = '&'.join(v for k, v in self.current_queries.items() if k != "user")
         alllink = (basequery, 'all users')
         if basequery:
             basequery += '&'
-        links = list(("{1}user={0}".format(user.pk, basequery), user.username) for user in User.objects.all())
+        links = list(("{1}user={0}".format(pk, basequery), username) for pk, username in get_user_menu())
         links = [alllink] + links
         self.menu.submenus.append(WorkViewMenu.SubMenu("User", links))
 
@@ -311,13 +368,8 @@ class WorkViewer(object):
         if basequery:
             basequery += '&'
 
-        # get all dates
-        values_list = WorkItem.objects.values_list('date', flat=True)
-        # Strip the day from dates and remove duplicates.
-        unique_dates = list(set(val.replace(day=1) for val in values_list if isinstance(val, datetime.date)))
-        # Sort so most recent date is at the top.
-        unique_dates.sort(reverse=True)
-        ranges = list(make_month_range(x) for x in unique_dates)
+        # months with work items, with the most recent month at the top.
+        ranges = list(make_month_range(x) for x in get_month_index())
 
         links = list(("{2}datemin={0}&datemax={1}".format(a, b, basequery), a.strftime('%Y %B')) for a, b in ranges)
         links = [alllink] + links
@@ -328,7 +380,7 @@ class WorkViewer(object):
         alllink = (basequery, 'all jobs')
         if basequery:
             basequery += '&'
-        links = list(("{1}job={0}".format(job.pk, basequery), job.name) for job in Job.objects.all())
+        links = list(("{1}job={0}".format(pk, basequery), name) for pk, name in get_job_menu())
         links = [alllink] + links
         self.menu.submenus.append(WorkViewMenu.SubMenu("Job", links))
 
@@ -336,9 +388,15 @@ class WorkViewer(object):
 class WorklogView(LoginRequiredMixin, TemplateView):
     template_name = 'worklog/viewwork.html'
     data_template = 'worklog/viewwork_data.html'
+    paginate_by = 100
+    export_chunk_size = 500
 
-    def get_context_data(self, **kwargs):
-        context = super(WorklogView, self).get_context_data(**kwargs)
+    def get(self, request, *args, **kwargs):
+        if 'export' in request.GET:
+            return self.export(self.get_viewer(**kwargs))
+        return super(WorklogView, self).get(request, *args, **kwargs)
+
+    def get_viewer(self, **kwargs):
         datemin = kwargs.get('datemin', None)
         datemax = kwargs.get('datemax', None)
         username = kwargs.get('username', None)
@@ -348,10 +406,76 @@ class WorklogView(LoginRequiredMixin, TemplateView):
         if datemax == 'today':
             datemax = datetime.date.today()
 
-        viewer = WorkViewer(self.request, username, datemin, datemax)
+        return WorkViewer(self.request, username, datemin, datemax)
+
+    def get_queryset(self, viewer):
+        items = WorkItem.objects.select_related('user', 'job')
+        return viewer.filter_items(items)
+
+    def paginate_items(self, items):
+        """
+        Seek (keyset) pagination over (date, id), with the most recent items first.
+        Returns the page of items and the cursors for the next and previous pages.
+        """
+        size = self.paginate_by
+        after = parse_cursor(self.request.GET.get('after'))
+        before = parse_cursor(self.request.GET.get('before'))
+
+        if before is not None:
+            date, pk = before
+            items = items.filter(Q(date__gt=date) | Q(date=date, pk__gt=pk))
+            page = list(items.order_by('date', 'pk')[:size + 1])
+
+            has_previous, has_next = len(page) > size, True
+            page = page[:size][::-1]
+        else:
+            if after is not None:
+                date, pk = after
+                items = items.filter(Q(date__lt=date) | Q(date=date, pk__lt=pk))
+            page = list(items.order_by('-date', '-pk')[:size + 1])
+
+            has_previous, has_next = after is not None, len(page) > size
+            page = page[:size]
+
+        next_cursor = make_cursor(page[-1]) if page and has_next else None
+        previous_cursor = make_cursor(page[0]) if page and has_previous else None
+
+        return page, next_cursor, previous_cursor
+
+    def export(self, viewer):
+        """
+        Streams the full table of matching work items, rendering the rows in chunks
+        rather than materialising the whole queryset.
+        """
+        items = self.get_queryset(viewer).order_by('-date', '-pk').iterator()
+
+        def rows():
+            yield '<table class="table table-bordered"><thead><tr>'
+            yield format_html_join('', '<th>{}</th>', ((title, ) for key, title in _column_layout))
+            yield '</tr></thead><tbody>'
+
+            while True:
+                chunk = list(islice(items, self.export_chunk_size))
+                if not chunk:
+                    break
 
-        items = WorkItem.objects.all()
-        items = viewer.filter_items(items).order_by('-date')
+                yield ''.join(
+                    format_html('<tr>{}</tr>', format_html_join('', '<td>{}</td>', ((v, ) for v in _itercolumns(item))))
+                    for item in chunk
+                )
+
+            yield '</tbody></table>'
+
+        return StreamingHttpResponse(rows(), content_type='text/html; charset=utf-8')
+
+    def get_context_data(self, **kwargs):
+        context = super(WorklogView, self).get_context_data(**kwargs)
+        datemin = kwargs.get('datemin', None)
+        datemax = kwargs.get('datemax', None)
+        username = kwargs.get('username', None)
+
+        viewer = self.get_viewer(**kwargs)
+        items, next_cursor, previous_cursor = self.paginate_items(self.get_queryset(viewer))
 
         menulink_base = ''
         if username is not None:
@@ -361,6 +485,9 @@ class WorklogView(LoginRequiredMixin, TemplateView):
             menulink_base += '../'
 
         context['items'] = items
+        context['next_query'] = viewer.get_query_string(after=next_cursor) if next_cursor else None
+        context['previous_query'] = viewer.get_query_string(before=previous_cursor) if previous_cursor else None
+        context['export_query'] = viewer.get_query_string(export=1)
         context['filtermenu'] = viewer.menu
         context['menulink_base'] = menulink_base
         context['current_filters'] = viewer.query_info
@@ -391,7 +518,37 @@ class ReportView(LoginRequiredMixin, TemplateView):
         else:
             date = str(datetime.date.today())
 
-        return self.render_to_response({'date': date})
+        return self.render_to_response({'date': date, 'run': self.get_invoice_run(date)})
+
+    def get_invoice_run(self, date):
+        try:
+            return InvoiceRun.objects.filter(date=date).order_by('-pk').first()
+        except ValidationError:
+            return None
+
+    def start_invoice_run(self, date):
+        """
+        Start marking the items billed on the date as invoiced in the background, unless
+        a run for the date is already in progress. A run that is still in progress after
+        `WORKLOG_INVOICE_RUN_TIMEOUT` seconds is assumed lost, and is marked as failed.
+        """
+        try:
+            with transaction.atomic():
+                InvoiceRun.objects.filter(date=date).stale().fail()
+                run = InvoiceRun.objects.create(date=date)
+                transaction.on_commit(lambda: self.enqueue_invoice_run(run))
+        except IntegrityError:
+            return self.get_invoice_run(date)
+
+        return run
+
+    def enqueue_invoice_run(self, run):
+        try:
+            mark_invoiced.delay(run.pk)
+        except Exception:
+            logger.exception("Could not start the invoice run for %s.", run.date)
+            InvoiceRun.objects.filter(pk=run.pk).fail()
+            run.state, run.active = InvoiceRun.STATES.FAILED, None
 
     def post(self, request, *args, **kwargs):
         date = request.POST['date']
@@ -400,19 +557,22 @@ class ReportView(LoginRequiredMixin, TemplateView):
             generate_invoice.delay(date)
             # send_task("tasks.generate_invoice")
             return self.render_to_response({'generated': True, 'date': date})
-        elif 'invoice' in request.POST:
-            jobs = Job.objects.filter(billing_schedule__date=date)
-
-            for job in jobs:
-                work_items = WorkItem.objects.filter(
-                    job=job, invoiced=False, date__lt=date).exclude(job__invoiceable=False)
-                for items in work_items:
-                    items.invoiced = True
-                    items.save()
-            return self.render_to_response({'invoiced': True, 'date': date})
-        else:
+        elif 'preview' not in request.POST and 'invoice' not in request.POST:
             return self.render_to_response(self.get_context_data(**kwargs))
 
+        try:
+            invoice_date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+        except ValueError:
+            return self.render_to_response({
+                'error': 'Date not correct format: yyyy-mm-dd.',
+                'date': date
+            })
+
+        if 'preview' in request.POST:
+            return self.render_to_response({'preview': build_invoice(invoice_date), 'date': date})
+
+        return self.render_to_response({'run': self.start_invoice_run(invoice_date), 'date': date})
+
     def render_to_response(self, context):
         return TemplateView.render_to_response(self, context)
 
@@ -448,10 +608,8 @@ class ChartView(LoginRequiredMixin, TemplateView):
         else:
             return self.render_to_response(context)
 
-    def post(self, request, *args, **kwargs):  # noqa: C901
+    def post(self, request, *args, **kwargs):
         job_id = request.POST['job_id']
-        start_date = None
-        end_date = None
 
         # Make sure the use selected a job
         if job_id == '-1':
@@ -463,158 +621,23 @@ class ChartView(LoginRequiredMixin, TemplateView):
         except Exception:
             return self.error('Job with id %s does not exist' % job_id)
 
-        if job is not None:
-            data = {}
-            start_date = None
-            end_date = None
+        # Try to convert the dates given
+        try:
+            start_date = parse_date(request.POST.get('start_date'), '%m/%d/%Y')
+        except ValueError:
+            return self.error('Enter a valid date format for the start date')
 
-            if job.hasFunding():
-                funding = Funding.objects.filter(job=job)
-            else:
-                funding = None
+        try:
+            end_date = parse_date(request.POST.get('end_date'), '%m/%d/%Y')
+        except ValueError:
+            return self.error('Enter a valid date format for the end date')
 
-            if job.hasWork():
-                work_items = WorkItem.objects.filter(job=job)
-            else:
-                work_items = None
-
-            # Try to convert the dates given
-            if 'start_date' in request.POST:
-                if len(request.POST['start_date']) > 0:
-                    try:
-                        start_date = datetime.datetime.strptime(
-                            request.POST['start_date'], '%m/%d/%Y').date()
-                    except ValueError:
-                        return self.error('Enter a valid date format for the start date')
-                else:
-                    if funding is None and work_items is None:
-                        return self.error('There is no work or funding available for job %s' % job)
-                    else:
-                        if funding is not None:
-                            first_funding = funding.order_by(
-                                'date_available')[0].date_available
-                        else:
-                            first_funding = None
-
-                        if work_items is not None:
-                            first_work = work_items.order_by('date')[0].date
-                        else:
-                            first_work = None
-
-                    if first_work is not None and first_funding is not None:
-                        if first_work > first_funding:
-                            start_date = first_funding
-                        else:
-                            start_date = first_work
-                    elif first_work is None and first_funding is not None:
-                        start_date = first_funding
-                    elif first_work is not None and first_funding is None:
-                        start_date = first_work
-                    else:
-                        return self.error('There is no work or funding available for job %s' % job)
-
-            if 'end_date' in request.POST:
-                if len(request.POST['end_date']) > 0:
-                    try:
-                        end_date = datetime.datetime.strptime(
-                            request.POST['end_date'], '%m/%d/%Y').date()
-                    except ValueError:
-                        return self.error('Enter a valid date format for the end date')
-                else:
-                    if funding is None and work_items is None:
-                        return self.error('There is no work or funding available for job %s' % job)
-                    else:
-                        if funding is not None:
-                            last_funding = funding.latest('date_available').date_available
-                        else:
-                            last_funding = None
-
-                        if work_items is not None:
-                            last_work = work_items.latest('date').date
-                        else:
-                            last_work = None
-
-                    if last_work is not None and last_funding is not None:
-                        if last_work < last_funding:
-                            end_date = last_funding
-                        else:
-                            end_date = last_work
-                    elif last_work is None and last_funding is not None:
-                        end_date = last_funding
-                    elif last_work is not None and last_funding is None:
-                        end_date = last_work
-                    else:
-                        return self.error('There is no work or funding available for job %s' % job)
-
-            # If, somehow, the dates were not set, do not continue
-            if start_date is not None and end_date is not None:
-                hours = 0
-
-                date = start_date
-                days = (end_date - start_date).days
-
-                # Make sure the dates were in a valid order
-                if days < 0:
-                    return self.error('Start date has to be before end date')
-                else:
-                    # We need to calculate the hours since the first available funding
-                    # or first work item
-                    if work_items is not None:
-                        work_date = work_items.order_by('date')[0].date
-                    else:
-                        work_date = None
-
-                    if funding is not None:
-                        funding_date = funding.order_by('date_available')[0].date_available
-                    else:
-                        funding_date = None
-
-                    if work_date is not None and funding_date is not None:
-                        if funding_date < work_date:
-                            initial_date = funding_date
-                        else:
-                            initial_date = work_date
-                    elif funding_date is None and work_date is not None:
-                        initial_date = work_date
-                    elif work_date is None and funding_date is not None:
-                        initial_date = funding_date
-                    else:
-                        return self.error('There is no work or funding available for job %s' % job)
-
-                    initial_days = (start_date - initial_date).days
-
-                    # If we have a difference between the initial date and start date
-                    # then we need to calculate up to the initial days
-                    if initial_days > 0:
-                        for n in range(initial_days):
-                            if work_items is not None:
-                                for work_item in work_items.filter(date=initial_date):
-                                    hours -= work_item.hours
-
-                            if funding is not None:
-                                for funds in funding.filter(date_available=initial_date):
-                                    hours += funds.hours
-
-                            initial_date += datetime.timedelta(days=1)
-
-                    # Loop through and calculate the hours for each day
-                    for n in range(days + 1):
-                        if work_items is not None:
-                            for work_item in work_items.filter(date=date):
-                                hours -= work_item.hours
-
-                        if funding is not None:
-                            for funds in funding.filter(date_available=date):
-                                hours += funds.hours
-
-                        data[str(date)] = hours
-                        date += datetime.timedelta(days=1)
-
-                    return HttpResponse(json.dumps(data), content_type='application/json')
-            else:
-                return self.error('Dates could not be processed')
-        else:
-            return self.error('That job does not exist')
+        try:
+            data = get_burndown(job, start_date, end_date)
+        except ValueError as e:
+            return self.error(str(e))
+
+        return HttpResponse(json.dumps(data), content_type='application/json')
 
     def error(self, message):
         error = {}
@@ -634,6 +657,25 @@ class ChartView(LoginRequiredMixin, TemplateView):
         return TemplateView.render_to_response(self, context)
 
 
+class BurndownView(LoginRequiredMixin, View):
+    """
+    JSON endpoint for a job's burn-down series. Accepts optional `start_date` and
+    `end_date` query parameters (yyyy-mm-dd), and returns the same data as the chart.
+    """
+
+    def get(self, request, *args, **kwargs):
+        job = get_object_or_404(Job, pk=kwargs['pk'])
+
+        try:
+            start_date = parse_date(request.GET.get('start_date'), '%Y-%m-%d')
+            end_date = parse_date(request.GET.get('end_date'), '%Y-%m-%d')
+            data = get_burndown(job, start_date, end_date)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        return JsonResponse(data)
+
+
 class JobDataView(LoginRequiredMixin, View):
 
     @method_decorator(csrf_exempt)
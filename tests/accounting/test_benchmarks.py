@@ -0,0 +1,81 @@
+import os
+import time
+from datetime import date, timedelta
+from unittest import mock, skipUnless
+
+from django.contrib.auth import get_user_model
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from labsite.accounting import models
+from labsite.accounting.views import ContractCtxMixin
+
+
+@skipUnless(os.environ.get('LABSITE_BENCHMARKS'), "set LABSITE_BENCHMARKS=1 to run the benchmarks")
+class ContractsBenchmark(TestCase):
+    """
+    Times the contracts page of a business unit with 1,000 contracts of three invoices
+    each, with and without the invoices prefetched.
+    """
+    contracts = 1000
+    invoices = 3
+    repeat = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.business_unit = models.BusinessUnit.objects.create(name='Unit', account_number='1234')
+
+        states = list(models.Contract.STATES.keys())
+        models.Contract.objects.bulk_create(
+            models.Contract(
+                business_unit=cls.business_unit, contract_id='C%d' % i, name='C%d' % i, amount=300,
+                start_date=date(2017, 1, 1), type=models.Contract.TYPES.FIXED, state=states[i % len(states)],
+            )
+            for i in range(cls.contracts)
+        )
+
+        invoices = []
+        for contract in models.Contract.objects.all():
+            for i in range(cls.invoices):
+                day = date(2017, 1, 1) + timedelta(days=30 * i)
+                invoices.append(models.Invoice(
+                    business_unit=cls.business_unit, contract=contract, expected_amount=100,
+                    expected_invoice_date=day, expected_payment_date=day,
+                    state=models.Invoice.STATES.RECEIVED if i == 0 else models.Invoice.STATES.NOT_INVOICED,
+                    actual_amount=100 if i == 0 else None,
+                ))
+        models.Invoice.objects.bulk_create(invoices)
+
+    def time_page(self):
+        url = reverse('accounting:contracts', kwargs={'business_unit': self.business_unit.pk})
+        self.client.get(url)
+
+        best = None
+        for _ in range(self.repeat):
+            # a full query log stops counting
+            connection.queries_log.clear()
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = self.client.get(url)
+                elapsed = time.perf_counter() - start
+
+            self.assertEqual(response.status_code, 200)
+            best = elapsed if best is None else min(best, elapsed)
+
+        return best, len(context)
+
+    def test_contracts(self):
+        self.client.force_login(self.user)
+
+        def get_contracts(view):
+            return models.Contract.objects.filter(business_unit=view.current_business_unit)
+
+        with mock.patch.object(ContractCtxMixin, 'get_contracts', get_contracts):
+            unprefetched = self.time_page()
+        prefetched = self.time_page()
+
+        for label, (elapsed, queries) in [('not prefetched', unprefetched), ('prefetched', prefetched)]:
+            print('\ncontracts page, %s: %.0f ms, %d queries' % (label, elapsed * 1000, queries))
@@ -0,0 +1,82 @@
+from django.test import TestCase
+
+from labsite.accounting import forms, models
+from labsite.accounting.utils import FiscalCalendar, Month
+
+
+class MonthlyBalanceFormTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.business_unit = models.BusinessUnit.objects.create(name='Unit', account_number='1234')
+        cls.other = models.BusinessUnit.objects.create(name='Other', account_number='5678')
+
+    def setUp(self):
+        models.Expenses.objects.create(business_unit=self.business_unit, year=2017, month=9, expected_amount=100)
+        models.Expenses.objects.create(business_unit=self.business_unit, year=2017, month=10, expected_amount=200)
+        models.CashBalance.objects.create(business_unit=self.business_unit, year=2017, month=8, actual_amount=1000)
+        models.CashBalance.objects.create(business_unit=self.business_unit, year=2017, month=9)
+
+        # the other business unit's balances share the same months
+        models.Expenses.objects.create(business_unit=self.other, year=2017, month=9, expected_amount=999)
+        models.CashBalance.objects.create(business_unit=self.other, year=2017, month=8, actual_amount=999)
+
+    def get_form(self, **changes):
+        kwargs = {
+            'business_unit': self.business_unit,
+            'billing_month': Month(2017, 9),
+            'fiscal_months': FiscalCalendar(2018).months,
+        }
+        if not changes:
+            return forms.MonthlyBalanceForm(**kwargs)
+
+        initial = forms.MonthlyBalanceForm(**kwargs)
+        data = {name: '' if field.initial is None else str(field.initial) for name, field in initial.fields.items()}
+        data.update(changes)
+        return forms.MonthlyBalanceForm(data=data, **kwargs)
+
+    def get_values(self, form, month):
+        data = next(data for data in form.month_data if data['month'] == month)
+        return [field.value() if hasattr(field, 'value') else field for field in data['fields']]
+
+    def test_month_data(self):
+        form = self.get_form()
+        self.assertEqual(self.get_values(form, Month(2017, 9))[:2], [100, None])
+        self.assertEqual(self.get_values(form, Month(2017, 10))[0], 200)
+
+        # the expected cash balances are looked up in bulk
+        self.assertIn('900.00', self.get_values(form, Month(2017, 9))[6])
+
+        with self.assertNumQueries(6):
+            self.get_form()
+
+    def test_save(self):
+        form = self.get_form(**{
+            '2017_09_exp_expected': '150',
+            '2017_09_exp_actual': '120',
+            '2017_10_exp_expected': '',
+            '2017_11_permp_expected': '300',
+            '2017_09_bal_actual': '5,000',
+        })
+        self.assertTrue(form.is_valid(), form.errors)
+
+        saved = form.save()
+        self.assertEqual(len(saved), 4)
+
+        expenses = models.Expenses.objects.get(business_unit=self.business_unit, year=2017, month=9)
+        self.assertEqual((expenses.expected_amount, expenses.actual_amount), (150, 120))
+        self.assertFalse(models.Expenses.objects.filter(business_unit=self.business_unit, year=2017, month=10).exists())
+        self.assertEqual(models.TemporaryPayroll.objects.get(year=2017, month=11).expected_amount, 300)
+        self.assertEqual(models.CashBalance.objects.get(business_unit=self.business_unit, month=9).actual_amount, 5000)
+        self.assertEqual(models.Expenses.objects.get(business_unit=self.other).expected_amount, 999)
+
+        # the snapshots are invalidated
+        self.assertIn('850.00', self.get_values(self.get_form(), Month(2017, 9))[6])
+
+    def test_reconcile(self):
+        form = self.get_form()
+        data = {'month': 8, 'year': 2017, 'business_unit': self.business_unit.pk}
+        reconcile_form = forms.MonthlyReconcileForm(dirty=False, data=data, balances=form.balances)
+
+        self.assertFalse(reconcile_form.is_valid())
+        self.assertEqual(reconcile_form.errors.as_data()['__all__'][0].code, 'incomplete')
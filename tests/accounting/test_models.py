@@ -0,0 +1,129 @@
+from datetime import date
+
+from django.test import TestCase
+
+from labsite.accounting import models
+from labsite.accounting.utils import Month
+
+
+class CashBalanceSnapshotTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.business_unit = models.BusinessUnit.objects.create(name='Unit', account_number='1234')
+        cls.other = models.BusinessUnit.objects.create(name='Other', account_number='5678')
+
+    def setUp(self):
+        self.contract = self.create_contract('C1', models.Contract.STATES.ACTIVE)
+
+        models.CashBalance.objects.create(business_unit=self.business_unit, year=2017, month=1, actual_amount=1000)
+        models.Expenses.objects.create(business_unit=self.business_unit, year=2017, month=2, expected_amount=100)
+        self.invoice = self.create_invoice(self.contract, date(2017, 3, 10), 500)
+        models.PermanentPayroll.objects.create(business_unit=self.business_unit, year=2017, month=5, expected_amount=50)
+
+    def create_contract(self, contract_id, state):
+        return models.Contract.objects.create(
+            business_unit=self.business_unit, contract_id=contract_id, name=contract_id,
+            start_date=date(2017, 1, 1), type=models.Contract.TYPES.FIXED, state=state,
+        )
+
+    def create_invoice(self, contract, payment_date, amount):
+        return models.Invoice.objects.create(
+            business_unit=self.business_unit, contract=contract, expected_amount=amount,
+            expected_invoice_date=payment_date, expected_payment_date=payment_date,
+        )
+
+    def get_amounts(self, stop=Month(2017, 6)):
+        return [
+            models.CashBalanceSnapshot.objects.get_expected_amount(self.business_unit, month)
+            for month in Month.range(Month(2016, 12), Month.next(stop))
+        ]
+
+    def get_snapshot_months(self):
+        return [Month(snapshot) for snapshot in models.CashBalanceSnapshot.objects.order_by('year', 'month')]
+
+    def assertSnapshotsCurrent(self):
+        amounts = self.get_amounts()
+        models.CashBalanceSnapshot.objects.all().delete()
+        self.assertEqual(amounts, self.get_amounts())
+        return amounts
+
+    def test_running_balance(self):
+        # the balance carries over the months without a cash balance
+        self.assertEqual(self.assertSnapshotsCurrent(), [0, 0, 900, 1400, 1400, 1350, 1350])
+
+        # and prefers the actual over the expected balance
+        models.CashBalance.objects.create(business_unit=self.business_unit, year=2017, month=3, actual_amount=1200)
+        self.assertEqual(self.assertSnapshotsCurrent(), [0, 0, 900, 1400, 1200, 1150, 1150])
+
+        balance = models.CashBalance.objects.get(year=2017, month=3)
+        self.assertEqual(balance.expected_amount, 1400)
+
+        # other business units have their own balances
+        self.assertEqual(models.CashBalanceSnapshot.objects.get_expected_amount(self.other, Month(2017, 6)), 0)
+
+    def test_single_lookup(self):
+        self.get_amounts()
+        snapshots = models.CashBalanceSnapshot.objects
+
+        with self.assertNumQueries(1):
+            self.assertEqual(snapshots.get_expected_amount(self.business_unit, Month(2017, 6)), 1350)
+
+        # later months continue on from the latest snapshot, with a query for each of the balances,
+        # and lock the business unit while the snapshots are computed
+        with self.assertNumQueries(13):
+            self.assertEqual(snapshots.get_expected_amount(self.business_unit, Month(2018, 6)), 1350)
+
+    def test_missing_month(self):
+        self.get_amounts()
+
+        # a snapshot computed from stale balances follows a missing month
+        snapshots = models.CashBalanceSnapshot.objects.filter(business_unit=self.business_unit)
+        snapshots.filter(year=2017, month=3).delete()
+        snapshots.filter(year=2017, month=5).update(expected_amount=0)
+
+        self.assertEqual(self.get_amounts(), [0, 0, 900, 1400, 1400, 1350, 1350])
+        self.assertEqual(self.get_snapshot_months(), Month.range(Month(2017, 1), Month(2017, 7)))
+
+    def test_invoice(self):
+        self.get_amounts()
+
+        self.invoice.expected_payment_date = date(2017, 4, 10)
+        self.invoice.save()
+        self.assertEqual(self.get_snapshot_months(), Month.range(Month(2017, 1), Month(2017, 3)))
+        self.assertEqual(self.assertSnapshotsCurrent(), [0, 0, 900, 900, 1400, 1350, 1350])
+
+        # an earlier invoice invalidates all of the snapshots
+        self.create_invoice(self.contract, date(2016, 12, 1), 25)
+        self.assertEqual(self.get_snapshot_months(), [])
+        self.assertEqual(self.assertSnapshotsCurrent(), [25, 25, 900, 900, 1400, 1350, 1350])
+
+        self.invoice.delete()
+        self.assertEqual(self.assertSnapshotsCurrent(), [25, 25, 900, 900, 900, 850, 850])
+
+    def test_contract_state(self):
+        contract = self.create_contract('C2', models.Contract.STATES.NEW)
+        self.create_invoice(contract, date(2017, 5, 1), 200)
+        self.assertEqual(self.get_amounts()[-1], 1350)
+
+        contract.state = models.Contract.STATES.ACTIVE
+        contract.save()
+        self.assertEqual(self.get_snapshot_months(), Month.range(Month(2017, 1), Month(2017, 5)))
+        self.assertEqual(self.assertSnapshotsCurrent()[-1], 1550)
+
+    def test_monthly_balance(self):
+        self.get_amounts()
+
+        expenses = models.Expenses.objects.get(year=2017, month=2)
+        expenses.actual_amount = 90
+        expenses.save()
+        self.assertEqual(len(self.get_snapshot_months()), 6)
+
+        expenses.expected_amount = 150
+        expenses.save(update_fields=['expected_amount'])
+        self.assertEqual(self.get_snapshot_months(), [Month(2017, 1)])
+        self.assertEqual(self.assertSnapshotsCurrent(), [0, 0, 850, 1350, 1350, 1300, 1300])
+
+        models.PermanentPayroll.objects.get(year=2017, month=5).delete()
+        self.assertEqual(self.get_snapshot_months(), Month.range(Month(2017, 1), Month(2017, 5)))
+        self.assertEqual(self.assertSnapshotsCurrent()[-1], 1350)
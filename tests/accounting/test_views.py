@@ -0,0 +1,256 @@
+from datetime import date
+
+from django.contrib.auth import get_user_model
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from labsite.accounting import models
+from labsite.accounting.utils import FiscalCalendar, Month
+
+
+class DashboardViewTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username='viewer', password='password')
+        cls.business_unit = models.BusinessUnit.objects.create(name='Unit', account_number='1234')
+        models.UserTeamRole.objects.create(user=cls.user, business_unit=cls.business_unit)
+
+        cls.contract = cls.create_contract('C1', models.Contract.STATES.ACTIVE)
+        cls.create_invoice(
+            cls.contract, date(2017, 7, 15), 500, actual_payment_date=date(2017, 8, 2), actual_amount=450,
+        )
+        cls.create_invoice(cls.contract, date(2017, 9, 1), 300)
+
+        # invoices of new contracts are not expected to be paid
+        cls.create_invoice(cls.create_contract('C2', models.Contract.STATES.NEW), date(2017, 7, 15), 1000)
+
+        cls.create_balance(models.CashBalance, 2017, 6, actual_amount=1000)
+        cls.create_balance(models.CashBalance, 2017, 9, actual_amount=2000)
+        cls.create_balance(models.Expenses, 2017, 8, expected_amount=100)
+        cls.create_balance(models.PermanentPayroll, 2017, 8, expected_amount=200, actual_amount=210)
+
+    @classmethod
+    def create_contract(cls, contract_id, state):
+        return models.Contract.objects.create(
+            business_unit=cls.business_unit, contract_id=contract_id, name=contract_id,
+            start_date=date(2017, 7, 1), type=models.Contract.TYPES.FIXED, state=state,
+        )
+
+    @classmethod
+    def create_invoice(cls, contract, payment_date, amount, **kwargs):
+        return models.Invoice.objects.create(
+            business_unit=cls.business_unit, contract=contract, expected_amount=amount,
+            expected_invoice_date=payment_date, expected_payment_date=payment_date, **kwargs
+        )
+
+    @classmethod
+    def create_balance(cls, model, year, month, expected_amount=0, **kwargs):
+        if model is not models.CashBalance:
+            kwargs['expected_amount'] = expected_amount
+        return model.objects.create(business_unit=cls.business_unit, year=year, month=month, **kwargs)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.url = reverse('accounting:dashboard', kwargs={'business_unit': self.business_unit.pk, 'fiscal_year': 2018})
+
+    def get(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        return response.context, len(context)
+
+    def test_balances(self):
+        context, _ = self.get()
+        balances = context['balances']
+
+        invoices = balances['Invoices']
+        self.assertEqual(invoices[0], (500, 0))
+        self.assertEqual(invoices[1], (0, 450))
+        self.assertEqual(invoices[2], (300, 0))
+        self.assertEqual(balances['Permanent Payroll'][1].actual_amount, 210)
+        self.assertIsNone(balances['Expenses'][0].pk)
+
+        groups = [group for group, _ in context['invoice_groups_and_totals']]
+        self.assertEqual([len(group) for group in groups[:3]], [1, 0, 1])
+
+        # the cash balances match the stored snapshots
+        expected = [
+            models.CashBalance(business_unit=self.business_unit, year=month.year, month=month.month).expected_amount
+            for month in FiscalCalendar(2018).months
+        ]
+        self.assertEqual([balance.expected_amount for balance in balances['Cash Balance']], expected)
+        self.assertEqual(expected[:3], [1500, 1200, 1500])
+        self.assertEqual(context['expected_totals'], '[%s]' % ', '.join('%d' % amount for amount in expected))
+
+    def test_unreconciled_opening_balance(self):
+        models.CashBalance.objects.filter(year=2017, month=6).update(actual_amount=None)
+        self.create_invoice(self.contract, date(2017, 6, 1), 50)
+
+        context, _ = self.get()
+        self.assertEqual(context['balances']['Cash Balance'][0].expected_amount, 550)
+
+    def test_constant_queries(self):
+        self.get()
+
+        # the session and user, the role with its business unit, the invoices, the four monthly balances,
+        # the opening balance, the billing month and the business unit menu.
+        _, count = self.get()
+        self.assertEqual(count, 11)
+
+        for month in Month.range(Month(2017, 7), Month(2018, 7)):
+            for day in [3, 4]:
+                self.create_invoice(self.contract, date(month.year, month.month, day), 10)
+
+            if not models.Expenses.objects.filter(year=month.year, month=month.month).exists():
+                self.create_balance(models.Expenses, month.year, month.month, expected_amount=5)
+                self.create_balance(models.TemporaryPayroll, month.year, month.month, expected_amount=5)
+
+        context, queries = self.get()
+        self.assertEqual(queries, count)
+        self.assertEqual(sum(len(group) for group, _ in context['invoice_groups_and_totals']), 26)
+
+
+class ProspectsViewTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username='viewer', password='password')
+        cls.business_unit = models.BusinessUnit.objects.create(name='Unit', account_number='1234')
+        models.UserTeamRole.objects.create(user=cls.user, business_unit=cls.business_unit)
+
+        models.CashBalance.objects.create(business_unit=cls.business_unit, year=2010, month=1, actual_amount=1000)
+        models.Expenses.objects.create(business_unit=cls.business_unit, year=2017, month=8, expected_amount=100)
+
+    def test_projected_balance(self):
+        self.client.force_login(self.user)
+        url = reverse('accounting:prospects', kwargs={'business_unit': self.business_unit.pk})
+
+        response = self.client.get(url)
+        self.assertEqual(response.context['proj_eofy_balance'], 900)
+
+
+class ContractsViewTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username='viewer', password='password')
+        cls.business_unit = models.BusinessUnit.objects.create(name='Unit', account_number='1234')
+        models.UserTeamRole.objects.create(user=cls.user, business_unit=cls.business_unit)
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.url = reverse('accounting:contracts', kwargs={'business_unit': self.business_unit.pk})
+
+        self.contract = self.create_contract('C1', models.Contract.STATES.ACTIVE, amount=300)
+        for month, state in [(1, 'RECEIVED'), (2, 'RECEIVED'), (3, 'INVOICED')]:
+            models.Invoice.objects.create(
+                business_unit=self.business_unit, contract=self.contract, expected_amount=100, state=state,
+                expected_invoice_date=date(2017, month, 1), expected_payment_date=date(2017, month, 1),
+                actual_amount=90 if state == 'RECEIVED' else None,
+            )
+
+    def create_contract(self, contract_id, state, amount=0):
+        return models.Contract.objects.create(
+            business_unit=self.business_unit, contract_id=contract_id, name=contract_id, amount=amount,
+            start_date=date(2017, 1, 1), type=models.Contract.TYPES.FIXED, state=state,
+        )
+
+    def test_contracts(self):
+        self.create_contract('C2', models.Contract.STATES.NEW)
+        response = self.client.get(self.url)
+
+        self.assertTrue(response.context['has_contracts'])
+        self.assertEqual([ctx['contract'].contract_id for ctx in response.context['new_contracts']], ['C2'])
+        self.assertEqual(response.context['completed_contracts'], [])
+
+        contract_ctx = response.context['active_contracts'][0]
+        self.assertEqual(contract_ctx['outstanding_amount'], self.contract.outstanding_amount())
+        self.assertEqual(contract_ctx['outstanding_amount'], 120)
+
+        # the invoices are ordered, and the formatted urls match the reversed urls
+        invoice = contract_ctx['invoices'][0]['invoice']
+        self.assertEqual(invoice.expected_invoice_date, date(2017, 3, 1))
+
+        url_kwargs = {'business_unit': self.business_unit.pk, 'contract': self.contract.pk}
+        self.assertEqual(contract_ctx['detail_url'], reverse('accounting:contract_detail', kwargs=url_kwargs))
+        self.assertEqual(contract_ctx['update_url'], reverse('accounting:update_contract', kwargs=url_kwargs))
+
+        url_kwargs['invoice'] = invoice.pk
+        print_url = reverse('accounting:print_invoice', kwargs=url_kwargs)
+        self.assertEqual(contract_ctx['invoices'][0]['print_url'], print_url)
+
+    def test_detail(self):
+        models.UserTeamRole.objects.filter(user=self.user).update(role=models.UserTeamRole.ROLES.MANAGER)
+        url = reverse('accounting:contract_detail', kwargs={
+            'business_unit': self.business_unit.pk, 'contract': self.contract.pk,
+        })
+
+        response = self.client.get(url)
+        self.assertEqual(len(response.context['contract_ctx']['invoices']), 3)
+        self.assertContains(response, response.context['contract_ctx']['invoices'][0]['print_url'])
+
+    def test_constant_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(self.url)
+
+        for i, state in enumerate(models.Contract.STATES.keys() * 3):
+            contract = self.create_contract('C%d' % (i + 2), state)
+            models.Invoice.objects.create(
+                business_unit=self.business_unit, contract=contract, expected_amount=100,
+                expected_invoice_date=date(2017, 1, 1), expected_payment_date=date(2017, 1, 1),
+            )
+
+        with self.assertNumQueries(len(context)):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.context['completed_contracts']), 3)
+
+
+class AccountingMixinTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username='manager', password='password')
+        cls.business_unit = models.BusinessUnit.objects.create(name='Unit', account_number='1234')
+        models.UserTeamRole.objects.create(
+            user=cls.user, business_unit=cls.business_unit, role=models.UserTeamRole.ROLES.MANAGER,
+        )
+
+    def setUp(self):
+        self.url = reverse('accounting:contracts', kwargs={'business_unit': self.business_unit.pk})
+
+    def request(self, method, user, **kwargs):
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(self.url, **kwargs)
+        atomic = any(query['sql'].startswith('SAVEPOINT') for query in context.captured_queries)
+        return response, atomic
+
+    def test_reads(self):
+        response, atomic = self.request('get', self.user)
+        self.assertTrue(response.context['is_manager'])
+        self.assertEqual(response.context['current_business_unit'], self.business_unit)
+        self.assertFalse(atomic)
+
+    def test_writes(self):
+        contract = models.Contract.objects.create(
+            business_unit=self.business_unit, contract_id='C1', name='C1',
+            start_date=date(2017, 1, 1), type=models.Contract.TYPES.FIXED,
+        )
+
+        response, atomic = self.request('post', self.user, data={'delete': contract.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(models.Contract.objects.exists())
+        self.assertTrue(atomic)
+
+    def test_non_member(self):
+        superuser = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        response, _ = self.request('get', superuser)
+        self.assertTrue(response.context['is_manager'])
+        self.assertEqual(response.context['current_business_unit'], self.business_unit)
+
+        other = get_user_model().objects.create_user(username='other', password='password')
+        response, _ = self.request('get', other)
+        self.assertEqual(response.status_code, 302)
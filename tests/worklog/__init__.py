@@ -1,8 +1,19 @@
 import datetime
+from django.db import connection
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 
 
+def run_commit_hooks():
+    """
+    Run the `transaction.on_commit` callbacks registered so far. A TestCase is never
+    committed, so they would not be run otherwise.
+    """
+    callbacks, connection.run_on_commit = connection.run_on_commit, []
+    for sids, func in callbacks:
+        func()
+
+
 class UserLoginContext(object):
     def __init__(self, client, username, password):
         self.client = client
@@ -1,11 +1,14 @@
 import datetime
 
 from django.contrib.auth.models import User
+from rest_framework import serializers
 from rest_framework.serializers import ValidationError
 from rest_framework.test import APITestCase
 
-from labsite.worklog.api.serializers import WorkItemSerializer
-from labsite.worklog.models import Job
+from labsite.worklog.api.serializers import (
+    WorkItemSerializer, get_field_lookups,
+)
+from labsite.worklog.models import Job, WorkItem
 from tests.worklog import factories
 
 
@@ -58,3 +61,33 @@ class WorkItemSerializerTestCase(APITestCase):
 
         attrs = self.serializer.validate_text('foo bar baz qux')
         self.assertIsNotNone(attrs)
+
+
+class FieldLookupsTestCase(APITestCase):
+
+    def test_columns(self):
+        fields = WorkItemSerializer().fields.values()
+        related, columns = get_field_lookups(WorkItem, fields)
+
+        self.assertEqual(related, set())
+        self.assertEqual(columns, {'id', 'user', 'date', 'hours', 'text', 'job'})
+
+    def test_related(self):
+        fields = [
+            serializers.CharField(source='user.username'),
+            serializers.CharField(source='job.name'),
+        ]
+        for name, field in zip(['username', 'job_name'], fields):
+            field.bind(name, serializers.Serializer())
+
+        related, columns = get_field_lookups(WorkItem, fields)
+
+        self.assertEqual(related, {'user', 'job'})
+        self.assertEqual(columns, {'id', 'user', 'user__username', 'job', 'job__name'})
+
+    def test_unrestricted(self):
+        field = serializers.CharField(source='get_absolute_url')
+        field.bind('url', serializers.Serializer())
+
+        related, columns = get_field_lookups(WorkItem, [field])
+        self.assertIsNone(columns)
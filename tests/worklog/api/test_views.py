@@ -1,15 +1,27 @@
+import csv
 import datetime
+import io
+import json
+import math
 import uuid
 from random import randrange
+from unittest import mock
 
 from django.contrib.auth.models import User
+from django.db import connection, transaction
 from django.db.models import Q
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from faker.factory import Factory as FakeFactory
 from rest_framework import status
 from rest_framework.test import APIRequestFactory, APITestCase
 
-from labsite.worklog.models import Job, WorkItem
-from tests.worklog import WorklogTestCaseBase, factories
+from labsite.worklog.models import (
+    Change, ChangeCounter, Job, JobSummary, WorkDay, WorkItem,
+)
+from labsite.worklog.views import WorklogView
+from tests.worklog import WorklogTestCaseBase, factories, run_commit_hooks
 
 
 faker = FakeFactory.create()
@@ -45,7 +57,7 @@ class WorkItemViewSetTestCase(ViewSetBaseTestCase):
             query_params = {'date': str(date)}
             expected_qs = WorkItem.objects.filter(date=date).order_by('pk')
             response = self.client.get('/worklog/api/workitems/', query_params)
-            actual_qs = [value["id"] for value in response.data]
+            actual_qs = [value["id"] for value in response.data["results"]]
             expected_qs = [value.id for value in expected_qs]
             self.assertEqual(list(actual_qs), list(expected_qs))
 
@@ -53,7 +65,7 @@ class WorkItemViewSetTestCase(ViewSetBaseTestCase):
             query_params = {'user': user}
             expected_qs = WorkItem.objects.filter(user=user).order_by('pk')
             response = self.client.get('/worklog/api/workitems/', query_params)
-            actual_qs = [value["id"] for value in response.data]
+            actual_qs = [value["id"] for value in response.data["results"]]
             expected_qs = [value.id for value in expected_qs]
             self.assertEqual(list(actual_qs), list(expected_qs))
 
@@ -62,7 +74,7 @@ class WorkItemViewSetTestCase(ViewSetBaseTestCase):
                 query_params = {'date': str(date), 'user': user}
                 expected_qs = WorkItem.objects.filter(user=user, date=date).order_by('pk')
                 response = self.client.get('/worklog/api/workitems/', query_params)
-                actual_qs = [value["id"] for value in response.data]
+                actual_qs = [value["id"] for value in response.data["results"]]
                 expected_qs = [value.id for value in expected_qs]
                 self.assertEqual(list(actual_qs), list(expected_qs))
 
@@ -118,6 +130,53 @@ class WorkItemViewSetTestCase(ViewSetBaseTestCase):
             response = self.client.get('/worklog/api/workitems/' + str(workitem) + '/')
             self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_pagination(self):
+        actual_qs = []
+        url = '/worklog/api/workitems/?page_size=3'
+        while url:
+            response = self.client.get(url)
+            self.assertLessEqual(len(response.data['results']), 3)
+            actual_qs += [value["id"] for value in response.data['results']]
+            url = response.data['next']
+
+        self.assertEqual(actual_qs, list(self.workitem_pks))
+
+    def test_workdays_unpaginated(self):
+        WorkDay.objects.create(user_id=self.user_pks[0], date=datetime.date.today())
+
+        response = self.client.get('/worklog/api/workdays/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+
+    @override_settings(WORKLOG_API_MAX_PAGE_SIZE=2)
+    def test_max_page_size(self):
+        response = self.client.get('/worklog/api/workitems/', {'page_size': 5})
+        self.assertEqual(len(response.data['results']), 2)
+
+    def test_fields(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/worklog/api/workitems/', {'fields': 'id,hours,unknown'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(list(response.data['results'][0]), ['id', 'hours'])
+
+        sql = context.captured_queries[-1]['sql']
+        self.assertIn('"hours"', sql)
+        self.assertNotIn('"text"', sql)
+
+    def test_fields_ignored_on_write(self):
+        data = {
+            'user': self.user_pks[0],
+            'date': str(datetime.date.today()),
+            'job': self.job_pks[0],
+            'hours': 2,
+            'text': 'sparse',
+        }
+
+        response = self.client.post('/worklog/api/workitems/?fields=id', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['text'], 'sparse')
+
 
 class JobViewSetTestCase(ViewSetBaseTestCase):
 
@@ -209,6 +268,267 @@ class JobViewSetTestCase(ViewSetBaseTestCase):
             self.assertEqual(response.status_code, status.HTTP_200_OK)
 
 
+class ConditionalListTestCase(ViewSetBaseTestCase):
+
+    def test_not_modified(self):
+        response = self.client.get('/worklog/api/workitems/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('ETag', response)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/worklog/api/workitems/', HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+
+        # only the aggregate is run against the table, no rows are fetched
+        workitem_queries = [q['sql'] for q in context.captured_queries if 'FROM "worklog_workitem"' in q['sql']]
+        self.assertEqual(len(workitem_queries), 1)
+        self.assertIn('MAX(', workitem_queries[0])
+        self.assertNotIn('"worklog_workitem"."text"', workitem_queries[0])
+
+    def test_modified(self):
+        etag = self.client.get('/worklog/api/workitems/')['ETag']
+
+        # neither the count nor the max pk change
+        workitem = WorkItem.objects.get(pk=self.workitem_pks[0])
+        workitem.text = 'changed'
+        workitem.save()
+        run_commit_hooks()
+
+        response = self.client.get('/worklog/api/workitems/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_query(self):
+        etag = self.client.get('/worklog/api/workitems/')['ETag']
+
+        response = self.client.get('/worklog/api/workitems/', {'fields': 'id'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_if_modified_since(self):
+        response = self.client.get('/worklog/api/workdays/')
+        self.assertNotIn('Last-Modified', response)
+
+        WorkDay.objects.create(user_id=self.user_pks[0], date=datetime.date.today())
+        run_commit_hooks()
+        second = math.ceil(ChangeCounter.objects.for_model(WorkDay).modified.timestamp())
+
+        # a later change could still share the second of the latest change
+        with mock.patch('time.time', return_value=second - 0.5):
+            response = self.client.get('/worklog/api/workdays/')
+        self.assertNotIn('Last-Modified', response)
+
+        with mock.patch('time.time', return_value=second):
+            last_modified = self.client.get('/worklog/api/workdays/')['Last-Modified']
+
+            response = self.client.get('/worklog/api/workdays/', HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # a change made later in the same second as the response
+        ChangeCounter.objects.filter(table=WorkDay._meta.db_table).update(
+            modified=datetime.datetime.fromtimestamp(second + 0.2, datetime.timezone.utc),
+        )
+        with mock.patch('time.time', return_value=second + 1):
+            response = self.client.get('/worklog/api/workdays/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_job_users(self):
+        etag = self.client.get('/worklog/api/jobs/')['ETag']
+
+        job = Job.objects.get(pk=self.job_pks[0])
+        job.users.add(User.objects.get(pk=self.user_pks[1]))
+        run_commit_hooks()
+
+        response = self.client.get('/worklog/api/jobs/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_counted_on_commit(self):
+        run_commit_hooks()
+        version = ChangeCounter.objects.for_model(WorkItem).version
+
+        with transaction.atomic():
+            for workitem in WorkItem.objects.filter(pk__in=self.workitem_pks[:3]):
+                workitem.save()
+            with transaction.atomic():
+                WorkItem.objects.get(pk=self.workitem_pks[3]).save()
+
+            # the counter's row is not locked for the rest of the transaction
+            self.assertEqual(ChangeCounter.objects.for_model(WorkItem).version, version)
+
+        # the transaction is counted once
+        run_commit_hooks()
+        self.assertEqual(ChangeCounter.objects.for_model(WorkItem).version, version + 1)
+
+    def test_rolled_back_savepoint(self):
+        run_commit_hooks()
+        version = ChangeCounter.objects.for_model(WorkItem).version
+
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    WorkItem.objects.get(pk=self.workitem_pks[0]).save()
+                    raise ValueError
+            except ValueError:
+                pass
+            WorkItem.objects.get(pk=self.workitem_pks[1]).save()
+
+        # the change outside of the savepoint is still counted
+        run_commit_hooks()
+        self.assertEqual(ChangeCounter.objects.for_model(WorkItem).version, version + 1)
+
+
+class WorkItemExportTestCase(ViewSetBaseTestCase):
+
+    def test_csv(self):
+        response = self.client.get('/worklog/api/workitems/export/')
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], ['id', 'date', 'user', 'job', 'hours', 'text', 'invoiced'])
+        self.assertEqual([int(row[0]) for row in rows[1:]], list(self.workitem_pks))
+
+    def test_ndjson(self):
+        workitem = WorkItem.objects.get(pk=self.workitem_pks[0])
+        response = self.client.get('/worklog/api/workitems/export.ndjson', {'username': workitem.user.username})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        items = [json.loads(line) for line in lines]
+        self.assertEqual(len(items), WorkItem.objects.filter(user=workitem.user_id).count())
+        self.assertEqual(items[0], {
+            'id': workitem.pk,
+            'date': workitem.date.isoformat(),
+            'user': workitem.user.username,
+            'job': workitem.job.name,
+            'hours': workitem.hours,
+            'text': workitem.text,
+            'invoiced': workitem.invoiced,
+        })
+
+    def test_single_query(self):
+        response = self.client.get('/worklog/api/workitems/export/')
+
+        with CaptureQueriesContext(connection) as context:
+            b''.join(response.streaming_content)
+        self.assertEqual(len(context), 1)
+
+    def test_unauthenticated(self):
+        self.client.force_authenticate(user=None)
+        response = self.client.get('/worklog/api/workitems/export.csv')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+# the changes are not listed again unless they were made out of order
+@override_settings(WORKLOG_CHANGE_FEED_WINDOW=0)
+class ChangeFeedTestCase(ViewSetBaseTestCase):
+    url = '/worklog/api/changes/'
+
+    def sync(self, since, **params):
+        response = self.client.get(self.url, dict(params, since=since))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_token(self):
+        token = self.client.get(self.url).data['next']
+        self.assertEqual(token, str(Change.objects.latest('seq').seq))
+
+        data = self.sync(token)
+        self.assertEqual(data['next'], token)
+        self.assertEqual((data['workitems'], data['workdays']), ([], []))
+
+    def test_changes(self):
+        token = self.client.get(self.url).data['next']
+        user = User.objects.get(pk=self.user_pks[0])
+
+        updated = WorkItem.objects.get(pk=self.workitem_pks[0])
+        updated.text = 'first'
+        updated.save()
+        updated.text = 'second'
+        updated.save()
+        deleted = WorkItem.objects.get(pk=self.workitem_pks[1])
+        deleted_pk = deleted.pk
+        deleted.delete()
+        workday = WorkDay.objects.create(user=user, date=datetime.date.today())
+
+        # a created and deleted item is only a tombstone
+        created = WorkItem.objects.create(user=user, date=datetime.date.today(), hours=1, text='gone', job=updated.job)
+        created_pk = created.pk
+        created.delete()
+
+        with self.assertNumQueries(5):
+            data = self.sync(token)
+
+        self.assertEqual([item['text'] for item in data['workitems']], ['second'])
+        self.assertEqual(data['workdays'][0]['id'], workday.pk)
+        self.assertEqual(data['deleted']['workitems'], [deleted_pk, created_pk])
+        self.assertEqual(data['deleted']['workdays'], [])
+        self.assertFalse(data['more'])
+
+        # nothing has changed since
+        data = self.sync(data['next'])
+        self.assertEqual((data['workitems'], data['deleted']['workitems']), ([], []))
+
+    def test_user(self):
+        token = self.client.get(self.url).data['next']
+        WorkDay.objects.create(user_id=self.user_pks[0], date=datetime.date.today())
+        WorkDay.objects.create(user_id=self.user_pks[1], date=datetime.date.today())
+
+        data = self.sync(token, user=self.user_pks[1])
+        self.assertEqual([workday['user'] for workday in data['workdays']], [self.user_pks[1]])
+
+    @override_settings(WORKLOG_API_MAX_PAGE_SIZE=2)
+    def test_more(self):
+        token = self.client.get(self.url).data['next']
+        for pk in self.workitem_pks[:3]:
+            WorkItem.objects.get(pk=pk).save()
+
+        data = self.sync(token)
+        self.assertTrue(data['more'])
+        self.assertEqual([item['id'] for item in data['workitems']], list(self.workitem_pks[:2]))
+
+        data = self.sync(data['next'])
+        self.assertFalse(data['more'])
+        self.assertEqual([item['id'] for item in data['workitems']], [self.workitem_pks[2]])
+
+    def test_bulk(self):
+        token = self.client.get(self.url).data['next']
+        job = Job.objects.get(pk=self.job_pks[0])
+        job.available_all_users = True
+        job.save()
+
+        response = self.client.post('/worklog/api/workitems/bulk/', [
+            {'user': self.user_pks[0], 'date': datetime.date.today(), 'hours': 1, 'text': 'bulk', 'job': job.pk},
+        ], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([item['id'] for item in self.sync(token)['workitems']], [response.data[0]['id']])
+
+    @override_settings(WORKLOG_CHANGE_FEED_WINDOW=60)
+    def test_late_commit(self):
+        Change.objects.update(created=timezone.now() - datetime.timedelta(days=1))
+        late, synced = [WorkItem.objects.get(pk=pk) for pk in self.workitem_pks[:2]]
+        late.save()
+        synced.save()
+
+        # the late change was not yet committed when the later change was synced
+        token = str(Change.objects.latest('seq').seq)
+        data = self.sync(token)
+        self.assertEqual([item['id'] for item in data['workitems']], [late.pk])
+
+        Change.objects.filter(object_id=late.pk).update(created=timezone.now() - datetime.timedelta(minutes=2))
+        self.assertEqual(self.sync(token)['workitems'], [])
+
+    def test_invalid(self):
+        for params in [{'since': 'x'}, {'since': '-1'}, {'since': '0', 'user': 'x'}]:
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
 class CreateWorkItemTestCase(WorklogTestCaseBase):
 
     def test_basic_get(self):
@@ -371,3 +691,135 @@ class ViewWorkTestCase(WorklogTestCaseBase):
             texts = list(x.text for x in response.context['items'])
             texts.sort()
             self.assertEqual(texts, ['item4', 'item6'])
+
+
+class ViewWorkPaginationTestCase(WorklogTestCaseBase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+
+        job = Job.objects.get(name="Job_Today")
+        for day in range(5):
+            for hours in range(1, 3):
+                WorkItem.objects.create(user=cls.user, date=cls.today - datetime.timedelta(days=day),
+                                        hours=hours, text="item", job=job)
+        WorkItem.objects.create(user=cls.user2, date=cls.today, hours=1, text="item", job=job)
+
+    def get_page(self, url):
+        response = self.client.get(url)
+        return response.context['items'], response.context['next_query'], response.context['previous_query']
+
+    @mock.patch.object(WorklogView, 'paginate_by', 4)
+    def test_pages(self):
+        expected = list(WorkItem.objects.filter(user=self.user).order_by('-date', '-pk'))
+
+        with self.scoped_login(username='master', password='password'):
+            items, next_query, previous_query = self.get_page('/worklog/view/master/')
+            self.assertEqual(items, expected[:4])
+            self.assertIsNone(previous_query)
+
+            items, next_query, previous_query = self.get_page('/worklog/view/?' + next_query)
+            self.assertEqual(items, expected[4:8])
+            self.assertIn('user=%d' % self.user.pk, next_query)
+
+            items, last_query, _ = self.get_page('/worklog/view/?' + next_query)
+            self.assertEqual(items, expected[8:])
+            self.assertIsNone(last_query)
+
+            items, _, previous_query = self.get_page('/worklog/view/?' + previous_query)
+            self.assertEqual(items, expected[:4])
+            self.assertIsNone(previous_query)
+
+    @mock.patch.object(WorklogView, 'paginate_by', 4)
+    def test_related_queries(self):
+        with self.scoped_login(username='master', password='password'):
+            response = self.client.get('/worklog/view/')
+
+        # rendering the page does not fetch related users/jobs per row
+        with self.assertNumQueries(0):
+            for item in response.context['items']:
+                str(item.user), str(item.job)
+
+    def test_export(self):
+        with self.scoped_login(username='master', password='password'):
+            response = self.client.get('/worklog/view/?user=%d&export=1' % self.user2.pk)
+            content = b''.join(response.streaming_content).decode()
+
+        self.assertEqual(content.count('<tr>'), 2)
+        self.assertIn('<td>user2</td>', content)
+
+
+class WorkItemBulkCreateTestCase(WorklogTestCaseBase):
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.job = Job.objects.get(name="Job_Today")
+        self.restricted = Job.objects.create(name="Restricted", open_date=self.today, available_all_users=False)
+        self.restricted.users.add(self.user)
+
+    def item(self, **kwargs):
+        data = {'user': self.user.pk, 'date': str(self.today), 'job': self.job.pk, 'hours': 1, 'text': 'bulk'}
+        data.update(kwargs)
+        return data
+
+    def post(self, data, query=''):
+        return self.client.post('/worklog/api/workitems/bulk/' + query, data, content_type='application/json')
+
+    def test_create(self):
+        data = [self.item(), self.item(job=self.restricted.pk, hours=2.5), self.item()]
+        response = self.post(json.dumps(data))
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data), 3)
+        # the pks are set on every backend, including for identical items
+        self.assertEqual(
+            [item['id'] for item in response.data],
+            list(WorkItem.objects.filter(text='bulk').order_by('pk').values_list('pk', flat=True)),
+        )
+        # insert() bypasses the summary signals
+        self.assertEqual(JobSummary.objects.get(job=self.restricted).worked_hours, 2.5)
+
+    def test_constant_queries(self):
+        def count_queries(size):
+            data = json.dumps([self.item(job=self.restricted.pk) for i in range(size)])
+            with CaptureQueriesContext(connection) as context:
+                self.post(data)
+            # the items are inserted one at a time on backends that do not return bulk inserted pks
+            inserts = [q for q in context.captured_queries if q['sql'].startswith('INSERT INTO "worklog_workitem"')]
+            return len(context) - len(inserts)
+
+        count_queries(1)  # the table's change counter is created on first use
+        self.assertEqual(count_queries(2), count_queries(20))
+        self.assertEqual(WorkItem.objects.filter(text='bulk').count(), 23)
+
+    def test_invalid(self):
+        data = [
+            self.item(),
+            self.item(hours=1.3),
+            self.item(job=Job.objects.get(name="Job_Old").pk),
+            self.item(user=self.user2.pk, job=self.restricted.pk),
+            self.item(job=999),
+        ]
+        response = self.post(json.dumps(data))
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('hours', response.data[1])
+        self.assertEqual(response.data[2], {'job': ["Job must be open."]})
+        self.assertEqual(response.data[3], {'non_field_errors': ["Job not available to user."]})
+        self.assertIn('job', response.data[4])
+        self.assertFalse(WorkItem.objects.filter(text='bulk').exists())
+
+    def test_skip_invalid(self):
+        data = [self.item(), self.item(hours=-1), self.item(hours=3)]
+        response = self.post(json.dumps(data), '?skip_invalid=true')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['created']), 2)
+        self.assertEqual([bool(error) for error in response.data['errors']], [False, True, False])
+        self.assertEqual(WorkItem.objects.filter(text='bulk').count(), 2)
+
+    def test_not_a_list(self):
+        response = self.post(json.dumps(self.item()))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
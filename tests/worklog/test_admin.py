@@ -0,0 +1,169 @@
+import datetime
+import io
+from zipfile import ZipFile
+
+from django.contrib import admin
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from labsite.worklog.admin import WorkItemAdmin
+from labsite.worklog.models import InvoiceRun, Job, JobSummary, WorkItem
+from tests.worklog import WorklogTestCaseBase
+
+
+class ArchiveTestCase(WorklogTestCaseBase):
+
+    def setUp(self):
+        self.model_admin = WorkItemAdmin(WorkItem, admin.site)
+        self.request = RequestFactory().post('/')
+        self.request.user = self.user
+
+        job, tied = Job.objects.get(name="Job_Today"), Job.objects.get(name="Job_LastWeek")
+        for day, hours in [(datetime.date(2018, 2, 2), 2), (datetime.date(2018, 1, 30), 1),
+                           (datetime.date(2018, 2, 1), 3)]:
+            WorkItem.objects.create(user=self.user, date=day, hours=hours, text='work', job=job)
+        for day in [datetime.date(2018, 2, 1), datetime.date(2018, 1, 31)]:
+            WorkItem.objects.create(user=self.user, date=day, hours=4, text='tied, "quoted"', job=tied)
+
+    def archive(self):
+        response = self.model_admin.archive(self.request, WorkItem.objects.all())
+        return ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_invoices(self):
+        archive = self.archive()
+
+        # the earliest month wins a tie
+        self.assertEqual(archive.namelist(), ['Job_LastWeek-2018-01.csv', 'Job_Today-2018-02.csv'])
+        self.assertEqual(archive.read('Job_Today-2018-02.csv').decode().splitlines(), [
+            'Date,Hours,Task',
+            '2018-01-30,1.0,work',
+            '2018-02-01,3.0,work',
+            '2018-02-02,2.0,work',
+        ])
+        self.assertEqual(archive.read('Job_LastWeek-2018-01.csv').decode().splitlines(), [
+            'Date,Hours,Task',
+            '2018-01-31,4.0,"tied, ""quoted"""',
+            '2018-02-01,4.0,"tied, ""quoted"""',
+        ])
+        self.assertFalse(WorkItem.objects.filter(invoiced=False).exists())
+
+    def test_incomplete(self):
+        content = self.model_admin.stream_invoices(WorkItem.objects.all())
+        next(content)
+
+        # the client disconnected before receiving the last chunk
+        content.close()
+        self.assertFalse(WorkItem.objects.filter(invoiced=True).exists())
+
+    def test_written_items(self):
+        self.model_admin.archive_chunk_size = 1
+        response = self.model_admin.archive(self.request, WorkItem.objects.all())
+        content = iter(response.streaming_content)
+        next(content)
+
+        # an item created while the zip is streamed is not in it
+        job = Job.objects.get(name="Job_Today")
+        item = WorkItem.objects.create(user=self.user, date=datetime.date(2018, 2, 3), hours=1, text='late', job=job)
+        archive = ZipFile(io.BytesIO(b''.join(content)))
+
+        self.assertNotIn('late', archive.read('Job_Today-2018-02.csv').decode())
+        self.assertEqual(list(WorkItem.objects.filter(invoiced=False)), [item])
+
+    def test_constant_queries(self):
+        job = Job.objects.get(name="Job_LastWeek2")
+        WorkItem.objects.create(user=self.user, date=datetime.date(2018, 3, 1), hours=1, text='work', job=job)
+
+        with CaptureQueriesContext(connection) as context:
+            archive = self.archive()
+
+        self.assertEqual(len(archive.namelist()), 3)
+        # the two checks, the file names, the items, and marking the written items (in a
+        # savepoint) with an update of each job summary
+        self.assertEqual(len(context), 4 + 4 + 3)
+
+
+class ChangelistTotalTestCase(WorklogTestCaseBase):
+
+    def setUp(self):
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+
+        job = Job.objects.get(name="Job_Today")
+        for day, hours, invoiced in [(1, 2, False), (1, 1.5, True), (2, 4, False)]:
+            WorkItem.objects.create(
+                user=self.user, date=datetime.date(2018, 1, day), hours=hours, text='work', job=job, invoiced=invoiced
+            )
+        self.url = reverse('admin:worklog_workitem_changelist')
+
+    def get_total(self, **params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url, params)
+        rollup = any('SUM("worklog_userdayhours"."hours")' in q['sql'] for q in context.captured_queries)
+        return response.context['hours__sum'], rollup
+
+    def test_rollup(self):
+        self.assertEqual(self.get_total(), (7.5, True))
+        self.assertEqual(self.get_total(**{'date__gte': '2018-01-02'}), (4, True))
+        self.assertEqual(self.get_total(**{'job__invoiceable__exact': '1'}), (7.5, True))
+
+    def test_work_items(self):
+        # the rollup does not track invoicing or the item text
+        self.assertEqual(self.get_total(invoiced__exact='0'), (6, False))
+        self.assertEqual(self.get_total(q='work'), (7.5, False))
+
+
+class MarkInvoicedTestCase(WorklogTestCaseBase):
+
+    def setUp(self):
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+
+        self.job = Job.objects.get(name="Job_Today")
+        for hours, invoiced in [(2, False), (3, False), (1, True)]:
+            WorkItem.objects.create(
+                user=self.user, date=datetime.date(2018, 1, 1), hours=hours, text='work', job=self.job,
+                invoiced=invoiced,
+            )
+        self.url = reverse('admin:worklog_workitem_changelist')
+
+    def run_action(self, action, invoiced):
+        # select all of the items shown by the invoiced filter
+        response = self.client.post('%s?invoiced__exact=%d' % (self.url, invoiced), {
+            'action': action,
+            'select_across': '1',
+            '_selected_action': WorkItem.objects.filter(invoiced=invoiced).values_list('pk', flat=True),
+        })
+        self.assertEqual(response.status_code, 302)
+        return JobSummary.objects.get(job=self.job).uninvoiced_hours
+
+    def test_filtered(self):
+        self.assertEqual(self.run_action('mark_invoiced', invoiced=0), 0)
+        self.assertFalse(WorkItem.objects.filter(invoiced=False).exists())
+
+        self.assertEqual(self.run_action('mark_not_invoiced', invoiced=1), 6)
+
+
+class InvoiceRunAdminTestCase(WorklogTestCaseBase):
+
+    def setUp(self):
+        self.user.is_staff = self.user.is_superuser = True
+        self.user.save()
+        self.client.force_login(self.user)
+
+    def test_mark_failed(self):
+        stuck = InvoiceRun.objects.create(date=datetime.date(2018, 1, 1), state=InvoiceRun.STATES.RUNNING)
+        done = InvoiceRun.objects.create(date=datetime.date(2018, 1, 2), state=InvoiceRun.STATES.DONE, active=None)
+
+        response = self.client.post(reverse('admin:worklog_invoicerun_changelist'), {
+            'action': 'mark_failed',
+            '_selected_action': [stuck.pk, done.pk],
+        })
+        self.assertEqual(response.status_code, 302)
+
+        self.assertEqual(InvoiceRun.objects.get(pk=stuck.pk).state, InvoiceRun.STATES.FAILED)
+        self.assertIsNone(InvoiceRun.objects.get(pk=stuck.pk).active)
+        self.assertEqual(InvoiceRun.objects.get(pk=done.pk).state, InvoiceRun.STATES.DONE)
@@ -0,0 +1,51 @@
+import datetime
+import os
+import time
+from unittest import skipUnless
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from labsite.worklog.models import Job
+from labsite.worklog.views import WorkViewer
+
+
+@skipUnless(os.environ.get('LABSITE_BENCHMARKS'), "set LABSITE_BENCHMARKS=1 to run the benchmarks")
+class MenuBenchmark(TestCase):
+    """
+    Times building the `WorkViewer` menus over 5,000 users and 5,000 jobs, with the
+    menu cache cleared before each build (cold) and kept (warm).
+    """
+    rows = 5000
+    repeat = 20
+
+    @classmethod
+    def setUpTestData(cls):
+        get_user_model().objects.bulk_create(get_user_model()(username='user%d' % i) for i in range(cls.rows))
+        Job.objects.bulk_create(Job(name='job%d' % i, open_date=datetime.date(2016, 1, 1)) for i in range(cls.rows))
+
+    def time_menus(self, cold):
+        request = RequestFactory().get('/worklog/view/')
+        WorkViewer(request, None, None, None)
+
+        elapsed, queries = 0, 0
+        for _ in range(self.repeat):
+            if cold:
+                cache.clear()
+
+            connection.queries_log.clear()
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                WorkViewer(request, None, None, None)
+                elapsed += time.perf_counter() - start
+            queries += len(context)
+
+        return elapsed / self.repeat, queries / self.repeat
+
+    def test_menus(self):
+        for label, cold in [('cold', True), ('warm', False)]:
+            elapsed, queries = self.time_menus(cold)
+            print('\nworklog menus, %s: %.1f ms, %d queries per build' % (label, elapsed * 1000, queries))
@@ -0,0 +1,260 @@
+import datetime
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from labsite.worklog import caches
+from labsite.worklog.models import ChangeCounter, Holiday, Job, WorkItem
+from labsite.worklog.views import WorkViewer
+from tests.worklog import WorklogTestCaseBase, run_commit_hooks
+
+
+class MonthIndexTestCase(WorklogTestCaseBase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.job = Job.objects.get(name="Job_Today")
+
+        WorkItem.objects.create(user=cls.user, date=datetime.date(2017, 1, 13), hours=1, text="item", job=cls.job)
+        WorkItem.objects.create(user=cls.user, date=datetime.date(2017, 1, 30), hours=1, text="item", job=cls.job)
+        WorkItem.objects.create(user=cls.user, date=datetime.date(2016, 11, 2), hours=1, text="item", job=cls.job)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_index(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(caches.get_month_index(), [datetime.date(2017, 1, 1), datetime.date(2016, 11, 1)])
+
+        with self.assertNumQueries(0):
+            caches.get_month_index()
+
+    def test_existing_month(self):
+        caches.get_month_index()
+        WorkItem.objects.create(user=self.user, date=datetime.date(2017, 1, 2), hours=1, text="item", job=self.job)
+
+        with self.assertNumQueries(0):
+            caches.get_month_index()
+
+    def test_new_month(self):
+        caches.get_month_index()
+        WorkItem.objects.create(user=self.user, date=datetime.date(2017, 3, 2), hours=1, text="item", job=self.job)
+
+        self.assertEqual(caches.get_month_index(), [
+            datetime.date(2017, 3, 1), datetime.date(2017, 1, 1), datetime.date(2016, 11, 1),
+        ])
+
+    def test_delete(self):
+        caches.get_month_index()
+        WorkItem.objects.filter(date__month=11).get().delete()
+
+        self.assertEqual(caches.get_month_index(), [datetime.date(2017, 1, 1)])
+
+    def test_moved(self):
+        caches.get_month_index()
+        item = WorkItem.objects.filter(date__month=11).get()
+        item.date = datetime.date(2017, 1, 20)
+        item.save()
+
+        # the item's original month is now empty
+        self.assertEqual(caches.get_month_index(), [datetime.date(2017, 1, 1)])
+
+    def test_moved_within_month(self):
+        caches.get_month_index()
+        item = WorkItem.objects.filter(date__month=11).get()
+        item.date, item.hours = datetime.date(2016, 11, 20), 2
+        item.save()
+
+        with self.assertNumQueries(0):
+            caches.get_month_index()
+
+
+class FilterMenuTestCase(WorklogTestCaseBase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_user_menu(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(caches.get_user_menu(), [(self.user.pk, 'master'), (self.user2.pk, 'user2')])
+
+        with self.assertNumQueries(0):
+            caches.get_user_menu()
+
+        # logging in does not invalidate the menu
+        self.client.login(username='master', password='password')
+        with self.assertNumQueries(0):
+            caches.get_user_menu()
+
+        self.user2.username = 'renamed'
+        self.user2.save()
+        self.assertEqual(caches.get_user_menu(), [(self.user.pk, 'master'), (self.user2.pk, 'renamed')])
+
+    def test_job_menu(self):
+        names = [name for pk, name in caches.get_job_menu()]
+        self.assertEqual(names, sorted(names))
+
+        with self.assertNumQueries(0):
+            caches.get_job_menu()
+
+        Job.objects.get(name="Job_Old").delete()
+        self.assertNotIn("Job_Old", [name for pk, name in caches.get_job_menu()])
+
+    def test_menu_queries(self):
+        request = RequestFactory().get('/worklog/view/')
+
+        # one query per menu when cold, however many users and jobs there are
+        with self.assertNumQueries(3):
+            WorkViewer(request, None, None, None)
+        with self.assertNumQueries(0):
+            WorkViewer(request, None, None, None)
+
+        get_user_model().objects.bulk_create(get_user_model()(username='menu%d' % i) for i in range(20))
+        Job.objects.bulk_create(Job(name='menu%d' % i, open_date=self.today) for i in range(20))
+        cache.clear()
+
+        with self.assertNumQueries(3):
+            viewer = WorkViewer(request, None, None, None)
+        with self.assertNumQueries(0):
+            WorkViewer(request, None, None, None)
+        self.assertEqual(len(viewer.menu.submenus[1].items), get_user_model().objects.count() + 1)
+
+    def test_view(self):
+        with self.scoped_login(username='master', password='password'):
+            self.client.get('/worklog/view/')
+
+            # the menus are served from the cache on subsequent requests
+            with self.assertNumQueries(0):
+                caches.get_user_menu(), caches.get_job_menu(), caches.get_month_index()
+
+
+class JobAccessTestCase(WorklogTestCaseBase):
+
+    def setUp(self):
+        cache.clear()
+        caches._get_job_access.cache_clear()
+        self.restricted = Job.objects.create(name="Restricted", open_date=self.today, available_all_users=False)
+        self.restricted.users.add(self.user)
+        # the jobs' change counter is incremented on commit
+        run_commit_hooks()
+
+    def test_access(self):
+        with self.assertNumQueries(2):
+            job_ids = Job.objects.accessible_ids(self.user)
+        self.assertEqual(job_ids, set(Job.objects.values_list('pk', flat=True)))
+        self.assertNotIn(self.restricted.pk, Job.objects.accessible_ids(self.user2))
+
+        # only the version is read once the set is cached
+        with self.assertNumQueries(1):
+            Job.objects.accessible_ids(self.user)
+
+    def test_shared(self):
+        Job.objects.accessible_ids(self.user)
+        caches._get_job_access.cache_clear()
+
+        # another process reads the sets from the cache backend
+        with self.assertNumQueries(1):
+            self.assertIn(self.restricted.pk, Job.objects.accessible_ids(self.user))
+
+    def test_other_process(self):
+        self.assertIn(self.restricted.pk, Job.objects.accessible_ids(self.user))
+
+        # a change counted by another process applies immediately, even though this
+        # process's caches were not cleared
+        Job.users.through.objects.filter(job=self.restricted).delete()
+        ChangeCounter.objects.increment(Job)
+        self.assertNotIn(self.restricted.pk, Job.objects.accessible_ids(self.user))
+
+    def test_users_changed(self):
+        self.assertNotIn(self.restricted.pk, Job.objects.accessible_ids(self.user2))
+
+        self.restricted.users.add(self.user2)
+        run_commit_hooks()
+        self.assertIn(self.restricted.pk, Job.objects.accessible_ids(self.user2))
+
+        self.restricted.users.clear()
+        run_commit_hooks()
+        self.assertNotIn(self.restricted.pk, Job.objects.accessible_ids(self.user))
+
+    def test_job_changed(self):
+        self.assertNotIn(self.restricted.pk, Job.objects.accessible_ids(self.user2))
+
+        self.restricted.available_all_users = True
+        self.restricted.save()
+        run_commit_hooks()
+        self.assertIn(self.restricted.pk, Job.objects.accessible_ids(self.user2))
+
+        self.restricted.delete()
+        run_commit_hooks()
+        self.assertNotIn(self.restricted.pk, Job.objects.accessible_ids(self.user))
+
+    def test_superuser(self):
+        self.assertNotIn(self.restricted.pk, Job.objects.accessible_ids(self.user2))
+
+        user = get_user_model().objects.get(pk=self.user2.pk)
+        user.is_superuser = True
+        user.save()
+        self.assertIn(self.restricted.pk, Job.objects.accessible_ids(user))
+
+    def test_save(self):
+        Job.objects.accessible_ids(self.user)
+
+        # the availability check does not query the jobs
+        with CaptureQueriesContext(connection) as context:
+            WorkItem.objects.create(user=self.user, date=self.today, hours=1, text="item", job=self.restricted)
+        self.assertFalse([q for q in context.captured_queries if 'worklog_job_users' in q['sql']])
+
+        WorkItem.objects.create(user=self.user, date=self.today, hours=1, text="item", job=self.restricted)
+
+        with self.assertRaises(ValueError):
+            WorkItem.objects.create(user=self.user2, date=self.today, hours=1, text="item", job=self.restricted)
+
+
+class HolidayCalendarTestCase(WorklogTestCaseBase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(caches.clear_holiday_calendar)
+
+    def test_calendar(self):
+        calendar = caches.HolidayCalendar([
+            (datetime.date(2018, 1, 3), datetime.date(2018, 1, 4)),
+            (datetime.date(2018, 1, 1), datetime.date(2018, 1, 2)),
+            (datetime.date(2018, 1, 10), datetime.date(2018, 1, 10)),
+            (datetime.date(2018, 1, 9), datetime.date(2018, 1, 8)),
+        ])
+
+        # overlapping and adjacent holidays are merged, and invalid ranges dropped
+        self.assertEqual(calendar.starts, [datetime.date(2018, 1, 1), datetime.date(2018, 1, 10)])
+        self.assertEqual(calendar.ends, [datetime.date(2018, 1, 4), datetime.date(2018, 1, 10)])
+
+        self.assertTrue(calendar.is_holiday(datetime.date(2018, 1, 4)))
+        self.assertFalse(calendar.is_holiday(datetime.date(2018, 1, 5)))
+        self.assertFalse(calendar.is_holiday(datetime.date(2017, 12, 31)))
+        self.assertFalse(calendar.is_business_day(datetime.date(2018, 1, 6)))
+
+        self.assertEqual(calendar.business_days(datetime.date(2017, 12, 29), datetime.date(2018, 1, 12)), [
+            datetime.date(2017, 12, 29), datetime.date(2018, 1, 5), datetime.date(2018, 1, 8),
+            datetime.date(2018, 1, 9), datetime.date(2018, 1, 11), datetime.date(2018, 1, 12),
+        ])
+        self.assertEqual(calendar.business_days(datetime.date(2018, 1, 2), datetime.date(2018, 1, 4)), [])
+
+    def test_cached(self):
+        with self.assertNumQueries(1):
+            caches.get_holiday_calendar()
+
+        with self.assertNumQueries(0):
+            self.assertFalse(caches.get_holiday_calendar().is_holiday(self.today))
+
+    def test_changes(self):
+        caches.get_holiday_calendar()
+
+        holiday = Holiday.objects.create(description="Today", start_date=self.today, end_date=self.today)
+        self.assertTrue(caches.get_holiday_calendar().is_holiday(self.today))
+
+        holiday.delete()
+        self.assertFalse(caches.get_holiday_calendar().is_holiday(self.today))
@@ -0,0 +1,40 @@
+import json
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+from labsite.worklog.models import WorkItem
+from tests.worklog import factories
+
+
+class ExportWorkItemsTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        factories.WorkItemFactory.create_batch(10)
+
+    def test_csv(self):
+        out = StringIO()
+        call_command('export_workitems', stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], 'id,date,user,job,hours,text,invoiced')
+        self.assertEqual(len(lines), WorkItem.objects.count() + 1)
+
+    def test_filters(self):
+        workitem = WorkItem.objects.first()
+
+        out = StringIO()
+        call_command('export_workitems', 'date=%s' % workitem.date, format='ndjson', stdout=out)
+
+        ids = [json.loads(line)['id'] for line in out.getvalue().splitlines()]
+        expected = WorkItem.objects.filter(date=workitem.date).order_by('pk').values_list('pk', flat=True)
+        self.assertEqual(ids, list(expected))
+
+    def test_invalid_filters(self):
+        with self.assertRaises(CommandError):
+            call_command('export_workitems', 'date')
+
+        with self.assertRaises(CommandError):
+            call_command('export_workitems', 'date=invalid')
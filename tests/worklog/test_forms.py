@@ -0,0 +1,54 @@
+from django.core.cache import cache
+from django.forms.models import modelformset_factory
+
+from labsite.worklog.forms import WorkItemBaseFormSet, WorkItemForm
+from labsite.worklog.models import Job, WorkItem
+from tests.worklog import WorklogTestCaseBase
+
+
+class WorkItemFormSetTestCase(WorklogTestCaseBase):
+    WorkItemFormSet = modelformset_factory(WorkItem, form=WorkItemForm, formset=WorkItemBaseFormSet)
+
+    def setUp(self):
+        cache.clear()
+        self.job = Job.objects.get(name="Job_Today")
+
+    def get_data(self, *jobs):
+        data = {
+            'form-TOTAL_FORMS': str(len(jobs)),
+            'form-INITIAL_FORMS': '0',
+            'form-MAX_NUM_FORMS': '',
+        }
+        for i, job in enumerate(jobs):
+            data.update({'form-%d-job' % i: str(job), 'form-%d-hours' % i: '1', 'form-%d-text' % i: 'work'})
+        return data
+
+    def count_queries(self, size):
+        # the job access set and the job choices
+        with self.assertNumQueries(2):
+            formset = self.WorkItemFormSet(self.get_data(*[self.job.pk] * size), logged_in_user=self.user)
+            self.assertTrue(formset.is_valid())
+            str(formset)
+
+    def test_constant_queries(self):
+        self.count_queries(1)
+        cache.clear()
+        self.count_queries(10)
+
+    def test_choices(self):
+        formset = self.WorkItemFormSet(logged_in_user=self.user, data=self.get_data(self.job.pk))
+        form = formset.forms[0]
+
+        names = [label for pk, label in form.fields['job'].choices]
+        self.assertEqual(names, ['None', 'Job_LastWeek', 'Job_LastWeek2', 'Job_OneDay', 'Job_Today'])
+        self.assertIn('<option value="%d" selected>Job_Today</option>' % self.job.pk, str(form['job']))
+
+        self.assertTrue(formset.is_valid())
+        self.assertEqual(form.cleaned_data['job'], self.job)
+
+    def test_invalid_choice(self):
+        future = Job.objects.get(name="Job_Future")
+        formset = self.WorkItemFormSet(self.get_data(future.pk, 'x'), logged_in_user=self.user)
+
+        self.assertFalse(formset.is_valid())
+        self.assertEqual([list(errors) for errors in formset.errors], [['job'], ['job']])
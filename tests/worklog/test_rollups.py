@@ -0,0 +1,258 @@
+import datetime
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import connection
+from django.forms.models import model_to_dict
+from django.test.utils import CaptureQueriesContext
+
+from labsite.worklog import signals
+from labsite.worklog.models import (
+    Funding, Job, JobSummary, UserDayHours, WorkItem,
+)
+from tests.worklog import WorklogTestCaseBase
+
+
+class JobSummaryTestCase(WorklogTestCaseBase):
+
+    def setUp(self):
+        self.job = Job.objects.get(name="Job_Today")
+        self.other = Job.objects.get(name="Job_LastWeek")
+
+    def create_item(self, day, hours=1, job=None, **kwargs):
+        return WorkItem.objects.create(
+            user=self.user, date=datetime.date(2018, 1, day), hours=hours, text='work', job=job or self.job, **kwargs
+        )
+
+    def assertSummaryCurrent(self, job):
+        summary = model_to_dict(JobSummary.objects.get(job=job))
+        self.assertEqual(summary, model_to_dict(JobSummary.objects.rebuild([job.pk])[0]))
+        return summary
+
+    def test_work(self):
+        self.create_item(3, 2)
+        item = self.create_item(5, 4)
+        self.create_item(4, 1, invoiced=True)
+
+        summary = self.assertSummaryCurrent(self.job)
+        self.assertEqual(summary['worked_hours'], 7)
+        self.assertEqual(summary['uninvoiced_hours'], 6)
+        self.assertEqual(summary['first_work_date'], datetime.date(2018, 1, 3))
+        self.assertEqual(summary['last_work_date'], datetime.date(2018, 1, 5))
+
+        item.hours, item.invoiced = 2.5, True
+        item.save()
+        summary = self.assertSummaryCurrent(self.job)
+        self.assertEqual(summary['worked_hours'], 5.5)
+        self.assertEqual(summary['uninvoiced_hours'], 2)
+
+        # moving the last item to another job
+        item = WorkItem.objects.get(pk=item.pk)
+        item.job = self.other
+        item.save()
+        summary = self.assertSummaryCurrent(self.job)
+        self.assertEqual(summary['last_work_date'], datetime.date(2018, 1, 4))
+        self.assertEqual(self.assertSummaryCurrent(self.other)['worked_hours'], 2.5)
+
+    def test_delete(self):
+        first = self.create_item(3)
+        self.create_item(4)
+        self.create_item(5)
+
+        first.delete()
+        summary = self.assertSummaryCurrent(self.job)
+        self.assertEqual(summary['first_work_date'], datetime.date(2018, 1, 4))
+
+        WorkItem.objects.filter(job=self.job).delete()
+        summary = self.assertSummaryCurrent(self.job)
+        self.assertEqual(summary['worked_hours'], 0)
+        self.assertIsNone(summary['first_work_date'])
+
+    def test_funding(self):
+        funding = Funding.objects.create(job=self.job, hours=10, date_available=datetime.date(2018, 1, 1))
+        Funding.objects.create(job=self.job, hours=5, date_available=datetime.date(2018, 2, 1))
+
+        funding.date_available = datetime.date(2018, 3, 1)
+        funding.save()
+
+        summary = self.assertSummaryCurrent(self.job)
+        self.assertEqual(summary['funded_hours'], 15)
+        self.assertEqual(summary['first_funding_date'], datetime.date(2018, 2, 1))
+        self.assertEqual(summary['last_funding_date'], datetime.date(2018, 3, 1))
+
+    def test_deferred(self):
+        item = self.create_item(3)
+
+        item = WorkItem.objects.only('id', 'text').get(pk=item.pk)
+        item.text = 'changed'
+        with CaptureQueriesContext(connection) as context:
+            item.save(update_fields=['text'])
+        self.assertFalse([q for q in context.captured_queries if 'worklog_jobsummary' in q['sql']])
+
+        # the original hours are unknown
+        item.hours = 3
+        item.save(update_fields=['hours'])
+        self.assertEqual(self.assertSummaryCurrent(self.job)['worked_hours'], 3)
+
+    def test_add_work_rows(self):
+        self.create_item(3)
+        items = WorkItem.objects.insert(
+            WorkItem(user=self.user, date=datetime.date(2018, 1, day), hours=2, text='work', job=self.job)
+            for day in [2, 6]
+        )
+
+        # one update per job
+        with CaptureQueriesContext(connection) as context:
+            signals.add_created_work(items)
+        self.assertEqual(len([q for q in context.captured_queries if 'worklog_jobsummary' in q['sql']]), 1)
+        summary = self.assertSummaryCurrent(self.job)
+        self.assertEqual(summary['worked_hours'], 5)
+        self.assertEqual(summary['first_work_date'], datetime.date(2018, 1, 2))
+        self.assertEqual(summary['last_work_date'], datetime.date(2018, 1, 6))
+
+        # removing a boundary date recomputes the dates
+        moved = WorkItem.objects.filter(date__gt=datetime.date(2018, 1, 3))
+        rows = list(moved.values_list('job_id', 'date', 'hours', 'invoiced'))
+        moved.update(job=self.other)
+        JobSummary.objects.add_work_rows(rows, -1)
+        self.assertEqual(self.assertSummaryCurrent(self.job)['last_work_date'], datetime.date(2018, 1, 3))
+
+    def test_has_work(self):
+        JobSummary.objects.all().delete()
+        self.create_item(3)
+
+        job = Job.objects.select_related('summary').get(pk=self.job.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(job.hasWork())
+            self.assertFalse(job.hasFunding())
+
+        # a missing summary is rebuilt
+        self.assertFalse(self.other.hasWork())
+        self.assertSummaryCurrent(self.other)
+
+    def test_rebuild_command(self):
+        self.create_item(3)
+        JobSummary.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_rollups', stdout=out)
+
+        self.assertEqual(JobSummary.objects.count(), Job.objects.count())
+        self.assertEqual(self.assertSummaryCurrent(self.job)['worked_hours'], 1)
+
+
+class UserDayHoursTestCase(WorklogTestCaseBase):
+
+    def setUp(self):
+        self.job = Job.objects.get(name="Job_Today")
+        self.other = Job.objects.get(name="Job_LastWeek")
+
+    def create_item(self, day, hours=1, job=None, **kwargs):
+        return WorkItem.objects.create(
+            user=self.user, date=datetime.date(2018, 1, day), hours=hours, text='work', job=job or self.job, **kwargs
+        )
+
+    def get_rows(self):
+        return set(UserDayHours.objects.values_list('user', 'date', 'job', 'hours', 'item_count'))
+
+    def assertRollupCurrent(self):
+        rows = self.get_rows()
+        UserDayHours.objects.rebuild()
+        self.assertEqual(rows, self.get_rows())
+        return rows
+
+    def test_work(self):
+        self.create_item(3, 2)
+        item = self.create_item(3, 1.5)
+        self.create_item(4, 1)
+
+        self.assertEqual(self.assertRollupCurrent(), {
+            (self.user.pk, datetime.date(2018, 1, 3), self.job.pk, 3.5, 2),
+            (self.user.pk, datetime.date(2018, 1, 4), self.job.pk, 1, 1),
+        })
+
+        item.hours, item.job = 3, self.other
+        item.save()
+        self.assertEqual(self.assertRollupCurrent(), {
+            (self.user.pk, datetime.date(2018, 1, 3), self.job.pk, 2, 1),
+            (self.user.pk, datetime.date(2018, 1, 3), self.other.pk, 3, 1),
+            (self.user.pk, datetime.date(2018, 1, 4), self.job.pk, 1, 1),
+        })
+
+    def test_invoiced(self):
+        item = self.create_item(3)
+
+        with CaptureQueriesContext(connection) as context:
+            item.invoiced = True
+            item.save()
+        self.assertFalse([q for q in context.captured_queries if 'worklog_userdayhours' in q['sql']])
+
+    def test_delete(self):
+        item = self.create_item(3)
+        self.create_item(4)
+
+        # the row is removed with its last item
+        item.delete()
+        self.assertEqual(self.assertRollupCurrent(), {
+            (self.user.pk, datetime.date(2018, 1, 4), self.job.pk, 1, 1),
+        })
+
+        WorkItem.objects.filter(job=self.job).delete()
+        self.assertEqual(self.assertRollupCurrent(), set())
+
+    def test_deferred(self):
+        item = self.create_item(3)
+
+        item = WorkItem.objects.only('id', 'text').get(pk=item.pk)
+        item.date = datetime.date(2018, 1, 5)
+        item.save(update_fields=['date'])
+        self.assertEqual(self.assertRollupCurrent(), {
+            (self.user.pk, datetime.date(2018, 1, 5), self.job.pk, 1, 1),
+        })
+
+    def test_add_work_rows(self):
+        self.create_item(3)
+        items = WorkItem.objects.insert(
+            WorkItem(user=self.user, date=datetime.date(2018, 1, day), hours=2, text='work', job=self.job)
+            for day in [3, 3, 4]
+        )
+
+        signals.add_created_work(items)
+        self.assertEqual(self.assertRollupCurrent(), {
+            (self.user.pk, datetime.date(2018, 1, 3), self.job.pk, 5, 3),
+            (self.user.pk, datetime.date(2018, 1, 4), self.job.pk, 2, 1),
+        })
+
+        # update() does not send signals
+        item = WorkItem.objects.get(pk=items[0].pk)
+        item.hours = 4
+        WorkItem.objects.filter(pk=item.pk).update(hours=item.hours)
+        signals.move_updated_work([item])
+        self.assertEqual(self.assertRollupCurrent(), {
+            (self.user.pk, datetime.date(2018, 1, 3), self.job.pk, 7, 3),
+            (self.user.pk, datetime.date(2018, 1, 4), self.job.pk, 2, 1),
+        })
+
+    def test_rebuild_for(self):
+        self.create_item(3)
+        self.create_item(3, job=self.other)
+
+        # update() does not send signals
+        WorkItem.objects.filter(job=self.other).update(job=self.job)
+        UserDayHours.objects.rebuild_for(WorkItem.objects.filter(job=self.job))
+        UserDayHours.objects.rebuild([self.other.pk])
+
+        self.assertEqual(self.assertRollupCurrent(), {
+            (self.user.pk, datetime.date(2018, 1, 3), self.job.pk, 2, 2),
+        })
+
+    def test_rebuild_command(self):
+        self.create_item(3)
+        self.create_item(4)
+        UserDayHours.objects.all().delete()
+
+        out = StringIO()
+        call_command('rebuild_rollups', stdout=out)
+
+        self.assertIn('Rebuilt 2 user day hours.', out.getvalue())
+        self.assertEqual(len(self.assertRollupCurrent()), 2)
@@ -3,8 +3,10 @@ import datetime
 from django.contrib.auth.models import User
 from django.core import mail
 
-from labsite.worklog import tasks
-from labsite.worklog.models import Employee, Job, WorkDay, WorkItem
+from labsite.worklog import caches, tasks
+from labsite.worklog.models import (
+    BillingSchedule, Employee, Holiday, InvoiceRun, Job, WorkDay, WorkItem,
+)
 from tests.worklog import WorklogTestCaseBase
 
 
@@ -101,3 +103,115 @@ class SendReminderEmailsTestCase(WorklogTestCaseBase):
         self.assertEquals(len(mail.outbox), 0)
         all_recipients = list(m.to[0] for m in mail.outbox)
         self.assertEquals(len(all_recipients), 0)
+
+    def test_batched(self):
+        weekday = self.today.isoweekday() in range(1, 6)
+        caches.get_holiday_calendar()
+
+        # one query for the employees, one for their work days
+        with self.settings(WORKLOG_EMAIL_REMINDERS_BATCH_SIZE=2), self.assertNumQueries(2 if weekday else 0):
+            tasks.send_reminder_emails()
+
+        expected = sum(len(dates) for dates in tasks.get_reminder_dates(
+            [self.user, self.user2, self.user3, self.user4, self.user5]).values())
+        self.assertEqual(len(mail.outbox), expected if weekday else 0)
+
+    def test_get_reminder_dates(self):
+        monday = datetime.date(2017, 3, 13)
+        WorkDay.objects.create(user=self.user, date=monday, reconciled=True)
+        WorkDay.objects.create(user=self.user2, date=monday, reconciled=False)
+        caches.get_holiday_calendar()
+
+        with self.assertNumQueries(1):
+            dates = tasks.get_reminder_dates([self.user, self.user2], today=monday)
+
+        # the weekend is skipped
+        self.assertEqual(dates, {
+            self.user.pk: [datetime.date(2017, 3, 10)],
+            self.user2.pk: [monday, datetime.date(2017, 3, 10)],
+        })
+
+    def test_holidays(self):
+        self.addCleanup(caches.clear_holiday_calendar)
+        Holiday.objects.create(
+            description="Break", start_date=datetime.date(2017, 3, 9), end_date=datetime.date(2017, 3, 10)
+        )
+        monday = datetime.date(2017, 3, 13)
+
+        dates = tasks.get_reminder_dates([self.user], today=monday)
+        self.assertEqual(dates[self.user.pk], [monday])
+
+        # no reminders are sent on a holiday
+        Holiday.objects.create(description="Today", start_date=self.today, end_date=self.today)
+        with self.settings(WORKLOG_SEND_REMINDERS=True):
+            tasks.send_reminder_emails()
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class BuildInvoiceTestCase(WorklogTestCaseBase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.billing_date = datetime.date(2017, 3, 15)
+
+        job = Job.objects.get(name="Job_LastWeek")
+        BillingSchedule.objects.create(job=job, date=cls.billing_date)
+        WorkItem.objects.create(user=cls.user, date=datetime.date(2017, 2, 27), hours=1, text="item1", job=job)
+        WorkItem.objects.create(user=cls.user, date=datetime.date(2017, 3, 1), hours=2, text="item2", job=job)
+        WorkItem.objects.create(user=cls.user, date=datetime.date(2017, 3, 6), hours=3, text="item3", job=job)
+        WorkItem.objects.create(user=cls.user, date=datetime.date(2017, 3, 6), hours=4, text="item4", job=job,
+                                invoiced=True)
+        WorkItem.objects.create(user=cls.user, date=datetime.date(2017, 3, 15), hours=5, text="item5", job=job)
+
+        # not invoiceable
+        job = Job.objects.get(name="Job_Today")
+        job.invoiceable = False
+        job.save()
+        BillingSchedule.objects.create(job=job, date=cls.billing_date)
+        WorkItem.objects.create(user=cls.user, date=datetime.date(2017, 3, 1), hours=6, text="item6", job=job)
+
+    def test_build_invoice(self):
+        with self.assertNumQueries(1):
+            msg = tasks.build_invoice(self.billing_date)
+
+        self.assertEqual(msg, (
+            "\nJob_LastWeek (6.0)"
+            "\n\tDate: Week of 2/27/2017 (1.0)\n\t\t1.0 hours, item1"
+            "\n\tDate: Week of 3/1/2017 (2.0)\n\t\t2.0 hours, item2"
+            "\n\tDate: Week of 3/6/2017 (3.0)\n\t\t3.0 hours, item3"
+        ))
+
+    def test_build_invoice_empty(self):
+        self.assertEqual(tasks.build_invoice(datetime.date(2017, 3, 16)), '')
+
+    def test_generate_invoice(self):
+        with self.settings(ADMINS=[('Admin', 'admin@example.com')]):
+            tasks.generate_invoice(str(self.billing_date))
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(mail.outbox[0].body.startswith(tasks.build_invoice(self.billing_date)))
+        self.assertEqual(mail.outbox[0].to, ['admin@example.com'])
+
+    def test_mark_invoiced(self):
+        run = InvoiceRun.objects.create(date=self.billing_date)
+
+        # including rebuilding the job summaries
+        with self.assertNumQueries(12):
+            tasks.mark_invoiced(run.pk)
+
+        run.refresh_from_db()
+        self.assertEqual(run.state, InvoiceRun.STATES.DONE)
+        self.assertFalse(run.active)
+        self.assertEqual(run.invoiced, 3)
+        self.assertEqual(
+            set(WorkItem.objects.filter(invoiced=True).values_list('text', flat=True)),
+            {'item1', 'item2', 'item3', 'item4'},
+        )
+
+    def test_mark_invoiced_once(self):
+        run = InvoiceRun.objects.create(date=self.billing_date, state=InvoiceRun.STATES.DONE, active=None)
+
+        with self.assertNumQueries(1):
+            tasks.mark_invoiced(run.pk)
+
+        self.assertEqual(WorkItem.objects.filter(invoiced=True).count(), 1)
@@ -1,12 +1,19 @@
-from datetime import date
+from datetime import date, timedelta
+from unittest import mock
 
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 from django_webtest import WebTest
 
-from labsite.worklog.models import WorkItem
+from labsite.worklog import caches
+from labsite.worklog.models import (
+    Funding, Holiday, InvoiceRun, JobSummary, UserDayHours, WorkDay, WorkItem,
+)
+from labsite.worklog.utils import get_burndown, get_work_summary
 from labsite.worklog.views import (
     find_previous_saturday, get_past_n_days, get_total_hours_from_workitems,
 )
+from tests.worklog import run_commit_hooks
 from tests.worklog.factories import JobFactory, UserFactory, WorkItemFactory
 
 
@@ -160,3 +167,287 @@ class ViewsFunctionsTest(WebTest):
         WorkItemFactory.create_batch(4, user=user, hours=2)
         items = WorkItem.objects.filter(user=user)
         self.assertEqual(get_total_hours_from_workitems(items), 8.0)
+
+
+class BurndownTestCase(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        self.user = UserFactory(username="tester")
+        self.job = JobFactory(name="burndown", available_all_users=True)
+        Funding.objects.create(job=self.job, hours=20, date_available=date(2015, 1, 1))
+        Funding.objects.create(job=self.job, hours=10, date_available=date(2015, 1, 4))
+        WorkItemFactory.create(user=self.user, job=self.job, date=date(2015, 1, 2), hours=4.0)
+        WorkItemFactory.create(user=self.user, job=self.job, date=date(2015, 1, 2), hours=2.5)
+        WorkItemFactory.create(user=self.user, job=self.job, date=date(2015, 1, 5), hours=1.0)
+
+    def test_series(self):
+        with self.assertNumQueries(2):
+            data = get_burndown(self.job)
+
+        self.assertEqual(list(data.items()), [
+            ('2015-01-01', 20),
+            ('2015-01-02', 13.5),
+            ('2015-01-03', 13.5),
+            ('2015-01-04', 23.5),
+            ('2015-01-05', 22.5),
+        ])
+
+    def test_series_range(self):
+        data = get_burndown(self.job, date(2015, 1, 3), date(2015, 1, 7))
+
+        self.assertEqual(list(data.items()), [
+            ('2015-01-03', 13.5),
+            ('2015-01-04', 23.5),
+            ('2015-01-05', 22.5),
+            ('2015-01-06', 22.5),
+            ('2015-01-07', 22.5),
+        ])
+
+    def test_errors(self):
+        with self.assertRaisesMessage(ValueError, 'Start date has to be before end date'):
+            get_burndown(self.job, date(2015, 1, 3), date(2015, 1, 2))
+
+        with self.assertRaisesMessage(ValueError, 'There is no work or funding available'):
+            get_burndown(JobFactory())
+
+    def test_chart_view(self):
+        url = reverse('worklog:chart_url')
+        response = self.app.post(url, {'job_id': self.job.pk, 'start_date': '01/02/2015', 'end_date': ''},
+                                 user=self.user)
+
+        self.assertEqual(response.json, {
+            '2015-01-02': 13.5,
+            '2015-01-03': 13.5,
+            '2015-01-04': 23.5,
+            '2015-01-05': 22.5,
+        })
+
+    def test_endpoint(self):
+        url = reverse('worklog:job_burndown_url', kwargs={'pk': self.job.pk})
+        response = self.app.get(url, {'start_date': '2015-01-04'}, user=self.user)
+        self.assertEqual(response.json, {'2015-01-04': 23.5, '2015-01-05': 22.5})
+
+        response = self.app.get(url, {'start_date': 'bad'}, user=self.user, expect_errors=True)
+        self.assertEqual(response.status_int, 400)
+
+
+class WorkSummaryTestCase(WebTest):
+
+    def setUp(self):
+        self.user = UserFactory(username="tester")
+        self.job = JobFactory(available_all_users=True)
+        self.today = date(2017, 3, 15)  # wednesday
+
+        for day, hours in [(15, 1), (15, 2), (13, 3), (11, 4), (9, 5), (8, 6), (1, 7)]:
+            WorkItemFactory.create(user=self.user, job=self.job, date=date(2017, 3, day), hours=hours)
+        WorkItemFactory.create(job=self.job, date=self.today, hours=8)
+        WorkDay.objects.create(user=self.user, date=date(2017, 3, 14), reconciled=True)
+
+    def test_summary(self):
+        with self.assertNumQueries(2):
+            summary = get_work_summary(self.user, self.today)
+
+        self.assertEqual(summary.days, [
+            (date(2017, 3, 15), 3), (date(2017, 3, 14), 0), (date(2017, 3, 13), 3), (date(2017, 3, 12), 0),
+            (date(2017, 3, 11), 4), (date(2017, 3, 10), 0), (date(2017, 3, 9), 5),
+        ])
+        # since saturday the 11th
+        self.assertEqual(summary.week_total, 10)
+        self.assertEqual(summary.outstanding, [date(2017, 3, 15), date(2017, 3, 13)])
+
+    def test_homepage(self):
+        response = self.app.get(reverse("worklog:home"), user=self.user)
+
+        self.assertEqual(len(response.context['past_seven_days']), 7)
+        self.assertEqual(response.context['total_hours'], get_work_summary(self.user).week_total)
+
+
+@mock.patch('labsite.worklog.views.mark_invoiced.delay')
+class InvoiceRunTestCase(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        self.user = UserFactory(username="tester")
+        self.url = reverse('worklog:report_url')
+
+    def invoice(self):
+        response = self.app.post(self.url, {'date': '2017-03-15', 'invoice': 'invoice'}, user=self.user)
+        run_commit_hooks()
+        return response
+
+    def test_started_once(self, delay):
+        response = self.invoice()
+        run = InvoiceRun.objects.get()
+
+        delay.assert_called_once_with(run.pk)
+        self.assertEqual(run.date, date(2017, 3, 15))
+        self.assertContains(response, 'Invoicing the items billed on')
+
+        # double submit
+        self.invoice()
+        self.assertEqual(delay.call_count, 1)
+        self.assertEqual(InvoiceRun.objects.count(), 1)
+
+    def test_rerun_finished(self, delay):
+        InvoiceRun.objects.create(date=date(2017, 3, 15), state=InvoiceRun.STATES.FAILED, active=None)
+
+        self.invoice()
+        run = InvoiceRun.objects.latest('pk')
+        delay.assert_called_once_with(run.pk)
+        self.assertEqual(run.state, InvoiceRun.STATES.PENDING)
+
+        # late items can be invoiced on a date that has been invoiced before
+        InvoiceRun.objects.filter(pk=run.pk).update(state=InvoiceRun.STATES.DONE, active=None)
+        response = self.invoice()
+        self.assertEqual(delay.call_count, 2)
+        self.assertEqual(response.context['run'], InvoiceRun.objects.latest('pk'))
+        self.assertEqual(InvoiceRun.objects.count(), 3)
+
+    def test_enqueue_failed(self, delay):
+        delay.side_effect = OSError("broker unavailable")
+
+        with self.assertLogs('labsite.worklog.views', 'ERROR'):
+            self.invoice()
+        self.assertEqual(InvoiceRun.objects.get().state, InvoiceRun.STATES.FAILED)
+
+        # the date can be invoiced again
+        delay.side_effect = None
+        self.invoice()
+        self.assertEqual(InvoiceRun.objects.latest('pk').state, InvoiceRun.STATES.PENDING)
+
+    def test_stale(self, delay):
+        self.invoice()
+        run = InvoiceRun.objects.get()
+
+        # the task was lost
+        InvoiceRun.objects.filter(pk=run.pk).update(created=timezone.now() - timedelta(hours=2))
+        self.invoice()
+        self.assertEqual(InvoiceRun.objects.get(pk=run.pk).state, InvoiceRun.STATES.FAILED)
+        self.assertEqual(delay.call_count, 2)
+
+    def test_status(self, delay):
+        InvoiceRun.objects.create(date=date(2017, 3, 15), state=InvoiceRun.STATES.DONE, invoiced=3)
+
+        response = self.app.get(self.url, {'date': '2017-03-15'}, user=self.user)
+        self.assertContains(response, 'Marked 3 items billed on')
+
+        response = self.app.get(self.url, {'date': 'bad'}, user=self.user)
+        self.assertNotContains(response, 'Marked')
+        delay.assert_not_called()
+
+
+class WeekViewTestCase(WebTest):
+    csrf_checks = False
+
+    def setUp(self):
+        self.user = UserFactory(username="tester")
+        self.alpha = JobFactory(name="Alpha", open_date=date(2000, 1, 1), close_date=None, available_all_users=True)
+        self.beta = JobFactory(name="Beta", open_date=date(2000, 1, 1), close_date=None, available_all_users=True)
+
+        # next week, which can always be edited
+        self.days = [find_previous_saturday(date.today()) + timedelta(days=i) for i in range(7, 14)]
+        self.url = reverse('worklog:week', kwargs={'date': self.days[3].isoformat()})
+
+    def create_item(self, job, day, hours, **kwargs):
+        return WorkItem.objects.create(user=self.user, job=job, date=self.days[day], hours=hours, text='work', **kwargs)
+
+    def cell(self, job, day):
+        return '%d-%s' % (job.pk, self.days[day].isoformat())
+
+    def get_data(self, **cells):
+        response = self.app.get(self.url, user=self.user)
+        data = {name: value for name, value in response.form.submit_fields()}
+        data.update(cells)
+        return data
+
+    def test_grid(self):
+        self.create_item(self.alpha, 0, 2)
+        self.create_item(self.beta, 1, 1)
+        self.create_item(self.beta, 1, 1.5)
+
+        response = self.app.get(self.url, user=self.user)
+        form = response.context['form']
+
+        self.assertEqual(response.context['days'], self.days)
+        self.assertEqual([job for job, text, cells in form.rows], [self.alpha, self.beta])
+        self.assertEqual(form[self.cell(self.alpha, 0)].value(), 2)
+        self.assertFalse(form.fields[self.cell(self.alpha, 0)].disabled)
+
+        # a cell with several items is read-only
+        self.assertEqual(form[self.cell(self.beta, 1)].value(), 2.5)
+        self.assertTrue(form.fields[self.cell(self.beta, 1)].disabled)
+
+    def test_save(self):
+        updated = self.create_item(self.alpha, 0, 2)
+        deleted = self.create_item(self.alpha, 1, 3)
+        unchanged = self.create_item(self.beta, 2, 1)
+
+        data = self.get_data(**{
+            self.cell(self.alpha, 0): '4',
+            self.cell(self.alpha, 1): '',
+            self.cell(self.alpha, 3): '1.5',
+            self.cell(self.beta, 4): '0.25',
+            '%d-text' % self.alpha.pk: 'new work',
+            '%d-text' % self.beta.pk: 'more work',
+        })
+        response = self.app.post(self.url, data, user=self.user)
+        self.assertRedirects(response, self.url)
+
+        self.assertEqual(WorkItem.objects.get(pk=updated.pk).hours, 4)
+        self.assertFalse(WorkItem.objects.filter(pk=deleted.pk).exists())
+        self.assertEqual(WorkItem.objects.get(pk=unchanged.pk).hours, 1)
+        self.assertEqual(set(WorkItem.objects.exclude(text='work').values_list('job', 'date', 'hours', 'text')), {
+            (self.alpha.pk, self.days[3], 1.5, 'new work'),
+            (self.beta.pk, self.days[4], 0.25, 'more work'),
+        })
+
+        # the rollups are refreshed
+        self.assertEqual(self.alpha.get_summary().worked_hours, 5.5)
+        self.assertEqual(
+            UserDayHours.objects.get(user=self.user, job=self.alpha, date=self.days[0]).hours, 4
+        )
+        self.assertEqual(JobSummary.objects.get(job=self.beta).worked_hours, 1.25)
+
+    def test_errors(self):
+        item = self.create_item(self.alpha, 0, 2)
+
+        data = self.get_data(**{
+            self.cell(self.alpha, 0): '1.1',
+            self.cell(self.beta, 1): '1',
+        })
+        response = self.app.post(self.url, data, user=self.user)
+        form = response.context['form']
+
+        self.assertIn(self.cell(self.alpha, 0), form.errors)
+        # new items need a description
+        self.assertIn('%d-text' % self.beta.pk, form.errors)
+
+        # nothing is saved
+        self.assertEqual(WorkItem.objects.get().pk, item.pk)
+        self.assertEqual(WorkItem.objects.get().hours, 2)
+
+    def test_read_only(self):
+        self.days = [day - timedelta(weeks=4) for day in self.days]
+        self.url = reverse('worklog:week', kwargs={'date': self.days[0].isoformat()})
+        item = self.create_item(self.alpha, 0, 2)
+
+        data = self.get_data(**{self.cell(self.alpha, 0): '3', self.cell(self.alpha, 1): '1'})
+        self.app.post(self.url, data, user=self.user)
+
+        self.assertEqual(WorkItem.objects.get().hours, item.hours)
+
+    def test_holidays(self):
+        self.addCleanup(caches.clear_holiday_calendar)
+        Holiday.objects.create(description="Break", start_date=self.days[2], end_date=self.days[3])
+
+        response = self.app.get(self.url, user=self.user)
+        self.assertEqual(response.context['holidays'], {self.days[2], self.days[3]})
+
+        response = self.app.get(reverse('worklog:date', kwargs={'date': self.days[3].isoformat()}), user=self.user)
+        self.assertTrue(response.context['is_holiday'])
+        self.assertContains(response, 'This day is a holiday.')
+
+    def test_invalid_date(self):
+        response = self.app.get('/worklog/2018-02-30/week/', user=self.user, expect_errors=True)
+        self.assertEqual(response.status_int, 404)